@@ -0,0 +1,46 @@
+"""Bonus maturation sweeper
+
+Revision ID: 5c1e9a7d2b40
+Revises: 83a3485f6337
+Create Date: 2026-10-18 09:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c1e9a7d2b40'
+down_revision: Union[str, Sequence[str], None] = '83a3485f6337'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('job_state',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('watermark', sa.DateTime(), nullable=True),
+    sa.Column('last_started_at', sa.DateTime(), nullable=True),
+    sa.Column('last_duration_ms', sa.Integer(), nullable=True),
+    sa.Column('last_processed', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_bonus_history_status_date', 'bonus_history', ['status', 'date'],
+            unique=False, postgresql_concurrently=True, if_not_exists=True
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_bonus_history_status_date', table_name='bonus_history',
+            postgresql_concurrently=True, if_exists=True
+        )
+    op.drop_table('job_state')
@@ -0,0 +1,50 @@
+"""Hot lookup indexes
+
+Revision ID: 9e4b2f61c8a3
+Revises: 5c1e9a7d2b40
+Create Date: 2026-10-18 10:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9e4b2f61c8a3'
+down_revision: Union[str, Sequence[str], None] = '5c1e9a7d2b40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_bonus_history_user_id_date', 'bonus_history', ['user_id', 'date'],
+            unique=False, postgresql_concurrently=True, if_not_exists=True
+        )
+        op.create_index(
+            'ix_bonus_history_user_id_status_date', 'bonus_history', ['user_id', 'status', 'date'],
+            unique=False, postgresql_concurrently=True, if_not_exists=True
+        )
+        op.create_index(
+            'ix_purchases_user_id', 'purchases', ['user_id'],
+            unique=False, postgresql_concurrently=True, if_not_exists=True
+        )
+        op.create_index(
+            'ix_users_invited_by_id', 'users', ['invited_by_id'],
+            unique=False, postgresql_concurrently=True, if_not_exists=True,
+            postgresql_where=sa.text('invited_by_id IS NOT NULL')
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_users_invited_by_id', table_name='users', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_purchases_user_id', table_name='purchases', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_bonus_history_user_id_status_date', table_name='bonus_history', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_bonus_history_user_id_date', table_name='bonus_history', postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,54 @@
+"""Referral closure table
+
+Revision ID: a6e2d9c40b18
+Revises: f3c8b1d5a276
+Create Date: 2026-10-18 18:05:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a6e2d9c40b18'
+down_revision: Union[str, Sequence[str], None] = 'f3c8b1d5a276'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('referral_closure',
+    sa.Column('ancestor_id', sa.BigInteger(), nullable=False),
+    sa.Column('descendant_id', sa.BigInteger(), nullable=False),
+    sa.Column('depth', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['ancestor_id'], ['users.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['descendant_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id')
+    )
+    op.create_index('ix_referral_closure_ancestor_id_depth', 'referral_closure', ['ancestor_id', 'depth'], unique=False)
+    op.create_index('ix_referral_closure_descendant_id_depth', 'referral_closure', ['descendant_id', 'depth'], unique=False)
+    # Даунлайн и link_referral читают замыкание сразу после деплоя, поэтому заполняем его здесь же.
+    # Глубина ограничена, чтобы цикл в invited_by_id не зациклил запрос
+    op.execute("""
+        INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE paths (ancestor_id, descendant_id, depth) AS (
+            SELECT invited_by_id, id, 1 FROM users WHERE invited_by_id IS NOT NULL AND invited_by_id <> id
+            UNION ALL
+            SELECT p.ancestor_id, u.id, p.depth + 1
+            FROM paths p JOIN users u ON u.invited_by_id = p.descendant_id
+            WHERE p.depth < 1000
+        )
+        SELECT ancestor_id, descendant_id, min(depth) FROM paths
+        WHERE ancestor_id <> descendant_id
+        GROUP BY ancestor_id, descendant_id
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_referral_closure_descendant_id_depth', table_name='referral_closure')
+    op.drop_index('ix_referral_closure_ancestor_id_depth', table_name='referral_closure')
+    op.drop_table('referral_closure')
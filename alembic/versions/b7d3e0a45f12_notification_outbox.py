@@ -0,0 +1,44 @@
+"""Notification outbox
+
+Revision ID: b7d3e0a45f12
+Revises: 9e4b2f61c8a3
+Create Date: 2026-10-18 11:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7d3e0a45f12'
+down_revision: Union[str, Sequence[str], None] = '9e4b2f61c8a3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('notification_outbox',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('chat_id', sa.BigInteger(), nullable=False),
+    sa.Column('text', sa.String(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('sent_at', sa.DateTime(), nullable=True),
+    sa.Column('last_error', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'ix_notification_outbox_due', 'notification_outbox', ['next_attempt_at'],
+        unique=False, postgresql_where=sa.text("status = 'pending'")
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_notification_outbox_due', table_name='notification_outbox')
+    op.drop_table('notification_outbox')
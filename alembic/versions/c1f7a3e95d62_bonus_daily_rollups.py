@@ -0,0 +1,46 @@
+"""Bonus daily rollups
+
+Revision ID: c1f7a3e95d62
+Revises: a6e2d9c40b18
+Create Date: 2026-10-18 19:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c1f7a3e95d62'
+down_revision: Union[str, Sequence[str], None] = 'a6e2d9c40b18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('bonus_daily_rollups',
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('earned', sa.BigInteger(), nullable=False),
+    sa.Column('paid_out', sa.BigInteger(), nullable=False),
+    sa.Column('operations', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'day')
+    )
+    op.create_index('ix_bonus_daily_rollups_day', 'bonus_daily_rollups', ['day'], unique=False, postgresql_include=['user_id', 'earned'])
+    # Статистика в боте читается из агрегатов сразу после деплоя, поэтому заполняем их здесь же
+    op.execute("""
+        INSERT INTO bonus_daily_rollups (user_id, day, earned, paid_out, operations)
+        SELECT user_id, date::date, sum(greatest(amount, 0)), sum(greatest(-amount, 0)), count(*)
+        FROM bonus_history
+        WHERE user_id IS NOT NULL AND date IS NOT NULL
+        GROUP BY user_id, date::date
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_bonus_daily_rollups_day', table_name='bonus_daily_rollups', postgresql_include=['user_id', 'earned'])
+    op.drop_table('bonus_daily_rollups')
@@ -0,0 +1,55 @@
+"""Broadcast campaigns
+
+Revision ID: d2a9c4e7b1f0
+Revises: b7d3e0a45f12
+Create Date: 2026-10-18 14:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2a9c4e7b1f0'
+down_revision: Union[str, Sequence[str], None] = 'b7d3e0a45f12'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('broadcast_campaigns',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('text', sa.String(), nullable=False),
+    sa.Column('audience', sa.String(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('last_user_id', sa.BigInteger(), nullable=False),
+    sa.Column('total_recipients', sa.Integer(), nullable=True),
+    sa.Column('delivered', sa.Integer(), nullable=False),
+    sa.Column('blocked', sa.Integer(), nullable=False),
+    sa.Column('failed', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('broadcast_deliveries',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('campaign_id', sa.BigInteger(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('sent_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['campaign_id'], ['broadcast_campaigns.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('campaign_id', 'user_id', name='uq_broadcast_deliveries_campaign_user')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('broadcast_deliveries')
+    op.drop_table('broadcast_campaigns')
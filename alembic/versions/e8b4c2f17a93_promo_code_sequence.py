@@ -0,0 +1,29 @@
+"""Promo code sequence
+
+Revision ID: e8b4c2f17a93
+Revises: c1f7a3e95d62
+Create Date: 2026-10-18 20:45:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8b4c2f17a93'
+down_revision: Union[str, Sequence[str], None] = 'c1f7a3e95d62'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Шаг равен models.PROMO_CODE_BLOCK: каждый nextval резервирует блок номеров
+    op.execute(sa.schema.CreateSequence(sa.Sequence('promo_code_seq', start=1, increment=100)))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute(sa.schema.DropSequence(sa.Sequence('promo_code_seq')))
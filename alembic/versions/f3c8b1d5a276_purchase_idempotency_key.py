@@ -0,0 +1,34 @@
+"""Purchase idempotency key
+
+Revision ID: f3c8b1d5a276
+Revises: d2a9c4e7b1f0
+Create Date: 2026-10-18 16:40:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3c8b1d5a276'
+down_revision: Union[str, Sequence[str], None] = 'd2a9c4e7b1f0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('purchases', sa.Column('idempotency_key', sa.String(), nullable=True))
+    # Колонка новая и пустая, поэтому индекс строится мгновенно и без CONCURRENTLY
+    op.create_index(
+        'ux_purchases_idempotency_key', 'purchases', ['idempotency_key'],
+        unique=True, postgresql_where=sa.text('idempotency_key IS NOT NULL')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ux_purchases_idempotency_key', table_name='purchases', postgresql_where=sa.text('idempotency_key IS NOT NULL'))
+    op.drop_column('purchases', 'idempotency_key')
@@ -4,24 +4,42 @@ from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, JSONResponse, Response 
 from starlette.responses import RedirectResponse
 from sqladmin import Admin, ModelView
-from sqladmin import action
+from sqladmin import action, expose
 from sqlalchemy import select, func
-from src.referalbot.api.routes import router, log_to_google_sheet, log_bonus_history
+from src.referalbot.api.routes import router, log_bonus_history
 from src.referalbot.database.db import async_session, init_db, engine
-from src.referalbot.database.models import User, Purchase, BonusHistory
+from src.referalbot.database.models import User, Purchase, BonusHistory, BroadcastCampaign, BROADCAST_AUDIENCES
 from src.referalbot.database import repository
+from src.referalbot.database.cache import listen_balance_invalidations
+from src.referalbot.jobs.maturation import run_maturation_sweeper
+from src.referalbot.jobs.notifications import NotificationDispatcher
+from src.referalbot.jobs.broadcast import BroadcastSender
+from src.referalbot.jobs.sheets import sheets_exporter
+from src.referalbot.jobs.bulk_bonus import (
+    PAYOUT, CREDIT, payout_batch, credit_batch, start_bulk_operation, get_bulk_operation, cancel_bulk_operations
+)
+from src.referalbot.bot.client import get_bot, close_bot
+from src.referalbot.api import webhook
+from src.referalbot.api.middleware import CorrelationIdMiddleware, MetricsMiddleware, QueryTrackerMiddleware
+from src.referalbot.config import (
+    BOT_MODE, ADMIN_DETAIL_RECENT_ITEMS, ADMIN_RELATION_PAGE_SIZE, ADMIN_BULK_INLINE_LIMIT
+)
+from src.referalbot.utils import logger
 from sqladmin.authentication import AuthenticationBackend
 from sqlalchemy.orm import Session
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import selectinload, lazyload, with_expression
+from markupsafe import Markup, escape
+from wtforms import SelectField
 import datetime
-from aiogram import Bot
-from src.referalbot.config import TELEGRAM_TOKEN
 import asyncio
 import os
 
 app = FastAPI()
+app.add_middleware(QueryTrackerMiddleware)
+app.add_middleware(MetricsMiddleware)
+# Добавлен последним, поэтому внешний: id виден во всех логах запроса
+app.add_middleware(CorrelationIdMiddleware)
 templates = Jinja2Templates(directory="src/referalbot/api/templates")
-bot = Bot(token=TELEGRAM_TOKEN) # Создаем экземпляр бота для отправки сообщений
 
 
 class AdminAuth(AuthenticationBackend):
@@ -56,16 +74,47 @@ admin = Admin(
     base_url="/admin"
 )
 
+def _bonus_status_label(history: BonusHistory) -> str:
+    return 'Ожидание' if history.status == 'pending' else 'Доступен'
+
+def _format_datetime(value: datetime.datetime | None) -> str:
+    return value.strftime('%Y-%m-%d %H:%M') if value else '-'
+
+def _format_referral(referral: User) -> Markup:
+    return escape(f"{referral.username} (ID: {referral.telegram_id})")
+
+def _format_bonus_operation(history: BonusHistory) -> Markup:
+    date = history.date.strftime('%Y-%m-%d') if history.date else '-'
+    return escape(f"{date}: {history.amount:+,} IDR ({history.operation}, {_bonus_status_label(history)})")
+
+def _format_downline(downline: dict) -> str:
+    if not downline["size"]:
+        return "Нет рефералов"
+    levels = ", ".join(f"{level['depth']}: {level['count']:,}" for level in downline["levels"])
+    return f"{downline['size']:,} чел., уровней: {downline['depth']} (по уровням: {levels})"
+
+def _relation_preview(items: list[Markup], total: int, url: str, empty: str) -> Markup:
+    """Latest items of a relationship plus a link to its paginated page when there are more."""
+    if not items:
+        return escape(empty)
+    preview = Markup("<br>").join(items)
+    if total > len(items):
+        preview += Markup('<br><a href="{}">Показать все ({:,})</a>').format(url, total)
+    return preview
+
 class UserAdmin(ModelView, model=User):
     name = "Пользователь"
     name_plural = "Пользователи"
     icon = "fa-solid fa-user"
-    column_list = [User.id, User.telegram_id, User.username, "available_bonus", "pending_bonus"]
+    column_list = [User.id, User.telegram_id, User.username, "available_balance", "pending_balance"]
+    column_sortable_list = [User.id, User.telegram_id, User.username, "available_balance", "pending_balance"]
     column_searchable_list = ["username", "promo_code", "telegram_id"]
     column_details_list = [
         User.id, User.telegram_id, User.username, User.promo_code,
-        "invited_by", "referrals", "bonus_history", "available_bonus", "pending_bonus"
+        "invited_by", "available_balance", "pending_balance", "downline", "recent_referrals", "recent_bonus_history"
     ]
+    # Рефералов меняют через поле "Пригласил" у них самих, чтобы замыкание дерева оставалось согласованным
+    form_excluded_columns = [User.referrals]
     
     column_labels = {
         'id': 'ID',
@@ -73,78 +122,210 @@ class UserAdmin(ModelView, model=User):
         'username': 'Имя пользователя',
         'promo_code': 'Промокод',
         'invited_by': 'Пригласил',
-        'referrals': 'Рефералы',
-        'bonus_history': 'История бонусов',
-        'available_bonus': 'Доступные бонусы',
-        'pending_bonus': 'Ожидающие бонусы',
+        'downline': 'Структура',
+        'recent_referrals': 'Рефералы',
+        'recent_bonus_history': 'История бонусов',
+        'available_balance': 'Доступные бонусы',
+        'pending_balance': 'Ожидающие бонусы',
     }
 
     column_formatters = {
-        "referrals": lambda m, a: "<br>".join(
-            [f"{ref.username} (ID: {ref.telegram_id})" for ref in m.referrals]
-        ) if m.referrals else "-",
-        "bonus_history": lambda m, a: "<br>".join(
-            [f"{h.date.strftime('%Y-%m-%d')}: {h.amount:+,} IDR ({h.operation}, {'Ожидание' if h.status == 'pending' else 'Доступен'})"
-             for h in sorted(m.bonus_history, key=lambda x: x.date, reverse=True)]
-        ) if m.bonus_history else "Нет операций",
-        "available_bonus": lambda m, a: f"{m.available_bonus:,}",
-        "pending_bonus": lambda m, a: f"{m.pending_bonus:,}",
+        "available_balance": lambda m, a: f"{m.available_balance:,}",
+        "pending_balance": lambda m, a: f"{m.pending_balance:,}",
     }
-    
-    async def get_query_for_list(self, session, *args, **kwargs):
-        """Запрос для списка пользователей с предзагрузкой истории бонусов."""
-        return await session.execute(
-            select(User).options(selectinload(User.bonus_history))
+
+    # На странице пользователя - только последние записи и ссылка на постраничный просмотр
+    column_formatters_detail = {
+        "available_balance": lambda m, a: f"{m.available_balance:,}",
+        "pending_balance": lambda m, a: f"{m.pending_balance:,}",
+        "downline": lambda m, a: _format_downline(m.downline),
+        "recent_referrals": lambda m, a: _relation_preview(
+            [_format_referral(ref) for ref in m.recent_referrals],
+            m.relation_counts["referrals"],
+            f"{admin.base_url}/{UserAdmin.identity}/{m.id}/referrals",
+            "Нет рефералов",
+        ),
+        "recent_bonus_history": lambda m, a: _relation_preview(
+            [_format_bonus_operation(h) for h in m.recent_bonus_history],
+            m.relation_counts["bonus_history"],
+            f"{admin.base_url}/{UserAdmin.identity}/{m.id}/bonus-history",
+            "Нет операций",
+        ),
+    }
+
+    def list_query(self, request: Request):
+        """
+        Users with balances aggregated in SQL: the bonus history itself is not
+        loaded, so the list page costs the same for any history size.
+        """
+        available, pending = repository.user_balance_columns()
+        # Сохраняем выражения для sort_query, чтобы сортировать по тем же колонкам
+        request.state.balance_columns = {"available_balance": available, "pending_balance": pending}
+        return select(User).options(
+            lazyload(User.bonus_history),
+            with_expression(User.available_balance, available),
+            with_expression(User.pending_balance, pending),
         )
+
+    def sort_query(self, stmt, request: Request):
+        sort_by = request.query_params.get("sortBy")
+        balance_columns = getattr(request.state, "balance_columns", {})
+        if sort_by not in balance_columns:
+            return super().sort_query(stmt, request)
+        column = balance_columns[sort_by]
+        order = column.desc() if request.query_params.get("sort") == "desc" else column.asc()
+        # id как второй ключ, чтобы страницы не пересекались при равных балансах
+        return stmt.order_by(order, User.id)
     
-    async def get_query_for_details(self, session, pk):
-        """Запрос для детального просмотра с загрузкой связей"""
-        return await session.execute(
-            select(User)
-            .options(
-                selectinload(User.invited_by),
-                selectinload(User.referrals),
-                selectinload(User.bonus_history)
+    def details_query(self, request: Request):
+        """User with SQL-aggregated balances; referrals and bonus history are not loaded."""
+        available, pending = repository.user_balance_columns()
+        return self._stmt_by_identifier(request.path_params["pk"]).options(
+            selectinload(User.invited_by).lazyload(User.bonus_history),
+            lazyload(User.referrals),
+            lazyload(User.purchases),
+            lazyload(User.bonus_history),
+            with_expression(User.available_balance, available),
+            with_expression(User.pending_balance, pending),
+        )
+
+    async def get_object_for_details(self, request: Request):
+        user = await super().get_object_for_details(request)
+        if user is None:
+            return None
+        async with async_session() as session:
+            user.relation_counts = await repository.count_user_relations(session, user.id)
+            user.downline = await repository.get_downline_stats(session, user.id)
+            user.recent_referrals = await repository.get_referrals_page(session, user.id, ADMIN_DETAIL_RECENT_ITEMS)
+            user.recent_bonus_history = await repository.get_bonus_history_page(
+                session, user.id, ADMIN_DETAIL_RECENT_ITEMS
             )
-            .filter_by(id=pk)
+        return user
+
+    async def on_model_change(self, data, model, is_created, request):
+        if is_created:
+            return
+        if "invited_by" not in data:
+            return
+        inviter_id = int(data["invited_by"]) if data["invited_by"] else None
+        if inviter_id == model.invited_by_id:
+            return
+        # Цикл в дереве отклоняется до сохранения, вместе со всей формой
+        if inviter_id is not None:
+            async with async_session() as session:
+                if await repository.creates_referral_cycle(session, model.id, inviter_id):
+                    raise ValueError("Пользователя не может пригласить он сам или его реферал")
+        # Замыкание переносится только после успешного сохранения
+        request.state.relink_referral = True
+
+    async def after_model_change(self, data, model, is_created, request):
+        if not (model.invited_by_id if is_created else getattr(request.state, "relink_referral", False)):
+            return
+        async with async_session() as session:
+            async with session.begin():
+                if not await repository.link_referral(session, model.id, model.invited_by_id):
+                    # Пригласивший успел попасть в даунлайн между проверкой и сохранением
+                    logger.error(
+                        f"Замыкание не обновлено: пользователь {model.id} приглашён "
+                        f"своим рефералом {model.invited_by_id}"
+                    )
+
+    @expose("/{pk}/referrals", methods=["GET"])
+    async def referrals_page(self, request: Request):
+        """All referrals of a user, newest first, ADMIN_RELATION_PAGE_SIZE per page."""
+        user_id = int(request.path_params["pk"])
+        before_id = request.query_params.get("before_id")
+        async with async_session() as session:
+            user = await session.get(User, user_id, options=[lazyload(User.bonus_history)])
+            if user is None:
+                raise HTTPException(status_code=404)
+            referrals = await repository.get_referrals_page(
+                session, user_id, ADMIN_RELATION_PAGE_SIZE, int(before_id) if before_id else None
+            )
+        return await self._relation_page(
+            request, user, f"Рефералы: {user}",
+            ["ID", "Имя пользователя", "Telegram ID", "Дата регистрации"],
+            [[ref.id, ref.username, ref.telegram_id, _format_datetime(ref.created_at)] for ref in referrals],
+            referrals,
+        )
+
+    @expose("/{pk}/bonus-history", methods=["GET"])
+    async def bonus_history_page(self, request: Request):
+        """Bonus operations of a user, newest first, ADMIN_RELATION_PAGE_SIZE per page."""
+        user_id = int(request.path_params["pk"])
+        before_id = request.query_params.get("before_id")
+        async with async_session() as session:
+            user = await session.get(User, user_id, options=[lazyload(User.bonus_history)])
+            if user is None:
+                raise HTTPException(status_code=404)
+            history = await repository.get_bonus_history_page(
+                session, user_id, ADMIN_RELATION_PAGE_SIZE, int(before_id) if before_id else None
+            )
+        return await self._relation_page(
+            request, user, f"История бонусов: {user}",
+            ["Дата", "Сумма", "Операция", "Описание", "Статус"],
+            [
+                [_format_datetime(h.date), f"{h.amount:+,} IDR", h.operation, h.description, _bonus_status_label(h)]
+                for h in history
+            ],
+            history,
         )
-        
+
+    async def _relation_page(self, request: Request, user: User, title: str, headers, rows, items):
+        # Полная страница - значит, дальше могут быть ещё записи
+        next_url = None
+        if len(items) == ADMIN_RELATION_PAGE_SIZE:
+            next_url = str(request.url.include_query_params(before_id=items[-1].id))
+        return await self.templates.TemplateResponse(request, "user_relation_page.html", {
+            "title": title,
+            "headers": headers,
+            "rows": rows,
+            "next_url": next_url,
+            "back_url": request.url_for("admin:details", identity=self.identity, pk=user.id),
+        })
+
     @action(
         name="reset_bonus",
         label="Сбросить бонусы",
         confirmation_message="Вы уверены, что хотите сбросить бонусы? Это действие отметит все доступные бонусы как выплаченные.",
     )
     async def reset_bonus_action(self, request: Request):
-        pks = request.query_params.getlist("pks")
+        pks = [int(pk) for pk in request.query_params.getlist("pks")]
         if not pks:
             return JSONResponse({"message": "Пользователи не выбраны"}, status_code=400)
 
-        messages = []
+        if len(pks) > ADMIN_BULK_INLINE_LIMIT:
+            operation_id = await start_bulk_operation(PAYOUT, pks)
+            return RedirectResponse(
+                request.url_for("admin:view-user-bulk_operation_page", operation_id=operation_id), status_code=302
+            )
+
         async with async_session() as session:
             async with session.begin():
-                for pk in pks:
-                    user_id = int(pk)
-                    user = await session.get(User, user_id)
-                    username = user.username if user else f"ID {user_id}"
-
-                    balance_data = await repository.get_bonus_balance(session, user_id)
-                    available_balance = balance_data['available_balance']
-
-                    if available_balance <= 0:
-                        messages.append(f"❌ Для пользователя {username}: нет доступных бонусов для выплаты.")
-                        continue
-
-                    await log_bonus_history(
-                        session,
-                        user_id,
-                        -available_balance,
-                        "Выплата (Админ)",
-                        "Выплата всего доступного баланса"
-                    )
-                    messages.append(f"✅ Для пользователя {username}: выплачен доступный баланс в размере {available_balance:,} IDR.")
+                usernames, paid = await payout_batch(session, pks)
+
+        messages = []
+        for user_id in pks:
+            username = usernames.get(user_id) or f"ID {user_id}"
+            if user_id in paid:
+                messages.append(f"✅ Для пользователя {username}: выплачен доступный баланс в размере {paid[user_id]:,} IDR.")
+            else:
+                messages.append(f"❌ Для пользователя {username}: нет доступных бонусов для выплаты.")
 
         return JSONResponse({"message": " ".join(messages)})
 
+    @expose("/bulk/{operation_id}", methods=["GET"])
+    async def bulk_operation_page(self, request: Request):
+        """Progress of a background bulk payout or credit."""
+        operation = await get_bulk_operation(request.path_params["operation_id"])
+        if operation is None:
+            raise HTTPException(status_code=404)
+        return await self.templates.TemplateResponse(request, "bulk_operation.html", {
+            "title": "Массовая выплата" if operation["kind"] == PAYOUT else "Массовое начисление",
+            "operation": operation,
+            "back_url": request.url_for("admin:list", identity=self.identity),
+        })
+
     @action(
         name="add_bonus",
         label="Начислить бонусы",
@@ -184,8 +365,7 @@ class PurchaseAdmin(ModelView, model=Purchase):
 
     async def create(self, request: Request) -> Response:
         if request.method == "GET":
-            # --- ОТЛАДКА ---
-            print("GET /create. Данные в сессии:", request.session.get("last_purchase_data"))
+            logger.debug("GET /create: данные в сессии %s", request.session.get("last_purchase_data"))
             
             # Получаем форму
             Form = await self.scaffold_form()
@@ -201,18 +381,15 @@ class PurchaseAdmin(ModelView, model=Purchase):
 
         # --- Обработка POST ---
         elif request.method == "POST":
-            # --- ОТЛАДКА ---
-            print("POST /create. Начало обработки.")
+            logger.debug("POST /create: начало обработки")
             
             # 1. Получаем данные формы
             form_data = await request.form()
-            # --- ОТЛАДКА ---
-            print("Данные формы (POST):", dict(form_data))
+            logger.debug("POST /create: данные формы %s", dict(form_data))
             
             # 2. Определяем действие
             save_action = form_data.get("save_action")
-            # --- ОТЛАДКА ---
-            print("Действие:", save_action)
+            logger.debug("POST /create: действие %s", save_action)
 
             # 3. Создаем форму для валидации
             Form = await self.scaffold_form()
@@ -221,8 +398,7 @@ class PurchaseAdmin(ModelView, model=Purchase):
 
             # 4. Проверяем валидацию
             if not form.is_valid():
-                # --- ОТЛАДКА ---
-                print("Форма невалидна:", form.errors)
+                logger.debug("POST /create: форма невалидна %s", form.errors)
                 # Если форма невалидна, снова показываем её с ошибками
                 context = {"request": request, "model_view": self, "form": form}
                 return await self.templates.render(self.create_template, context=context)
@@ -232,8 +408,7 @@ class PurchaseAdmin(ModelView, model=Purchase):
             model = self.model()
             # Заполняем модель данными из формы
             data = form.data  # Это словарь с проверенными данными
-            # --- ОТЛАДКА ---
-            print("Проверенные данные формы:", data)
+            logger.debug("POST /create: проверенные данные формы %s", data)
             
             # Вызываем on_model_change для бизнес-логики (например, расчет bonus_amount)
             # Передаем data, model, is_created=True
@@ -247,16 +422,14 @@ class PurchaseAdmin(ModelView, model=Purchase):
                 if name != "save_action": # Исключаем служебное поле
                     setattr(model, name, value)
                     
-            # --- ОТЛАДКА ---
-            print("Модель перед сохранением:", model.__dict__)
+            logger.debug("POST /create: модель перед сохранением %s", model.__dict__)
 
             # 6. Сохраняем модель в БД
             async with async_session() as session:
                 session.add(model)
                 await session.commit()
                 await session.refresh(model) # Получаем ID
-                # --- ОТЛАДКА ---
-                print("Модель сохранена с ID:", model.id)
+                logger.debug("POST /create: покупка сохранена с ID %s", model.id)
                 
             # 7. Вызываем after_model_change для логики после сохранения (бонусы)
             # Передаем data, сохраненную модель, is_created=True
@@ -274,42 +447,38 @@ class PurchaseAdmin(ModelView, model=Purchase):
                     # bonus_amount и date не сохраняем
                 }
                 request.session["last_purchase_data"] = session_data
-                # --- ОТЛАДКА ---
-                print("'Save and add another' нажата. Сохраненные данные:", session_data)
+                logger.debug("POST /create: 'Save and add another', данные для следующей формы %s", session_data)
                 # Редиректим НАЗАД на страницу создания
                 return RedirectResponse(request.url, status_code=303) # 303 See Other для правильного GET-запроса
                 
             else: # save_action == "save" или не определено
                 # Очищаем сессию
                 request.session.pop("last_purchase_data", None)
-                # --- ОТЛАДКА ---
-                print("'Save' нажата или действие не определено. Данные из сессии очищены.")
+                logger.debug("POST /create: 'Save', данные из сессии очищены")
                 # Редиректим на страницу списка
                 return RedirectResponse(self.url_path_for('list'), status_code=303)
 
 # Обновите также list, чтобы избежать преждевременной очистки
     async def list(self, request: Request) -> Response:
-    # --- ОТЛАДКА ---
-        print("GET /list. Session contents:", request.session)
+        logger.debug("GET /list: данные в сессии %s", request.session)
         # При переходе к списку очищаем сессию от временных данных
         # Но только если мы пришли сюда не из-за "Save and add another"
         # Так как в create мы сами управляем редиректом, здесь можно просто очистить.
         # Хотя, если пользователь перешел на список другим способом, очистка не повредит.
         if "last_purchase_data" in request.session:
-            print("Возврат к списку. Очистка данных из сессии.")
+            logger.debug("GET /list: очистка данных из сессии")
             request.session.pop("last_purchase_data", None)
         return await super().list(request)
 
 # Обновите after_model_change, чтобы он не пытался обрабатывать form_data снова
     async def after_model_change(self, data: dict, model: Purchase, is_created: bool, request: Request) -> None:
-        print("after_model_change вызван. is_created:", is_created, "model.id:", model.id if model else None)
+        logger.debug("after_model_change: is_created=%s, model.id=%s", is_created, model.id if model else None)
     
     # Эта логика теперь вызывается из нашего кастомного create
     # и не должна больше пытаться анализировать request.form()
     
         if not is_created or not model or model.bonus_amount <= 0:
-            # --- ОТЛАДКА ---
-            print("after_model_change: Условия не выполнены (is_created, model, bonus_amount). Выход.")
+            logger.debug("after_model_change: условия не выполнены (is_created, model, bonus_amount)")
             return
             
         # --- Логика начисления бонусов ---
@@ -317,8 +486,7 @@ class PurchaseAdmin(ModelView, model=Purchase):
             # Загружаем Purchase с пользователем и его пригласившим
             purchase_db = await session.get(Purchase, model.id, options=[selectinload(Purchase.user).selectinload(User.invited_by)])
             if not (purchase_db and purchase_db.user and purchase_db.user.invited_by):
-                # --- ОТЛАДКА ---
-                print("after_model_change: Пользователь или пригласивший не найдены.")
+                logger.debug("after_model_change: пользователь или пригласивший не найдены")
                 return # Нет пригласившего, бонус не начисляем
                 
             inviter = purchase_db.user.invited_by
@@ -330,21 +498,16 @@ class PurchaseAdmin(ModelView, model=Purchase):
                 "Начисление", f"За покупку от {user.username}"
             )
             
-            # Отправляем уведомление в Telegram
+            # Уведомление в Telegram уходит через outbox вместе с бонусом
             if inviter.telegram_id:
-                try:
-                    await bot.send_message(
-                        chat_id=inviter.telegram_id,
-                        text=f"🎉 Вам начислен бонус: +{model.bonus_amount:,} IDR"
-                    )
-                    # --- ОТЛАДКА ---
-                    print(f"Уведомление отправлено пользователю {inviter.telegram_id}")
-                except Exception as e:
-                    print(f"Ошибка отправки уведомления: {e}")
+                repository.enqueue_notification(
+                    session,
+                    inviter.telegram_id,
+                    f"🎉 Вам начислен бонус: +{model.bonus_amount:,} IDR"
+                )
                     
             await session.commit()
-            # --- ОТЛАДКА ---
-            print("Бонусы успешно начислены и записаны в БД.")
+            logger.info(f"Бонус {model.bonus_amount} IDR за покупку {model.id} начислен пользователю {inviter.id}")
     
     async def on_model_change(self, data: dict, model: Purchase, is_created: bool, request: Request) -> None:
         async with async_session() as session:
@@ -380,21 +543,23 @@ async def add_bonus(request: Request):
             {"request": request, "message": "Ошибка: Сумма для начисления должна быть положительной."}
         )
 
+    user_ids = [int(pk) for pk in pks]
+    if len(user_ids) > ADMIN_BULK_INLINE_LIMIT:
+        operation_id = await start_bulk_operation(CREDIT, user_ids, amount_to_add)
+        return RedirectResponse(
+            url=f"{admin.base_url}/{UserAdmin.identity}/bulk/{operation_id}", status_code=302
+        )
+
     async with async_session() as session:
         async with session.begin():
-            for pk in pks:
-                user_id = int(pk)
-                user = await session.get(User, user_id)
-                username = user.username if user else f"ID {user_id}"
+            usernames, _ = await credit_batch(session, user_ids, amount_to_add)
 
-                await log_bonus_history(
-                    session,
-                    user_id,
-                    amount_to_add,
-                    "Начисление (Админ)",
-                    f"Начисление через админ-панель"
-                )
-                messages.append(f"✅ Для пользователя {username}: Бонусы успешно начислены на {amount_to_add:,} IDR.")
+    for user_id in user_ids:
+        if user_id in usernames:
+            username = usernames[user_id] or f"ID {user_id}"
+            messages.append(f"✅ Для пользователя {username}: Бонусы успешно начислены на {amount_to_add:,} IDR.")
+        else:
+            messages.append(f"❌ Пользователь ID {user_id} не найден.")
 
     return templates.TemplateResponse(
         "add_bonus_success.html",
@@ -432,12 +597,110 @@ class BonusHistoryAdmin(ModelView, model=BonusHistory):
             .filter_by(id=pk)
         )
 
+BROADCAST_STATUSES = {
+    'draft': 'Черновик',
+    'running': 'Отправляется',
+    'paused': 'Приостановлена',
+    'done': 'Завершена',
+    'cancelled': 'Отменена',
+}
+
+
+class BroadcastCampaignAdmin(ModelView, model=BroadcastCampaign):
+    """
+    Broadcasts are created as drafts and sent by BroadcastSender once started;
+    pausing or cancelling takes effect after the batch being sent.
+    """
+    name = "Рассылка"
+    name_plural = "Рассылки"
+    icon = "fa-solid fa-bullhorn"
+    can_edit = False
+    column_list = [
+        BroadcastCampaign.id, BroadcastCampaign.created_at, BroadcastCampaign.audience, BroadcastCampaign.status,
+        BroadcastCampaign.total_recipients, BroadcastCampaign.delivered, BroadcastCampaign.blocked,
+        BroadcastCampaign.failed,
+    ]
+    column_details_exclude_list = [BroadcastCampaign.last_user_id]
+    column_default_sort = [(BroadcastCampaign.id, True)]
+    form_columns = [BroadcastCampaign.text, BroadcastCampaign.audience]
+    form_overrides = {'audience': SelectField}
+    form_args = {
+        'text': {'label': 'Текст сообщения'},
+        'audience': {'label': 'Получатели', 'choices': list(BROADCAST_AUDIENCES.items())},
+    }
+    column_labels = {
+        'id': 'ID',
+        'text': 'Текст сообщения',
+        'created_at': 'Создана',
+        'started_at': 'Запущена',
+        'finished_at': 'Завершена',
+        'audience': 'Получатели',
+        'status': 'Статус',
+        'total_recipients': 'Обработано',
+        'delivered': 'Доставлено',
+        'blocked': 'Заблокировали бота',
+        'failed': 'Ошибки',
+    }
+    column_formatters = {
+        "audience": lambda m, a: BROADCAST_AUDIENCES.get(m.audience, m.audience),
+        "status": lambda m, a: BROADCAST_STATUSES.get(m.status, m.status),
+        "total_recipients": lambda m, a: (
+            f"{m.delivered + m.blocked + m.failed:,} / {m.total_recipients:,}" if m.total_recipients is not None else "—"
+        ),
+    }
+    column_formatters_detail = column_formatters
+
+    async def _change_status(self, request: Request, status: str, from_statuses: tuple[str, ...]):
+        pks = [int(pk) for pk in request.query_params.getlist("pks")]
+        async with async_session() as session:
+            async with session.begin():
+                await repository.set_broadcast_status(session, pks, status, from_statuses)
+        return RedirectResponse(request.url_for("admin:list", identity=self.identity), status_code=302)
+
+    @action(name="start", label="Запустить", confirmation_message="Начать (или продолжить) отправку выбранных рассылок?")
+    async def start_action(self, request: Request):
+        return await self._change_status(request, 'running', ('draft', 'paused'))
+
+    @action(name="pause", label="Приостановить")
+    async def pause_action(self, request: Request):
+        return await self._change_status(request, 'paused', ('running',))
+
+    @action(name="cancel", label="Отменить", confirmation_message="Отменить выбранные рассылки? Продолжить их будет нельзя.")
+    async def cancel_action(self, request: Request):
+        return await self._change_status(request, 'cancelled', ('draft', 'running', 'paused'))
+
 admin.add_view(UserAdmin)
 admin.add_view(PurchaseAdmin)
 admin.add_view(BonusHistoryAdmin)
+admin.add_view(BroadcastCampaignAdmin)
 
 app.include_router(router)
+if BOT_MODE == "webhook":
+    app.include_router(webhook.router)
 
 @app.on_event("startup")
 async def startup_event():
-    await init_db()
\ No newline at end of file
+    await init_db()
+    if BOT_MODE == "webhook":
+        await webhook.setup_webhook()
+    app.state.notification_dispatcher = NotificationDispatcher(get_bot())
+    # Рассылки и уведомления делят один глобальный лимит Telegram
+    app.state.broadcast_sender = BroadcastSender(get_bot(), app.state.notification_dispatcher.global_limiter)
+    app.state.background_tasks = [
+        asyncio.create_task(run_maturation_sweeper()),
+        asyncio.create_task(app.state.notification_dispatcher.run()),
+        asyncio.create_task(app.state.broadcast_sender.run()),
+        asyncio.create_task(sheets_exporter.run()),
+    ]
+    if BOT_MODE == "webhook":
+        # Балансы читает бот, а пишут и другие процессы API
+        app.state.background_tasks.append(asyncio.create_task(listen_balance_invalidations(engine)))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in app.state.background_tasks:
+        task.cancel()
+    await asyncio.gather(*app.state.background_tasks, return_exceptions=True)
+    await cancel_bulk_operations()
+    await webhook.drain_updates()
+    await close_bot()
\ No newline at end of file
@@ -0,0 +1,125 @@
+import time
+import uuid
+
+from starlette.routing import Match, Mount
+
+from src.referalbot.database.query_tracker import track_queries
+from src.referalbot.metrics import HTTP_REQUEST_LATENCY
+from src.referalbot.utils import correlation_id
+
+
+def _match_route_path(routes, scope) -> str | None:
+    """Template of the route `scope` matches, including the paths of the mounts it is nested in."""
+    partial = None
+    for route in routes:
+        match, child_scope = route.matches(scope)
+        if match == Match.NONE:
+            continue
+        if isinstance(route, Mount):
+            if not route.routes:
+                # Смонтированное приложение без маршрутов (статика): один шаблон на всё
+                return route.path
+            inner = _match_route_path(route.routes, {**scope, **child_scope})
+            return route.path + inner if inner else None
+        if match == Match.FULL:
+            return route.path
+        # Путь совпал, метод нет (405)
+        partial = partial or route.path
+    return partial
+
+
+def _route_path(scope, request_scope: dict) -> str:
+    """
+    Route template for metric labels. FastAPI routes leave themselves in the
+    scope; routes of mounted Starlette apps (the sqladmin /admin) do not, so
+    they are matched again against `request_scope`, a copy of the scope taken
+    before routing. Requests matching no route share the "unmatched" label.
+    """
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    app = request_scope.get("app")
+    return _match_route_path(getattr(app, "routes", ()), request_scope) or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording request latency per route template (e.g.
+    /purchases/{purchase_id}), measured until the response is fully sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+        request_scope = dict(scope)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUEST_LATENCY.observe(
+                time.perf_counter() - started, method=scope["method"], route=_route_path(scope, request_scope),
+                status=status,
+            )
+
+
+class QueryTrackerMiddleware:
+    """
+    ASGI middleware counting SQL statements per request, including ones run
+    while a streaming response is being sent, and warning about N+1 patterns.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_scope = dict(scope)
+        with track_queries(scope["path"]) as recorder:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                # Шаблон маршрута известен только после роутинга
+                recorder.name = f"{scope['method']} {_route_path(scope, request_scope)}"
+
+
+class CorrelationIdMiddleware:
+    """
+    ASGI middleware giving every request a correlation id for its log
+    records: the incoming X-Request-ID header, or a new random id. The id is
+    returned in the X-Request-ID response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex[:16]
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        token = correlation_id.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            correlation_id.reset(token)
@@ -1,15 +1,21 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse, Response
 from sqlalchemy import select, func
-from src.referalbot.database.models import User, Purchase, BonusHistory
-from src.referalbot.database.db import async_session
-from pydantic import BaseModel
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from aiogram import Bot
-from src.referalbot.config import TELEGRAM_TOKEN
+from sqlalchemy.orm import selectinload
+from src.referalbot.database.models import User, Purchase, BonusHistory, LEADERBOARD_PERIODS
+from src.referalbot.database.db import async_session, pool_stats
+from src.referalbot.database import repository
+from src.referalbot.database.cache import invalidate_balance, balance_cache, leaderboard_cache, promo_code_cache
+from src.referalbot.jobs.sheets import sheets_exporter
+from src.referalbot.metrics import REGISTRY, CONTENT_TYPE
+from src.referalbot.config import PURCHASE_BATCH_MAX_ROWS
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from datetime import datetime, timezone
+import csv
+import io
+import json
 
 router = APIRouter()
-bot = Bot(token=TELEGRAM_TOKEN) # Создаем экземпляр бота для отправки сообщений
 
 class PurchaseCreate(BaseModel):
     user_id: int
@@ -19,6 +25,22 @@ class PurchaseCreate(BaseModel):
 class PurchaseUpdate(BaseModel):
     bonus_paid: bool
 
+class PurchaseImportRow(BaseModel):
+    idempotency_key: str = Field(min_length=1, max_length=200)
+    user_id: int
+    amount: int = Field(gt=0)
+    discount_applied: int = 5
+    name: str | None = None
+    date: datetime | None = None
+
+    @field_validator("date")
+    @classmethod
+    def to_naive_utc(cls, value: datetime | None) -> datetime | None:
+        # В базе даты хранятся в UTC без часового пояса
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
 async def log_bonus_history(session, user_id, amount, operation, description):
     status = 'pending' if amount > 0 else 'available'
 
@@ -31,82 +53,91 @@ async def log_bonus_history(session, user_id, amount, operation, description):
     )
     session.add(history)
     await session.flush()
-
-def log_to_google_sheet(purchase, user):
-    try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        creds = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", scope)
-        client = gspread.authorize(creds)
-        sheet = client.open("ReferralBot").sheet1
-        invited_by_username = user.invited_by.username if user.invited_by else "-"
-        
-        records = sheet.get_all_records()
-        purchase_row = None
-        for idx, row in enumerate(records, start=2):
-            if row.get("Purchase ID") == purchase.id:
-                purchase_row = idx
-                break
-        
-        row_data = [
-            purchase.id,
-            purchase.user_id,
-            user.username,
-            user.promo_code,
-            invited_by_username,
-            purchase.date.isoformat(),
-            purchase.amount,
-            purchase.discount_applied,
-            purchase.bonus_amount,
-            # Статус "Ожидание" заменен на "Начислен"
-            "Выплачен" if purchase.bonus_paid else "Начислен", 
-        ]
-        
-        if purchase_row:
-            sheet.update(f"A{purchase_row}:J{purchase_row}", [row_data])
-        else:
-            sheet.append_row(row_data)
-    except FileNotFoundError:
-        print("Файл credentials.json не найден")
-    except Exception as e:
-        print(f"Ошибка записи в Google Sheets: {e}")
+    await repository.add_bonus_rollups(session, [(user_id, history.date, amount)])
+    invalidate_balance(session, user_id)
 
 @router.get("/users")
-async def list_users():
+async def list_users(after_id: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)):
+    """
+    Streams one page of users with their referral statistics as a JSON array.
+    Keyset pagination: pass the id of the last received user as `after_id`.
+    """
+    async def generate():
+        async with async_session() as session:
+            yield "["
+            first = True
+            async for row in repository.iter_user_summaries(session, after_id, limit):
+                yield ("" if first else ",") + json.dumps(row, default=str, ensure_ascii=False)
+                first = False
+            yield "]"
+
+    return StreamingResponse(generate(), media_type="application/json")
+
+@router.get("/users/{user_id}/downline")
+async def user_downline(user_id: int):
+    """Size, depth and per-level head count of the user's referral downline."""
+    async with async_session() as session:
+        if (await session.execute(select(User.id).filter_by(id=user_id))).scalar_one_or_none() is None:
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
+        return {"user_id": user_id, **await repository.get_downline_stats(session, user_id)}
+
+@router.get("/users/{user_id}/uplines")
+async def user_uplines(user_id: int):
+    """The chain of inviters above the user, nearest first."""
+    async with async_session() as session:
+        if (await session.execute(select(User.id).filter_by(id=user_id))).scalar_one_or_none() is None:
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
+        return {"user_id": user_id, "uplines": await repository.get_uplines(session, user_id)}
+
+@router.get("/leaderboard")
+async def referrer_leaderboard(
+    period: str = Query("week", pattern="^(" + "|".join(LEADERBOARD_PERIODS) + ")$"),
+    limit: int = Query(10, ge=1, le=100),
+):
+    """Users who earned the most bonuses over the period, from the daily rollups."""
+    async with async_session() as session:
+        leaders = await repository.get_referrer_leaderboard(session, LEADERBOARD_PERIODS[period], limit)
+    return {"period": period, "days": LEADERBOARD_PERIODS[period], "leaders": leaders}
+
+@router.get("/jobs")
+async def list_jobs():
+    """Watermark and duration of the last run of each background job."""
     async with async_session() as session:
-        users = await session.execute(select(User))
-        users = users.scalars().all()
-        result = []
-        for user in users:
-            referrals = await session.execute(select(User).filter_by(invited_by_id=user.id))
-            referrals = referrals.scalars().all()
-            purchases = await session.execute(select(Purchase).filter_by(user_id=user.id))
-            purchases = purchases.scalars().all()
-            referral_purchases = 0
-            total_bonus = 0
-            paid_bonus = 0
-            for referral in referrals:
-                ref_purchases = await session.execute(select(Purchase).filter_by(user_id=referral.id))
-                ref_purchases = ref_purchases.scalars().all()
-                for purchase in ref_purchases:
-                    referral_purchases += purchase.amount
-                    bonus = purchase.bonus_amount
-                    if purchase.bonus_paid:
-                        paid_bonus += bonus
-                    else:
-                        total_bonus += bonus
-            result.append({
-                "id": user.id,
-                "telegram_id": user.telegram_id,
-                "username": user.username,
-                "promo_code": user.promo_code,
-                "invited_by": (await session.execute(select(User).filter_by(id=user.invited_by_id))).scalar_one_or_none().username if user.invited_by_id else None,
-                "referral_count": len(referrals),
-                "referral_purchases": referral_purchases,
-                "total_bonus": total_bonus + paid_bonus,
-                "paid_bonus": paid_bonus,
-                "purchases": [{"id": p.id, "amount": p.amount, "discount_applied": p.discount_applied, "bonus_amount": p.bonus_amount, "date": p.date, "bonus_paid": p.bonus_paid} for p in purchases]
-            })
-        return result
+        states = await repository.get_job_states(session)
+        return [
+            {
+                "name": state.name,
+                "watermark": state.watermark,
+                "last_started_at": state.last_started_at,
+                "last_duration_ms": state.last_duration_ms,
+                "last_processed": state.last_processed,
+            }
+            for state in states
+        ]
+
+@router.get("/notifications/stats")
+async def notification_stats(request: Request):
+    """Throughput and backlog depth of the notification outbox dispatcher."""
+    return request.app.state.notification_dispatcher.stats()
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics of the API process."""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+@router.get("/db/pool")
+async def db_pool_stats():
+    """Checked-out connections, overflow and checkout times per engine role."""
+    return pool_stats()
+
+@router.get("/cache/stats")
+async def cache_stats():
+    """Size, hit, miss and eviction counters of this process's caches."""
+    return {
+        "balance": balance_cache.stats(),
+        "leaderboard": leaderboard_cache.stats(),
+        "promo_code": promo_code_cache.stats(),
+    }
 
 @router.post("/purchases")
 async def create_purchase(purchase: PurchaseCreate):
@@ -131,7 +162,8 @@ async def create_purchase(purchase: PurchaseCreate):
         await session.commit()
         await session.refresh(new_purchase)
 
-        #log_to_google_sheet(new_purchase, user)
+        inviter = await session.get(User, user.invited_by_id) if user.invited_by_id else None
+        sheets_exporter.enqueue(new_purchase, user, inviter.username if inviter else None)
 
         if user.invited_by_id and calculated_bonus_amount > 0:
             # Логируем начисление бонуса
@@ -143,27 +175,88 @@ async def create_purchase(purchase: PurchaseCreate):
                 f"За покупку от {user.username} (ID: {new_purchase.id})"
             )
 
-            # >> НОВОЕ: Отправляем уведомление о начислении бонуса <<
-            inviter_result = await session.execute(select(User).filter_by(id=user.invited_by_id))
-            inviter = inviter_result.scalar_one_or_none()
+            # Уведомление уходит через outbox в той же транзакции, что и бонус
             if inviter and inviter.telegram_id:
-                try:
-                    await bot.send_message(
-                        chat_id=inviter.telegram_id,
-                        text=f"🎉 Вам начислен бонус: +{calculated_bonus_amount:,} IDR за покупку вашего реферала {user.username}."
-                    )
-                except Exception as e:
-                    print(f"Не удалось отправить уведомление пользователю {inviter.telegram_id}: {e}")
+                repository.enqueue_notification(
+                    session,
+                    inviter.telegram_id,
+                    f"🎉 Вам начислен бонус: +{calculated_bonus_amount:,} IDR за покупку вашего реферала {user.username}."
+                )
             
             await session.commit()
 
 
         return {"message": "Покупка создана", "purchase_id": new_purchase.id, "bonus_amount": new_purchase.bonus_amount}
     
+def _parse_purchase_rows(body: bytes, content_type: str) -> list:
+    if "csv" in content_type:
+        reader = csv.DictReader(io.StringIO(body.decode("utf-8-sig")))
+        # Пустая ячейка CSV - то же, что отсутствующее поле
+        return [{key: value for key, value in row.items() if value not in ("", None)} for row in reader]
+    rows = json.loads(body)
+    if not isinstance(rows, list):
+        raise ValueError("Ожидается JSON-массив покупок")
+    return rows
+
+def _validation_error(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, e['loc'])) or 'row'}: {e['msg']}" for e in error.errors())
+
+@router.post("/purchases/batch")
+async def create_purchases_batch(request: Request):
+    """
+    Imports purchases from a JSON array or a CSV file (Content-Type: text/csv,
+    header row with PurchaseImportRow fields) in one transaction. Every row
+    needs an idempotency_key: re-sending a batch reports the rows imported
+    before as duplicates instead of creating them again. Returns a result per
+    row in input order.
+    """
+    try:
+        raw_rows = _parse_purchase_rows(await request.body(), request.headers.get("content-type", ""))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Не удалось разобрать тело запроса: {e}")
+    if len(raw_rows) > PURCHASE_BATCH_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"Не больше {PURCHASE_BATCH_MAX_ROWS} покупок за запрос")
+
+    report = [{"row": index} for index in range(len(raw_rows))]
+    rows = {}
+    for index, raw in enumerate(raw_rows):
+        try:
+            row = PurchaseImportRow.model_validate(raw)
+        except ValidationError as e:
+            report[index].update(status="invalid", error=_validation_error(e))
+            continue
+        report[index]["idempotency_key"] = row.idempotency_key
+        if row.idempotency_key in rows:
+            report[index].update(status="invalid", error="Ключ повторяется в запросе")
+            continue
+        rows[row.idempotency_key] = row.model_dump()
+
+    results, created = {}, []
+    if rows:
+        async with async_session() as session:
+            async with session.begin():
+                results, created = await repository.import_purchases(session, list(rows.values()))
+    for purchase, user in created:
+        sheets_exporter.enqueue(purchase, user, user.inviter_username)
+
+    for entry in report:
+        if "status" not in entry:
+            entry.update(results[entry["idempotency_key"]])
+    return {
+        "created": sum(entry["status"] == "created" for entry in report),
+        "duplicates": sum(entry["status"] == "duplicate" for entry in report),
+        "failed": sum(entry["status"] not in ("created", "duplicate") for entry in report),
+        "rows": report,
+    }
+
 @router.patch("/purchases/{purchase_id}")
 async def update_purchase(purchase_id: int, update: PurchaseUpdate):
     async with async_session() as session:
-        purchase = await session.execute(select(Purchase).filter_by(id=purchase_id))
+        purchase = await session.execute(
+            select(Purchase)
+            .options(selectinload(Purchase.user).selectinload(User.invited_by))
+            .filter_by(id=purchase_id)
+        )
         purchase = purchase.scalar_one_or_none()
         if not purchase:
             raise HTTPException(status_code=404, detail="Покупка не найдена")
@@ -182,8 +275,7 @@ async def update_purchase(purchase_id: int, update: PurchaseUpdate):
 
         purchase.bonus_paid = update.bonus_paid
         await session.commit()
-        await session.refresh(purchase)
-        user = await session.execute(select(User).filter_by(id=purchase.user_id))
-        user = user.scalar_one_or_none()
-        #log_to_google_sheet(purchase, user)
+        user = purchase.user
+        inviter = user.invited_by if user else None
+        sheets_exporter.enqueue(purchase, user, inviter.username if inviter else None)
         return {"message": "Покупка обновлена"}
\ No newline at end of file
@@ -0,0 +1,44 @@
+import hmac
+
+from aiogram.types import Update
+from fastapi import APIRouter, HTTPException, Request, Response
+
+from src.referalbot.bot.client import get_bot
+from src.referalbot.bot.dispatcher import get_dispatcher, update_queue
+from src.referalbot.config import WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET
+from src.referalbot.utils import logger
+
+router = APIRouter()
+
+
+@router.post(WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    """
+    Receives an update from Telegram, checks the secret token and acknowledges
+    once the update is queued; it is handled by the dispatcher's update
+    workers. While the queue is full the response waits, so Telegram slows
+    down deliveries.
+    """
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+
+    bot = get_bot()
+    update = Update.model_validate(await request.json(), context={"bot": bot})
+    await get_dispatcher().feed_update(bot, update)
+    return Response(status_code=200)
+
+
+async def setup_webhook() -> None:
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set when BOT_MODE=webhook")
+    await get_bot().set_webhook(
+        f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+    )
+    logger.info(f"Webhook установлен: {WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+
+async def drain_updates() -> None:
+    """Waits for updates that are still queued or being processed."""
+    await update_queue.close()
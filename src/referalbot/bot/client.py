@@ -0,0 +1,69 @@
+import asyncio
+import ssl
+
+import certifi
+from aiogram import Bot, __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+
+from src.referalbot.bot.middleware import TelegramMetricsMiddleware
+from src.referalbot.config import TELEGRAM_TOKEN, BOT_HTTP_POOL_SIZE, BOT_HTTP_KEEPALIVE
+
+_bot: Bot | None = None
+
+
+class KeepaliveAiohttpSession(AiohttpSession):
+    """
+    AiohttpSession whose connector also keeps idle connections for
+    `keepalive_timeout` seconds; aiogram passes only `limit` to TCPConnector.
+    The aiohttp session is created here instead of in AiohttpSession, so
+    proxies are not supported.
+    """
+
+    def __init__(self, limit: int, keepalive_timeout: float, **kwargs):
+        super().__init__(limit=limit, **kwargs)
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self._client: ClientSession | None = None
+
+    async def create_session(self) -> ClientSession:
+        if self._client is None or self._client.closed:
+            self._client = ClientSession(
+                connector=TCPConnector(
+                    ssl=ssl.create_default_context(cafile=certifi.where()),
+                    limit=self.limit,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=3600,
+                ),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram_version}"},
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None and not self._client.closed:
+            await self._client.close()
+            # Как в AiohttpSession: даём SSL-соединениям закрыться
+            await asyncio.sleep(0.25)
+
+
+def get_bot() -> Bot:
+    """
+    Returns the process-wide Bot client, creating it on first use. All
+    Telegram calls of the process share its aiohttp connection pool.
+    """
+    global _bot
+    if _bot is None:
+        session = KeepaliveAiohttpSession(limit=BOT_HTTP_POOL_SIZE, keepalive_timeout=BOT_HTTP_KEEPALIVE)
+        session.middleware(TelegramMetricsMiddleware())
+        _bot = Bot(token=TELEGRAM_TOKEN, session=session)
+    return _bot
+
+
+async def close_bot() -> None:
+    """Closes the HTTP session of the shared Bot client, if it was created."""
+    global _bot
+    if _bot is not None:
+        await _bot.session.close()
+        _bot = None
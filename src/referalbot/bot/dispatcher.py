@@ -0,0 +1,58 @@
+from aiogram import Dispatcher
+
+from src.referalbot.bot.handlers import router
+from src.referalbot.bot.middleware import (
+    DatabaseMiddleware, MetricsMiddleware, QueryTrackerMiddleware, UpdateQueueMiddleware
+)
+from src.referalbot.config import BOT_UPDATE_WORKERS, BOT_UPDATE_MAX_PENDING, DB_ROLE
+from src.referalbot.database.db import async_session, engine_profile
+from src.referalbot.metrics import CallbackCounter, Gauge
+
+# Общий для сообщений и callback-запросов, чтобы счётчики были едиными
+db_middleware = DatabaseMiddleware(async_session)
+metrics_middleware = MetricsMiddleware()
+query_tracker_middleware = QueryTrackerMiddleware()
+
+# Обработчикам нужна БД, поэтому больше воркеров, чем соединений в пуле, только добавят ожидание пула
+_db_pool = engine_profile(DB_ROLE)
+update_queue = UpdateQueueMiddleware(
+    BOT_UPDATE_WORKERS or _db_pool["pool_size"] + _db_pool["max_overflow"], BOT_UPDATE_MAX_PENDING
+)
+
+CallbackCounter(
+    "referalbot_bot_updates_total", "Handled updates, and how many of them used the database",
+    lambda: {"all": db_middleware.updates_total, "db": db_middleware.db_updates_total}, ("kind",)
+)
+
+Gauge(
+    "referalbot_bot_update_queue", "Updates waiting in chat queues, being handled, and chats with updates",
+    update_queue.stats, ("state",)
+)
+CallbackCounter(
+    "referalbot_bot_updates_dequeued_total", "Updates taken from the queue and handled",
+    lambda: {(): update_queue.handled_total}
+)
+
+_dispatcher: Dispatcher | None = None
+
+
+def get_dispatcher() -> Dispatcher:
+    """
+    Returns the process-wide Dispatcher with middlewares and handlers attached.
+    Used both by polling (bot/main.py) and by the webhook endpoint of the API.
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        dp = Dispatcher()
+        # Последним из outer-middleware: контекст чата уже определён, остальное выполняют воркеры
+        dp.update.outer_middleware(update_queue)
+        # Метрики первыми, чтобы время ожидания БД входило в latency обработчика
+        dp.message.middleware(metrics_middleware)
+        dp.callback_query.middleware(metrics_middleware)
+        dp.message.middleware(query_tracker_middleware)
+        dp.callback_query.middleware(query_tracker_middleware)
+        dp.message.middleware(db_middleware)
+        dp.callback_query.middleware(db_middleware)
+        dp.include_router(router)
+        _dispatcher = dp
+    return _dispatcher
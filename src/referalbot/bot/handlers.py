@@ -3,19 +3,18 @@ from aiogram.filters import Command, CommandStart
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from sqlalchemy.ext.asyncio import AsyncSession
 from src.referalbot.database import repository
+from src.referalbot.database.models import LEADERBOARD_PERIODS
 from src.referalbot.utils import logger
-from aiogram import Bot
-from src.referalbot.config import TELEGRAM_TOKEN
 import html  # Импортируем модуль для экранирования HTML
 
 router = Router()
-bot = Bot(token=TELEGRAM_TOKEN)
 
 def main_keyboard():
     keyboard = [
         [InlineKeyboardButton(text="Проверить бонусы", callback_data="check_bonuses")],
         [InlineKeyboardButton(text="История операций", callback_data="bonus_history")],
         [InlineKeyboardButton(text="Пригласить друга", callback_data="invite_friend")],
+        [InlineKeyboardButton(text="Топ рефереров", callback_data="leaderboard")],
         [InlineKeyboardButton(text="Помощь", callback_data="help_info")],
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -35,11 +34,12 @@ async def start_with_referral(message: types.Message, command, session: AsyncSes
         ref_code_clean = ref_code.replace("REF_", "")
         
         async with session.begin():
-            user = await repository.get_or_create_user(session, telegram_id, username)
-            inviter = await repository.get_user_by_promo_code(session, ref_code_clean)
+            inviter = await repository.resolve_promo_code(session, ref_code_clean)
+            # Пригласивший проставляется в том же запросе, что создаёт пользователя
+            inviter_id = inviter[0] if inviter and inviter[1] != telegram_id else None
+            user, invited = await repository.upsert_user(session, telegram_id, username, inviter_id)
             
-            if inviter and inviter.telegram_id != telegram_id and not user.invited_by_id:
-                user.invited_by_id = inviter.id
+            if invited:
                 await message.answer(
                     f"Добро пожаловать, {html.escape(username)}!\n"
                     f"Вы получили 5% скидку по коду {html.escape(ref_code)} на все услуги Bali Love Consulting 🎁\n\n"
@@ -91,7 +91,7 @@ async def start(message: types.Message, session: AsyncSession):
         logger.error(f"Ошибка в /start: {e}")
         await message.answer("Ошибка при обработке /start.")
 
-@router.callback_query(F.data == "help_info")
+@router.callback_query(F.data == "help_info", flags={"db": False})
 async def help_command_callback(callback: types.CallbackQuery):
     logger.info(f"Обработка help_info для пользователя {callback.from_user.id}")
     try:
@@ -192,6 +192,33 @@ async def bonus_history_callback(callback: types.CallbackQuery, session: AsyncSe
         await callback.message.answer("Ошибка при получении истории операций.")
         await callback.answer()
 
+@router.callback_query(F.data == "leaderboard")
+async def leaderboard_callback(callback: types.CallbackQuery, session: AsyncSession):
+    logger.info(f"Обработка leaderboard для пользователя {callback.from_user.id}")
+    try:
+        async with session.begin():
+            weekly = await repository.get_referrer_leaderboard(session, LEADERBOARD_PERIODS['week'])
+            monthly = await repository.get_referrer_leaderboard(session, LEADERBOARD_PERIODS['month'])
+
+        response_lines = []
+        for title, leaders in (("🏆 <b>Топ рефереров за неделю:</b>", weekly), ("🏆 <b>Топ рефереров за месяц:</b>", monthly)):
+            response_lines.append(title)
+            if not leaders:
+                response_lines.append("<i>Пока никто не получил бонусов</i>")
+            for place, leader in enumerate(leaders, start=1):
+                # Экранируем имя пользователя
+                username = html.escape(leader["username"] or "Неизвестный")
+                response_lines.append(f"{place}. {username} — <b>+{int(leader['earned']):,} IDR</b>")
+            response_lines.append("")
+
+        await callback.message.answer("\n".join(response_lines).strip(), parse_mode="HTML")
+        await callback.answer()
+
+    except Exception as e:
+        logger.error(f"Ошибка в leaderboard: {e}")
+        await callback.message.answer("Ошибка при получении рейтинга.")
+        await callback.answer()
+
 @router.callback_query(F.data == "invite_friend")
 async def invite_friend_callback(callback: types.CallbackQuery, session: AsyncSession):
     logger.info(f"Обработка invite_friend для пользователя {callback.from_user.id}")
@@ -1,18 +1,35 @@
-from aiogram import Bot, Dispatcher
-from src.referalbot.bot.handlers import router
-from src.referalbot.bot.middleware import DatabaseMiddleware
-from src.referalbot.config import TELEGRAM_TOKEN
-from src.referalbot.database.db import async_session, init_db
+from src.referalbot.bot.client import get_bot, close_bot
+from src.referalbot.bot.dispatcher import get_dispatcher, db_middleware, update_queue
+from src.referalbot.config import BOT_MODE, BOT_METRICS_PORT
+from src.referalbot.metrics import start_metrics_server
+from src.referalbot.database.db import init_db, engine
+from src.referalbot.database.cache import listen_balance_invalidations
+from src.referalbot.utils import logger
 import asyncio
 
 async def main():
+    if BOT_MODE == "webhook":
+        logger.info("BOT_MODE=webhook: обновления принимает API, polling не запускается")
+        return
     await init_db()
-    bot = Bot(token=TELEGRAM_TOKEN)
-    dp = Dispatcher()
-    dp.message.middleware(DatabaseMiddleware(async_session))
-    dp.callback_query.middleware(DatabaseMiddleware(async_session))
-    dp.include_router(router)
-    await dp.start_polling(bot)
+    bot = get_bot()
+    dp = get_dispatcher()
+    metrics_runner = await start_metrics_server("0.0.0.0", BOT_METRICS_PORT) if BOT_METRICS_PORT else None
+    # Балансы меняет процесс API: его коммиты сбрасывают кэш бота через LISTEN/NOTIFY
+    invalidation_listener = asyncio.create_task(listen_balance_invalidations(engine))
+    try:
+        # getUpdates не работает, пока установлен webhook
+        await bot.delete_webhook()
+        # Обновления по очереди отдаются в update_queue; когда она полна, getUpdates ждёт
+        await dp.start_polling(bot, handle_as_tasks=False, close_bot_session=False)
+    finally:
+        await update_queue.close()
+        invalidation_listener.cancel()
+        await asyncio.gather(invalidation_listener, return_exceptions=True)
+        logger.info(f"Обновлений с обращением к БД: {db_middleware.stats()}")
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await close_bot()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
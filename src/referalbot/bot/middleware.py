@@ -1,12 +1,182 @@
+import asyncio
+import contextvars
+import time
+from collections import deque
+
 from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
 from typing import Callable, Dict, Any, Awaitable
-from aiogram.types import TelegramObject
+from aiogram.types import TelegramObject, Update
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from src.referalbot.database.query_tracker import track_queries
+from src.referalbot.metrics import (
+    BOT_HANDLER_LATENCY, BOT_HANDLER_ERRORS, BOT_UPDATE_QUEUE_WAIT, TELEGRAM_REQUEST_LATENCY,
+    TELEGRAM_REQUEST_ERRORS
+)
+from src.referalbot.utils import logger, correlation_id
+
+
+class LazySession:
+    """
+    Stands in for an AsyncSession and creates the real one on first attribute
+    access, so handlers that never query the database do not take anything
+    from the session pool.
+    """
+
+    def __init__(self, session_pool: callable):
+        self._session_pool = session_pool
+        self._session: AsyncSession | None = None
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name: str) -> Any:
+        # Вызывается только для атрибутов, которых нет у самого LazySession
+        if self._session is None:
+            self._session = self._session_pool()
+        return getattr(self._session, name)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+class UpdateQueueMiddleware(BaseMiddleware):
+    """
+    Outer update middleware that puts the update into a queue and returns at
+    once; `workers` background tasks run the rest of the middleware chain and
+    the handler. Updates of one chat (or one user, for events without a chat)
+    go through a per-chat queue and are handled strictly in order, different
+    chats are handled concurrently. At most `max_pending` updates may be
+    queued or running: beyond that the caller waits, which slows down polling
+    or delays the webhook response instead of growing the queue.
+
+    Since the middleware returns before the handler runs, aiogram's
+    ErrorsMiddleware and `dp.errors` handlers never see handler exceptions
+    (the workers log them), and aiogram's "Update id=... is handled" log
+    line and duration describe only the enqueueing, not the handling.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        super().__init__()
+        self.workers = workers
+        self._slots = asyncio.Semaphore(max_pending)
+        # Чат присутствует здесь, пока он стоит в _ready или его обновление обрабатывается
+        self._chats: dict[Any, deque] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self.queued = 0
+        self.running = 0
+        self.handled_total = 0
+
+    def stats(self) -> dict:
+        return {"queued": self.queued, "running": self.running, "chats": len(self._chats)}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        context = data.get("event_context")
+        key = context and (context.chat_id or context.user_id) or ("update", event.update_id)
+        await self._slots.acquire()
+        if not self._tasks:
+            self.start()
+
+        updates = self._chats.get(key)
+        if updates is None:
+            updates = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        updates.append((handler, event, data, time.perf_counter()))
+        self.queued += 1
+
+    def start(self) -> None:
+        """
+        Starts the workers. Each gets an empty context: created from inside a
+        webhook request they would otherwise keep that request's query
+        recorder and correlation id forever.
+        """
+        self._tasks = [
+            asyncio.create_task(self._worker(), context=contextvars.Context()) for _ in range(self.workers)
+        ]
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            updates = self._chats[key]
+            handler, event, data, queued_at = updates.popleft()
+            self.queued -= 1
+            self.running += 1
+            BOT_UPDATE_QUEUE_WAIT.observe(time.perf_counter() - queued_at)
+            token = correlation_id.set(f"update-{event.update_id}")
+            try:
+                await handler(event, data)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {event.update_id}: {e}")
+            finally:
+                correlation_id.reset(token)
+                self.running -= 1
+                self.handled_total += 1
+                self._slots.release()
+                # Следующее обновление чата встаёт в конец, чтобы активный чат не занимал воркер
+                if updates:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+                self._ready.task_done()
+
+    async def close(self) -> None:
+        """Waits for queued updates to be handled and stops the workers."""
+        if not self._tasks:
+            return
+        await self._ready.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
 class DatabaseMiddleware(BaseMiddleware):
+    """
+    Injects a LazySession as `session`. Handlers registered with
+    flags={"db": False} get no session at all.
+    """
+
     def __init__(self, session_pool: callable):
         super().__init__()
         self.session_pool = session_pool
+        self.updates_total = 0
+        self.db_updates_total = 0
+
+    def stats(self) -> dict:
+        return {"updates_total": self.updates_total, "db_updates_total": self.db_updates_total}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        self.updates_total += 1
+        if not get_flag(data, "db", default=True):
+            return await handler(event, data)
+
+        session = LazySession(self.session_pool)
+        data["session"] = session
+        try:
+            return await handler(event, data)
+        finally:
+            if session.opened:
+                self.db_updates_total += 1
+            await session.close()
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Records latency and errors of every handler, labelled by handler name."""
 
     async def __call__(
         self,
@@ -14,6 +184,42 @@ class DatabaseMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any]
     ) -> Any:
-        async with self.session_pool() as session:
-            data["session"] = session
-            return await handler(event, data)
\ No newline at end of file
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            BOT_HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            BOT_HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+
+
+class QueryTrackerMiddleware(BaseMiddleware):
+    """Counts SQL statements per update and warns about N+1 patterns in handlers."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+        with track_queries(f"bot:{name}"):
+            return await handler(event, data)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Records latency and errors of Bot API calls, labelled by method."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_REQUEST_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_REQUEST_LATENCY.observe(time.perf_counter() - started, method=name)
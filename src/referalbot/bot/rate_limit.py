@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Async token bucket: allows `rate` acquisitions per second with bursts of
+    up to `capacity`. `pause()` blocks every caller for a given time, which is
+    how a Telegram RetryAfter (flood control) is honoured for the whole bot.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PerChatLimiter:
+    """
+    Enforces a minimal interval between two messages to the same chat.
+    Only chats messaged within the last interval are kept in memory.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_allowed: dict[int, float] = {}
+
+    async def acquire(self, chat_id: int) -> None:
+        now = time.monotonic()
+        if len(self._next_allowed) > 10_000:
+            self._next_allowed = {k: v for k, v in self._next_allowed.items() if v > now}
+        allowed_at = self._next_allowed.get(chat_id, now)
+        self._next_allowed[chat_id] = max(allowed_at, now) + self.interval
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
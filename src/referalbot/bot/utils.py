@@ -1,8 +1,22 @@
 import re
-import random
-import uuid
 
-def generate_promo_code(username: str) -> str:
-    ref_code =  re.sub(r"[^a-zA-Z0-9]", "", username) or str(uuid.uuid4())[:8]
-    print(ref_code)
-    return ref_code
\ No newline at end of file
+BASE36_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# Длина части из имени пользователя: ссылка t.me/...?start=REF_<код> ограничена 64 символами
+PROMO_PREFIX_LENGTH = 16
+
+def to_base36(number: int) -> str:
+    digits = ""
+    while True:
+        number, remainder = divmod(number, 36)
+        digits = BASE36_DIGITS[remainder] + digits
+        if not number:
+            return digits
+
+def generate_promo_code(username: str, number: int) -> str:
+    """
+    Readable promo code: the username's letters and digits plus a unique
+    number in base36 after a dash. Codes issued before this scheme have no
+    dash, so new codes never collide with them or with each other.
+    """
+    prefix = re.sub(r"[^a-zA-Z0-9]", "", username or "")[:PROMO_PREFIX_LENGTH] or "BALI"
+    return f"{prefix}-{to_base36(number)}"
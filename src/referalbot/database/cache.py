@@ -0,0 +1,161 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Hashable
+
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import Session
+
+from src.referalbot.config import (
+    BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL, LEADERBOARD_CACHE_TTL, PROMO_CODE_CACHE_SIZE, PROMO_CODE_CACHE_TTL
+)
+from src.referalbot.metrics import CallbackCounter
+from src.referalbot.utils import logger
+
+# Канал PostgreSQL, в который писатели сообщают id пользователей с изменившимся балансом
+BALANCE_INVALIDATION_CHANNEL = "balance_invalidated"
+# Полезная нагрузка NOTIFY ограничена 8000 байт
+NOTIFY_IDS_PER_MESSAGE = 500
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire. An entry lives at most `ttl`
+    seconds and never past its `valid_until` (for balances: the moment a
+    pending bonus matures or an earning leaves the weekly window).
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, valid_until: datetime | None = None) -> None:
+        ttl = self.ttl
+        if valid_until is not None:
+            ttl = min(ttl, (valid_until - datetime.utcnow()).total_seconds())
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Балансы по id пользователя; изменения из других процессов приходят через LISTEN/NOTIFY
+balance_cache = TTLCache(maxsize=BALANCE_CACHE_SIZE, ttl=BALANCE_CACHE_TTL)
+# Рейтинг по ключу (дней, лимит): записи живут LEADERBOARD_CACHE_TTL секунд
+leaderboard_cache = TTLCache(maxsize=64, ttl=LEADERBOARD_CACHE_TTL)
+# Промокод -> (id, telegram_id) пригласившего; правки кода видны после PROMO_CODE_CACHE_TTL
+promo_code_cache = TTLCache(maxsize=PROMO_CODE_CACHE_SIZE, ttl=PROMO_CODE_CACHE_TTL)
+
+CallbackCounter(
+    "referalbot_balance_cache_events_total", "Balance cache hits, misses and evictions",
+    lambda: {event: balance_cache.stats()[event] for event in ("hits", "misses", "evictions")}, ("event",)
+)
+CallbackCounter(
+    "referalbot_promo_code_cache_events_total", "Promo code cache hits, misses and evictions",
+    lambda: {event: promo_code_cache.stats()[event] for event in ("hits", "misses", "evictions")}, ("event",)
+)
+
+
+def invalidate_balance(session, user_id: int) -> None:
+    """
+    Drops the cached balance of a user whose bonus history is being written.
+    The entry is dropped right away and once more after the transaction
+    commits, so a read that raced with the write cannot keep a stale value.
+    Other processes learn about the write from a NOTIFY sent with the commit
+    (see listen_balance_invalidations).
+    """
+    balance_cache.invalidate(user_id)
+    session.info.setdefault("dirty_balances", set()).add(user_id)
+
+
+@event.listens_for(Session, "before_commit")
+def _notify_dirty_balances(session: Session) -> None:
+    user_ids = sorted(session.info.get("dirty_balances", ()))
+    if not user_ids or session.get_bind().dialect.name != "postgresql":
+        return
+    # NOTIFY доставляется только при фиксации транзакции
+    for offset in range(0, len(user_ids), NOTIFY_IDS_PER_MESSAGE):
+        payload = ",".join(map(str, user_ids[offset:offset + NOTIFY_IDS_PER_MESSAGE]))
+        session.execute(select(func.pg_notify(BALANCE_INVALIDATION_CHANNEL, payload)))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed_balances(session: Session) -> None:
+    for user_id in session.info.pop("dirty_balances", ()):
+        balance_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_balances(session: Session) -> None:
+    session.info.pop("dirty_balances", None)
+
+
+def _on_balance_notification(connection, pid, channel, payload: str) -> None:
+    for user_id in payload.split(","):
+        balance_cache.invalidate(int(user_id))
+
+
+async def listen_balance_invalidations(engine: AsyncEngine, retry_interval: float = 5) -> None:
+    """
+    Drops balances written by other processes (the API, jobs) from this
+    process's cache: LISTENs on a connection of `engine` kept for this task.
+    Notifications sent while the connection is down are lost, so the cache is
+    cleared on every (re)connect; in between the TTL bounds staleness. Runs
+    until cancelled.
+    """
+    while True:
+        try:
+            async with engine.connect() as conn:
+                driver = (await conn.get_raw_connection()).driver_connection
+                closed = asyncio.Event()
+                on_close = lambda _: closed.set()
+                driver.add_termination_listener(on_close)
+                await driver.add_listener(BALANCE_INVALIDATION_CHANNEL, _on_balance_notification)
+                balance_cache.clear()
+                try:
+                    await closed.wait()
+                finally:
+                    # Соединение возвращается в пул: снимаем подписку
+                    driver.remove_termination_listener(on_close)
+                    if not driver.is_closed():
+                        await driver.remove_listener(BALANCE_INVALIDATION_CHANNEL, _on_balance_notification)
+            logger.warning("Соединение для LISTEN инвалидаций баланса закрыто, переподключение")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка LISTEN инвалидаций баланса: {e}")
+        await asyncio.sleep(retry_interval)
@@ -1,13 +1,177 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+import os
+import time
+
+from sqlalchemy import exc, event, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
 from sqlalchemy.orm import sessionmaker
-from src.referalbot.config import DATABASE_URL
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from src.referalbot.config import DATABASE_URL, DB_ROLE, DB_ECHO
 from src.referalbot.database.models import Base
+from src.referalbot.database.query_tracker import record_query
+from src.referalbot.metrics import DB_QUERY_LATENCY, DB_POOL_CHECKOUT, Gauge
+from src.referalbot.utils import logger
+
+logger.debug(f"База данных: {make_url(DATABASE_URL).render_as_string(hide_password=True)}")
+
+# Профили пулов по ролям процессов. Любое значение можно переопределить
+# переменной окружения DB_<РОЛЬ>_<ПАРАМЕТР>, например DB_BOT_POOL_SIZE=20.
+ENGINE_PROFILES = {
+    "api": {
+        "pool_size": 10,
+        "max_overflow": 10,
+        "pool_timeout": 30,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "prepared_statement_cache_size": 500,
+    },
+    "bot": {
+        "pool_size": 10,
+        "max_overflow": 5,
+        "pool_timeout": 10,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "prepared_statement_cache_size": 500,
+    },
+    "jobs": {
+        "pool_size": 2,
+        "max_overflow": 0,
+        "pool_timeout": 60,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "prepared_statement_cache_size": 100,
+    },
+}
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    AsyncAdaptedQueuePool that records how long checkouts take: the wait for
+    a free connection, plus opening a new one and the pre-ping when they
+    happen.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_total = 0.0
+        self.checkout_max = 0.0
+        self.timeouts = 0
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.checkouts += 1
+            self.checkout_total += elapsed
+            self.checkout_max = max(self.checkout_max, elapsed)
+            # logging_name пула = роль движка, сохраняется при пересоздании пула
+            DB_POOL_CHECKOUT.observe(elapsed, role=getattr(self, "logging_name", None) or "")
+
+
+def engine_profile(role: str) -> dict:
+    profile = dict(ENGINE_PROFILES[role])
+    for key, default in profile.items():
+        value = os.getenv(f"DB_{role.upper()}_{key.upper()}")
+        if value is not None:
+            profile[key] = value.lower() == "true" if isinstance(default, bool) else type(default)(value)
+    return profile
+
+
+def create_engine_for_role(role: str) -> AsyncEngine:
+    profile = engine_profile(role)
+    connect_args = {}
+    prepared_statement_cache_size = profile.pop("prepared_statement_cache_size")
+    if "asyncpg" in DATABASE_URL:
+        # Кэш подготовленных запросов диалекта SQLAlchemy: statement_cache_size самого
+        # asyncpg не используется, диалект вызывает connection.prepare() сам
+        connect_args["prepared_statement_cache_size"] = prepared_statement_cache_size
+    role_engine = create_async_engine(
+        DATABASE_URL,
+        echo=DB_ECHO,
+        poolclass=TimedQueuePool,
+        pool_logging_name=role,
+        connect_args=connect_args,
+        **profile
+    )
+    _instrument(role_engine, role)
+    return role_engine
+
+
+def _instrument(role_engine: AsyncEngine, role: str) -> None:
+    """
+    Records the latency of every SQL statement executed by the engine and
+    reports it to the query tracker of the current request/update.
+    """
+    sync_engine = role_engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_started"].pop()
+        DB_QUERY_LATENCY.observe(duration, role=role)
+        record_query(statement, duration)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(context):
+        started = context.connection.info.get("query_started") if context.connection else None
+        if started:
+            DB_QUERY_LATENCY.observe(time.perf_counter() - started.pop(), role=role)
+
+
+_engines: dict[str, AsyncEngine] = {}
+_sessionmakers: dict[str, sessionmaker] = {}
+
+
+def get_engine(role: str = DB_ROLE) -> AsyncEngine:
+    if role not in _engines:
+        _engines[role] = create_engine_for_role(role)
+    return _engines[role]
+
+
+def get_sessionmaker(role: str = DB_ROLE) -> sessionmaker:
+    if role not in _sessionmakers:
+        _sessionmakers[role] = sessionmaker(get_engine(role), class_=AsyncSession, expire_on_commit=False)
+    return _sessionmakers[role]
+
+
+def pool_stats() -> dict:
+    """Live statistics of every engine pool created in this process."""
+    stats = {}
+    for role, role_engine in _engines.items():
+        pool = role_engine.pool
+        stats[role] = {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0),
+            "checkouts": pool.checkouts,
+            "checkout_avg_ms": round(pool.checkout_total / pool.checkouts * 1000, 2) if pool.checkouts else 0,
+            "checkout_max_ms": round(pool.checkout_max * 1000, 2),
+            "timeouts": pool.timeouts,
+        }
+    return stats
+
 
-print(DATABASE_URL)
+Gauge(
+    "referalbot_db_pool_checked_out", "Connections currently checked out of the pool",
+    lambda: {role: stats["checked_out"] for role, stats in pool_stats().items()}, ("role",)
+)
+Gauge(
+    "referalbot_db_pool_overflow", "Connections opened above pool_size",
+    lambda: {role: stats["overflow"] for role, stats in pool_stats().items()}, ("role",)
+)
 
-engine = create_async_engine(DATABASE_URL, echo=True)
-async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+engine = get_engine()
+async_session = get_sessionmaker()
 
 async def init_db():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
@@ -1,13 +1,30 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, BigInteger
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, DateTime, Boolean, BigInteger, Index, Sequence, UniqueConstraint
+from sqlalchemy.orm import relationship, declarative_base, query_expression
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.sql import func
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy import select, func
 
 Base = declarative_base(cls=AsyncAttrs)
 
+# Бонус становится доступным через 14 дней после начисления
+BONUS_MATURATION_PERIOD = timedelta(days=14)
+
+# Номера промокодов выдаются блоками: один nextval резервирует за процессом PROMO_CODE_BLOCK номеров
+PROMO_CODE_BLOCK = 100
+promo_code_seq = Sequence('promo_code_seq', start=1, increment=PROMO_CODE_BLOCK, metadata=Base.metadata)
+
+# Периоды рейтинга рефереров: сколько последних дней (UTC, включая сегодня) учитывается
+LEADERBOARD_PERIODS = {'week': 7, 'month': 30}
+
+def is_bonus_available(history: "BonusHistory", now: datetime | None = None) -> bool:
+    """Matches the SQL maturation rule: matured pending bonuses count as available."""
+    if history.status == 'available':
+        return True
+    now = now or datetime.utcnow()
+    return history.status == 'pending' and history.date is not None and history.date < now - BONUS_MATURATION_PERIOD
+
 class User(Base):
     __tablename__ = 'users'
     id = Column(BigInteger, primary_key=True)
@@ -22,6 +39,15 @@ class User(Base):
     purchases = relationship('Purchase', back_populates='user')
     bonus_history = relationship('BonusHistory', back_populates='user', lazy="selectin")
 
+    # Заполняются только запросами с with_expression (см. repository.user_balance_columns)
+    available_balance = query_expression()
+    pending_balance = query_expression()
+
+    __table_args__ = (
+        # Большинство пользователей пришли без приглашения, их в индекс не берём
+        Index('ix_users_invited_by_id', 'invited_by_id', postgresql_where=invited_by_id.is_not(None)),
+    )
+
     @hybrid_property
     def total_bonus(self):
         """Python-свойство для доступа к сумме бонусов"""
@@ -39,14 +65,17 @@ class User(Base):
     @property
     def available_bonus(self) -> int:
         """Synchronous property to calculate available bonus for admin panel."""
-        # Note: This does not trigger the 'update_pending_bonuses' logic.
-        # The admin panel view might have a slight delay in bonus maturation.
-        return sum(h.amount for h in self.bonus_history if h.status == 'available')
+        now = datetime.utcnow()
+        return sum(h.amount for h in self.bonus_history if is_bonus_available(h, now))
 
     @property
     def pending_bonus(self) -> int:
         """Synchronous property to calculate pending bonus for admin panel."""
-        return sum(h.amount for h in self.bonus_history if h.status == 'pending' and h.amount > 0)
+        now = datetime.utcnow()
+        return sum(
+            h.amount for h in self.bonus_history
+            if h.status == 'pending' and h.amount > 0 and not is_bonus_available(h, now)
+        )
 
     # Эта функция отвечает за красивое отображение в админке
     def __str__(self) -> str:
@@ -64,12 +93,58 @@ class Purchase(Base):
     bonus_amount = Column(BigInteger, nullable=False, default=0)
     date = Column(DateTime, default=datetime.utcnow)
     bonus_paid = Column(Boolean, default=False) # ЗАКОММЕНТИРОВАЛИ
+    # Ключ строки из внешней системы (POST /purchases/batch): повторный импорт не создаст дубль
+    idempotency_key = Column(String, nullable=True)
     
     user = relationship('User', back_populates='purchases')
 
+    __table_args__ = (
+        Index('ix_purchases_user_id', 'user_id'),
+        Index(
+            'ux_purchases_idempotency_key', 'idempotency_key',
+            unique=True, postgresql_where=idempotency_key.is_not(None)
+        ),
+    )
+
     def __str__(self) -> str:
         return f"Покупка #{self.id} ({self.name})"
 
+class BonusDailyRollup(Base):
+    """
+    Per-user totals of bonus_history for each UTC day: positive amounts in
+    `earned`, negative ones in `paid_out`. Updated by
+    repository.add_bonus_rollups in the transaction that writes the bonus
+    rows, rebuilt by tools/rebuild_bonus_rollups.py.
+    """
+    __tablename__ = 'bonus_daily_rollups'
+    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    earned = Column(BigInteger, default=0, nullable=False)
+    paid_out = Column(BigInteger, default=0, nullable=False)
+    operations = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        # Рейтинг за период читается только из индекса
+        Index('ix_bonus_daily_rollups_day', 'day', postgresql_include=['user_id', 'earned']),
+    )
+
+class ReferralClosure(Base):
+    """
+    Every (ancestor, descendant) pair of the referral tree with the distance
+    between them: depth 1 is a direct referral. Maintained by
+    repository.link_referral, rebuilt by tools/build_referral_closure.py.
+    """
+    __tablename__ = 'referral_closure'
+    ancestor_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    depth = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        # Размер и уровни даунлайна считаются только по индексу
+        Index('ix_referral_closure_ancestor_id_depth', 'ancestor_id', 'depth'),
+        Index('ix_referral_closure_descendant_id_depth', 'descendant_id', 'depth'),
+    )
+
 class BonusHistory(Base):
     __tablename__ = 'bonus_history'
     id = Column(BigInteger, primary_key=True)
@@ -82,5 +157,118 @@ class BonusHistory(Base):
     
     user = relationship('User', back_populates='bonus_history')
 
+    __table_args__ = (
+        # Используется фоновым переводом pending -> available
+        Index('ix_bonus_history_status_date', 'status', 'date'),
+        # История операций пользователя (сортировка по дате)
+        Index('ix_bonus_history_user_id_date', 'user_id', 'date'),
+        # Баланс пользователя по статусам
+        Index('ix_bonus_history_user_id_status_date', 'user_id', 'status', 'date'),
+    )
+
+    def __str__(self) -> str:
+        return f"Операция #{self.id} (user_id={self.user_id})"
+
+class JobState(Base):
+    """Watermark and timing of the last run of a background job."""
+    __tablename__ = 'job_state'
+    name = Column(String, primary_key=True)
+    watermark = Column(DateTime, nullable=True)
+    last_started_at = Column(DateTime, nullable=True)
+    last_duration_ms = Column(Integer, nullable=True)
+    last_processed = Column(BigInteger, nullable=False, default=0)
+
+    def __str__(self) -> str:
+        return f"{self.name} (watermark={self.watermark})"
+
+
+class NotificationOutbox(Base):
+    """Telegram message written in the same transaction as the change it reports."""
+    __tablename__ = 'notification_outbox'
+    id = Column(BigInteger, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(String, nullable=False)
+    status = Column(String, default='pending', nullable=False)  # pending / sent / failed
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index('ix_notification_outbox_due', 'next_attempt_at', postgresql_where=status == 'pending'),
+    )
+
+    def __str__(self) -> str:
+        return f"Уведомление #{self.id} (chat_id={self.chat_id}, {self.status})"
+
+
+# Кому может быть адресована рассылка
+BROADCAST_AUDIENCES = {
+    'all': 'Все пользователи',
+    'invited': 'Пришедшие по приглашению',
+    'referrers': 'Пригласившие друзей',
+    'buyers': 'Совершившие покупку',
+}
+
+
+class BroadcastCampaign(Base):
+    """Message to all or a filtered subset of users, sent by jobs/broadcast.py."""
+    __tablename__ = 'broadcast_campaigns'
+    id = Column(BigInteger, primary_key=True)
+    text = Column(String, nullable=False)
+    audience = Column(String, default='all', nullable=False)  # ключ BROADCAST_AUDIENCES
+    status = Column(String, default='draft', nullable=False)  # draft / running / paused / done / cancelled
+    # Чекпоинт: все пользователи с id <= last_user_id уже обработаны
+    last_user_id = Column(BigInteger, default=0, nullable=False)
+    total_recipients = Column(Integer, nullable=True)
+    delivered = Column(Integer, default=0, nullable=False)
+    blocked = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    def __str__(self) -> str:
+        return f"Рассылка #{self.id} ({self.status})"
+
+
+class BroadcastDelivery(Base):
+    """One recipient of a campaign; the unique key makes every message go out at most once."""
+    __tablename__ = 'broadcast_deliveries'
+    id = Column(BigInteger, primary_key=True)
+    campaign_id = Column(BigInteger, ForeignKey('broadcast_campaigns.id', ondelete='CASCADE'), nullable=False)
+    user_id = Column(BigInteger, nullable=False)
+    status = Column(String, default='sending', nullable=False)  # sending / delivered / blocked / failed
+    attempts = Column(Integer, default=0, nullable=False)
+    error = Column(String, nullable=True)
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('campaign_id', 'user_id', name='uq_broadcast_deliveries_campaign_user'),
+    )
+
+
+class BulkOperation(Base):
+    """
+    Progress of a background bulk payout or credit started from the admin
+    (jobs/bulk_bonus.py). Counters are updated in the transaction of each
+    batch, so they always match the committed bonus rows.
+    """
+    __tablename__ = 'bulk_operations'
+    id = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)  # payout / credit
+    amount = Column(BigInteger, nullable=True)  # сумма начисления на пользователя
+    status = Column(String, default='running', nullable=False)  # running / done / failed / cancelled
+    total = Column(Integer, nullable=False)
+    processed = Column(Integer, default=0, nullable=False)
+    affected = Column(Integer, default=0, nullable=False)
+    total_amount = Column(BigInteger, default=0, nullable=False)
+    error = Column(String, nullable=True)
+    started_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # Время последнего батча: у "running", который перестал обновляться, процесс был остановлен
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
     def __str__(self) -> str:
-        return f"Операция #{self.id} (user_id={self.user_id})"
\ No newline at end of file
+        return f"Массовая операция {self.kind} {self.id} ({self.status})"
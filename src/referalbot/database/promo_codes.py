@@ -0,0 +1,35 @@
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.referalbot.database.models import PROMO_CODE_BLOCK, promo_code_seq
+
+
+class PromoCodeAllocator:
+    """
+    Hands out unique promo code numbers. Each process reserves a block of
+    PROMO_CODE_BLOCK numbers with a single nextval of promo_code_seq (whose
+    increment is the block size) and issues them from memory, so creating a
+    user needs no uniqueness check or retry. Numbers of a block left unused
+    when the process stops or a transaction rolls back are simply skipped.
+    """
+
+    def __init__(self, block: int = PROMO_CODE_BLOCK):
+        self.block = block
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    async def allocate(self, session: AsyncSession) -> int:
+        async with self._lock:
+            if self._next >= self._end:
+                # nextval не откатывается вместе с транзакцией: блок остаётся за процессом
+                start = (await session.execute(select(promo_code_seq.next_value()))).scalar_one()
+                self._next, self._end = start, start + self.block
+            number = self._next
+            self._next += 1
+            return number
+
+
+promo_code_allocator = PromoCodeAllocator()
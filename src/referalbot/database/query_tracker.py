@@ -0,0 +1,78 @@
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from src.referalbot.config import QUERY_REPEAT_THRESHOLD
+from src.referalbot.utils import logger
+
+_current_recorder: ContextVar["QueryRecorder | None"] = ContextVar("query_recorder", default=None)
+
+_PARAM_RE = re.compile(r"\$\d+|%\(\w+\)s|\?")
+_PARAM_LIST_RE = re.compile(r"\((?:\s*\?(?:::[\w ]+)?\s*,)+\s*\?(?:::[\w ]+)?\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    """
+    Normalizes a SQL statement so that executions differing only in bound
+    parameters (including the length of expanded IN lists) share one shape.
+    """
+    shape = _PARAM_RE.sub("?", statement)
+    shape = _PARAM_LIST_RE.sub("(?)", shape)
+    return _SPACE_RE.sub(" ", shape).strip()
+
+
+class QueryRecorder:
+    """Statements executed within one unit of work (an HTTP request or a bot update)."""
+
+    def __init__(
+        self, name: str, repeat_threshold: int = QUERY_REPEAT_THRESHOLD, parent: "QueryRecorder | None" = None
+    ):
+        self.name = name
+        self.parent = parent
+        self.repeat_threshold = repeat_threshold
+        self.count = 0
+        self.total_time = 0.0
+        self.shapes: Counter[str] = Counter()
+
+    def record(self, statement: str, duration: float) -> None:
+        self.count += 1
+        self.total_time += duration
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold: int | None = None) -> dict[str, int]:
+        """Shapes executed at least `threshold` times - likely N+1 queries."""
+        threshold = threshold or self.repeat_threshold
+        return {shape: n for shape, n in self.shapes.most_common() if n >= threshold}
+
+    def report(self) -> str:
+        lines = [f"{self.name}: {self.count} queries, {self.total_time * 1000:.1f} ms"]
+        lines += [f"  {n}x {shape}" for shape, n in self.shapes.most_common()]
+        return "\n".join(lines)
+
+
+@contextmanager
+def track_queries(name: str, repeat_threshold: int = QUERY_REPEAT_THRESHOLD):
+    """
+    Records every statement executed in the current context into a
+    QueryRecorder and warns about repeated statement shapes on exit.
+    Nested trackers also report into the enclosing one.
+    """
+    recorder = QueryRecorder(name, repeat_threshold, parent=_current_recorder.get())
+    token = _current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current_recorder.reset(token)
+        for shape, n in recorder.repeated().items():
+            logger.warning(f"Возможный N+1 в {recorder.name}: запрос выполнен {n} раз: {shape[:300]}")
+
+
+def record_query(statement: str, duration: float) -> None:
+    """Called by the engine event hooks for every executed statement."""
+    recorder = _current_recorder.get()
+    while recorder is not None:
+        recorder.record(statement, duration)
+        recorder = recorder.parent
@@ -1,133 +1,968 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, and_, update
+from sqlalchemy import (
+    select, insert, delete, func, and_, or_, update, case, cast, true, exists, bindparam, tuple_, literal,
+    BigInteger, Integer, String, DateTime, JSON
+)
+from sqlalchemy.orm import aliased, lazyload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
 from datetime import datetime, timedelta
+from typing import AsyncIterator, Iterable
 
-from src.referalbot.database.models import User, BonusHistory
+from src.referalbot.database.models import (
+    User, BonusHistory, BonusDailyRollup, Purchase, JobState, NotificationOutbox, BroadcastCampaign,
+    BroadcastDelivery, ReferralClosure, BONUS_MATURATION_PERIOD
+)
+from src.referalbot.database.cache import balance_cache, leaderboard_cache, promo_code_cache, invalidate_balance
+from src.referalbot.database.promo_codes import promo_code_allocator
 from src.referalbot.bot.utils import generate_promo_code
 
+# Строк в одном upsert агрегатов: 5 параметров на строку при лимите asyncpg в 32767
+ROLLUP_UPSERT_CHUNK = 5000
 
-async def update_pending_bonuses(session: AsyncSession, user_id: int) -> None:
+
+def matured_bonuses_batch_query(cutoff: datetime, batch_size: int):
     """
-    Updates the status of pending bonuses older than 14 days to 'available'.
-    This function commits the changes within its own scope.
+    Selects ids of up to `batch_size` pending bonuses dated before `cutoff`,
+    skipping rows locked by a concurrent sweep.
     """
-    fourteen_days_ago = datetime.utcnow() - timedelta(days=14)
-    stmt = (
-        update(BonusHistory)
+    return (
+        select(BonusHistory.id)
         .where(
             and_(
-                BonusHistory.user_id == user_id,
                 BonusHistory.status == 'pending',
-                BonusHistory.date < fourteen_days_ago
+                BonusHistory.date < cutoff
             )
         )
+        .order_by(BonusHistory.date)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+
+async def mature_pending_bonuses(session: AsyncSession, cutoff: datetime, batch_size: int) -> int:
+    """
+    Marks up to `batch_size` pending bonuses dated before `cutoff` as 'available'.
+    Rows locked by a concurrent sweep are skipped. Returns the number of updated rows.
+    """
+    batch = matured_bonuses_batch_query(cutoff, batch_size)
+    result = await session.execute(
+        update(BonusHistory)
+        .where(BonusHistory.id.in_(batch.scalar_subquery()))
         .values(status='available')
         .execution_options(synchronize_session=False)
     )
-    await session.execute(stmt)
+    return result.rowcount
+
+def _sum_where(condition):
+    return func.coalesce(func.sum(case((condition, BonusHistory.amount), else_=0)), 0)
+
+def _balance_conditions(now: datetime):
+    """Conditions of available (including matured pending) and still pending bonuses."""
+    maturation_cutoff = now - BONUS_MATURATION_PERIOD
+    matured = and_(BonusHistory.status == 'pending', BonusHistory.date < maturation_cutoff)
+    still_pending = and_(
+        BonusHistory.status == 'pending',
+        or_(BonusHistory.date.is_(None), BonusHistory.date >= maturation_cutoff)
+    )
+    return or_(BonusHistory.status == 'available', matured), still_pending
 
-async def get_bonus_balance(session: AsyncSession, user_id: int) -> dict:
+def bonus_balance_query(user_id: int, now: datetime | None = None):
     """
-    Calculates available, pending, and statistical bonus balances for a user.
-    It internally updates the status of matured bonuses.
+    Builds the single query behind get_bonus_balance: balances are aggregated
+    over the user's bonus history, earnings statistics over their daily
+    rollups. The week is the last 7 UTC days including today.
     """
-    # First, update statuses of any matured bonuses
-    await update_pending_bonuses(session, user_id)
+    now = now or datetime.utcnow()
+    week_start = now.date() - timedelta(days=6)
+    available, still_pending = _balance_conditions(now)
+    rollups = BonusDailyRollup.user_id == user_id
+    weekly = and_(rollups, BonusDailyRollup.day >= week_start, BonusDailyRollup.earned > 0)
 
-    # 1. Calculate available balance
-    available_balance_result = await session.execute(
-        select(func.coalesce(func.sum(BonusHistory.amount), 0)).where(
-            and_(
-                BonusHistory.user_id == user_id,
-                BonusHistory.status == 'available'
-            )
-        )
+    return select(
+        _sum_where(available).label("available_balance"),
+        _sum_where(still_pending).label("pending_balance"),
+        select(func.coalesce(func.sum(BonusDailyRollup.earned), 0)).where(weekly)
+        .scalar_subquery().label("weekly_earnings"),
+        select(func.coalesce(func.sum(BonusDailyRollup.earned), 0)).where(rollups)
+        .scalar_subquery().label("total_earned"),
+        # Моменты, когда посчитанный баланс изменится сам по себе
+        func.min(case((still_pending, BonusHistory.date))).label("next_maturation_from"),
+        select(func.min(BonusDailyRollup.day)).where(weekly).scalar_subquery().label("weekly_window_from"),
+    ).where(BonusHistory.user_id == user_id)
+
+async def add_bonus_rollups(session: AsyncSession, operations: Iterable[tuple[int, datetime, int]]) -> None:
+    """
+    Adds freshly written bonus_history rows, given as (user_id, date, amount),
+    to the daily rollups with one upsert per ROLLUP_UPSERT_CHUNK (user, day)
+    pairs. Call it in the transaction that writes the rows.
+    """
+    totals = {}
+    for user_id, operation_date, amount in operations:
+        key = (user_id, operation_date.date())
+        earned, paid_out, count = totals.get(key, (0, 0, 0))
+        totals[key] = (earned + max(amount, 0), paid_out + max(-amount, 0), count + 1)
+    # Один порядок строк во всех транзакциях исключает взаимные блокировки
+    rows = [
+        {"user_id": user_id, "day": day, "earned": earned, "paid_out": paid_out, "operations": count}
+        for (user_id, day), (earned, paid_out, count) in sorted(totals.items())
+    ]
+    for offset in range(0, len(rows), ROLLUP_UPSERT_CHUNK):
+        stmt = pg_insert(BonusDailyRollup).values(rows[offset:offset + ROLLUP_UPSERT_CHUNK])
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[BonusDailyRollup.user_id, BonusDailyRollup.day],
+            set_={
+                "earned": BonusDailyRollup.earned + stmt.excluded.earned,
+                "paid_out": BonusDailyRollup.paid_out + stmt.excluded.paid_out,
+                "operations": BonusDailyRollup.operations + stmt.excluded.operations,
+            },
+        ))
+
+async def get_referrer_leaderboard(
+    session: AsyncSession, days: int, limit: int = 10, use_cache: bool = True
+) -> list[dict]:
+    """
+    Users who earned the most bonuses over the last `days` UTC days
+    (including today), read from the daily rollups. The result is shared by
+    all callers and cached for LEADERBOARD_CACHE_TTL seconds.
+    """
+    if use_cache:
+        cached = leaderboard_cache.get((days, limit))
+        if cached is not None:
+            return list(cached)
+
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    earned = func.sum(BonusDailyRollup.earned)
+    top = (
+        select(BonusDailyRollup.user_id, earned.label("earned"))
+        .where(BonusDailyRollup.day >= since)
+        .group_by(BonusDailyRollup.user_id)
+        .having(earned > 0)
+        .order_by(earned.desc(), BonusDailyRollup.user_id)
+        .limit(limit)
+        .subquery()
     )
-    available_balance = available_balance_result.scalar_one()
+    result = await session.execute(
+        select(User.id, User.telegram_id, User.username, top.c.earned)
+        .join(top, top.c.user_id == User.id)
+        .order_by(top.c.earned.desc(), User.id)
+    )
+    leaders = [dict(row) for row in result.mappings().all()]
+    leaderboard_cache.set((days, limit), leaders)
+    return list(leaders)
 
-    # 2. Calculate pending balance
-    pending_balance_result = await session.execute(
-        select(func.coalesce(func.sum(BonusHistory.amount), 0)).where(
-            and_(
-                BonusHistory.user_id == user_id,
-                BonusHistory.status == 'pending'
-            )
+def user_balance_columns(now: datetime | None = None):
+    """
+    Available and pending balances of the outer User row as correlated scalar
+    subqueries. In a paginated list they are evaluated only for the rows of
+    the page, each by an index scan over the user's bonus history.
+    """
+    available, still_pending = _balance_conditions(now or datetime.utcnow())
+    return tuple(
+        select(_sum_where(condition))
+        .where(BonusHistory.user_id == User.id)
+        .correlate(User)
+        .scalar_subquery()
+        .label(name)
+        for condition, name in ((available, "available_balance"), (still_pending, "pending_balance"))
+    )
+
+async def get_usernames(session: AsyncSession, user_ids: list[int], lock: bool = False) -> dict[int, str | None]:
+    """
+    Usernames of the existing users among `user_ids`. With lock=True the rows
+    are locked FOR UPDATE in id order, serializing concurrent bulk payouts.
+    """
+    query = select(User.id, User.username).where(User.id.in_(user_ids)).order_by(User.id)
+    if lock:
+        query = query.with_for_update()
+    result = await session.execute(query)
+    return dict(result.all())
+
+_BONUS_INSERT_COLUMNS = ["user_id", "amount", "operation", "description", "date", "status"]
+
+async def payout_available_balances(
+    session: AsyncSession, user_ids: list[int], operation: str, description: str, now: datetime | None = None
+) -> dict[int, int]:
+    """
+    Pays out the whole available balance of every user in `user_ids` with a
+    single INSERT ... SELECT of negative 'available' rows; users with nothing
+    available get no row. Lock the users first (get_usernames(lock=True)) so a
+    concurrent payout cannot read the same balance. Returns {user_id: paid amount}.
+    """
+    now = now or datetime.utcnow()
+    available, _ = _balance_conditions(now)
+    available_sum = _sum_where(available)
+    payouts = (
+        select(
+            BonusHistory.user_id,
+            -available_sum,
+            literal(operation, String),
+            literal(description, String),
+            literal(now, DateTime),
+            literal('available', String),
         )
+        .where(BonusHistory.user_id.in_(user_ids))
+        .group_by(BonusHistory.user_id)
+        .having(available_sum > 0)
+    )
+    result = await session.execute(
+        insert(BonusHistory)
+        .from_select(_BONUS_INSERT_COLUMNS, payouts)
+        .returning(BonusHistory.user_id, BonusHistory.amount)
     )
-    pending_balance = pending_balance_result.scalar_one()
+    paid = {user_id: -amount for user_id, amount in result.all()}
+    await add_bonus_rollups(session, ((user_id, now, -amount) for user_id, amount in paid.items()))
+    for user_id in paid:
+        invalidate_balance(session, user_id)
+    return paid
 
-    # 3. Calculate statistics
-    one_week_ago = datetime.utcnow() - timedelta(days=7)
-    weekly_earnings_result = await session.execute(
-        select(func.coalesce(func.sum(BonusHistory.amount), 0))
-        .filter(
-            and_(
-                BonusHistory.user_id == user_id,
-                BonusHistory.amount > 0,
-                BonusHistory.date >= one_week_ago
-            )
+async def credit_bonuses(
+    session: AsyncSession, user_ids: list[int], amount: int, operation: str, description: str,
+    now: datetime | None = None
+) -> list[int]:
+    """
+    Credits `amount` to every existing user in `user_ids` as pending bonuses
+    with one multi-row INSERT ... SELECT. Returns the ids that were credited.
+    """
+    now = now or datetime.utcnow()
+    credits = select(
+        User.id,
+        literal(amount, BigInteger),
+        literal(operation, String),
+        literal(description, String),
+        literal(now, DateTime),
+        literal('pending', String),
+    ).where(User.id.in_(user_ids))
+    result = await session.execute(
+        insert(BonusHistory)
+        .from_select(_BONUS_INSERT_COLUMNS, credits)
+        .returning(BonusHistory.user_id)
+    )
+    credited = result.scalars().all()
+    await add_bonus_rollups(session, ((user_id, now, amount) for user_id in credited))
+    for user_id in credited:
+        invalidate_balance(session, user_id)
+    return credited
+
+async def import_purchases(
+    session: AsyncSession, rows: list[dict], now: datetime | None = None
+) -> tuple[dict[str, dict], list[tuple]]:
+    """
+    Inserts a batch of purchases (dicts with idempotency_key, user_id, amount,
+    discount_applied, name, date; keys unique within the batch) with a fixed
+    number of statements: one query resolves buyers and inviters, purchases
+    and the inviters' bonus rows are bulk-inserted, and the notifications go
+    to the outbox. Rows whose key was imported before are not inserted again.
+
+    Returns {idempotency_key: result} and (purchase, buyer) rows of the
+    created purchases; the buyer row carries inviter_username.
+    """
+    now = now or datetime.utcnow()
+    inviter = aliased(User)
+    result = await session.execute(
+        select(
+            User.id, User.username, User.promo_code, User.invited_by_id,
+            inviter.username.label("inviter_username"), inviter.telegram_id.label("inviter_telegram_id"),
         )
+        .outerjoin(inviter, User.invited_by_id == inviter.id)
+        .where(User.id.in_({row["user_id"] for row in rows}))
     )
-    weekly_earnings = weekly_earnings_result.scalar_one()
+    users = {user.id: user for user in result.all()}
 
-    total_earned_result = await session.execute(
-        select(func.coalesce(func.sum(BonusHistory.amount), 0))
-        .filter(
-            and_(
-                BonusHistory.user_id == user_id,
-                BonusHistory.amount > 0
+    results = {}
+    values = []
+    for row in rows:
+        user = users.get(row["user_id"])
+        if user is None:
+            results[row["idempotency_key"]] = {"status": "user_not_found", "error": "Пользователь не найден"}
+            continue
+        values.append({
+            "idempotency_key": row["idempotency_key"],
+            "user_id": user.id,
+            "name": row.get("name"),
+            "amount": row["amount"],
+            "discount_applied": row.get("discount_applied", 5),
+            "bonus_amount": int(round(row["amount"] * 0.05)) if user.invited_by_id else 0,
+            "date": row.get("date") or now,
+            "bonus_paid": False,
+        })
+    if not values:
+        return results, []
+
+    inserted = (await session.execute(
+        pg_insert(Purchase)
+        .on_conflict_do_nothing(
+            index_elements=[Purchase.idempotency_key], index_where=Purchase.idempotency_key.is_not(None)
+        )
+        .returning(
+            Purchase.id, Purchase.user_id, Purchase.idempotency_key, Purchase.amount, Purchase.discount_applied,
+            Purchase.bonus_amount, Purchase.date, Purchase.bonus_paid,
+        ),
+        values
+    )).all()
+
+    created = []
+    bonuses = []
+    for purchase in inserted:
+        user = users[purchase.user_id]
+        results[purchase.idempotency_key] = {
+            "status": "created", "purchase_id": purchase.id, "bonus_amount": purchase.bonus_amount
+        }
+        created.append((purchase, user))
+        if not purchase.bonus_amount:
+            continue
+        bonuses.append({
+            "user_id": user.invited_by_id,
+            "amount": purchase.bonus_amount,
+            "operation": "Начисление",
+            "description": f"За покупку от {user.username} (ID: {purchase.id})",
+            "date": now,
+            "status": 'pending',
+        })
+        invalidate_balance(session, user.invited_by_id)
+        if user.inviter_telegram_id:
+            enqueue_notification(
+                session,
+                user.inviter_telegram_id,
+                f"🎉 Вам начислен бонус: +{purchase.bonus_amount:,} IDR за покупку вашего реферала {user.username}."
             )
+    if bonuses:
+        await session.execute(insert(BonusHistory), bonuses)
+        await add_bonus_rollups(session, ((bonus["user_id"], now, bonus["amount"]) for bonus in bonuses))
+
+    # Ключи, уже загруженные раньше: сообщаем id существующей покупки
+    skipped = [value["idempotency_key"] for value in values if value["idempotency_key"] not in results]
+    if skipped:
+        existing = await session.execute(
+            select(Purchase.idempotency_key, Purchase.id, Purchase.bonus_amount)
+            .where(Purchase.idempotency_key.in_(skipped))
         )
+        for key, purchase_id, bonus_amount in existing.all():
+            results[key] = {"status": "duplicate", "purchase_id": purchase_id, "bonus_amount": bonus_amount}
+    return results, created
+
+async def get_bonus_balance(session: AsyncSession, user_id: int, use_cache: bool = True) -> dict:
+    """
+    Calculates available, pending, and statistical bonus balances for a user
+    in a single read-only query. Pending bonuses older than 14 days are counted
+    as available even if their status has not been updated yet.
+    Results are cached per user until the next write to their bonus history
+    or until a pending bonus matures; pass use_cache=False to force a read.
+    """
+    if use_cache:
+        cached = balance_cache.get(user_id)
+        if cached is not None:
+            return dict(cached)
+
+    result = await session.execute(bonus_balance_query(user_id))
+    balance = dict(result.mappings().one())
+    next_maturation_from = balance.pop("next_maturation_from")
+    weekly_window_from = balance.pop("weekly_window_from")
+
+    changes_at = []
+    if next_maturation_from:
+        changes_at.append(next_maturation_from + BONUS_MATURATION_PERIOD)
+    if weekly_window_from:
+        # День выпадает из недельного окна в полночь (UTC) через 7 дней
+        changes_at.append(datetime.combine(weekly_window_from + timedelta(days=7), datetime.min.time()))
+    balance_cache.set(user_id, balance, min(changes_at, default=None))
+    return dict(balance)
+
+async def upsert_user(
+    session: AsyncSession, telegram_id: int, username: str, invited_by_id: int | None = None
+) -> tuple[User, bool]:
+    """
+    Fetches the user by Telegram ID or creates them. An existing user costs a
+    single SELECT and is not written to. A new user is inserted with INSERT
+    ... ON CONFLICT DO NOTHING, so a concurrent /start for the same Telegram
+    ID waits for the other insert and then reads its row instead of failing
+    on the unique constraint. A promo code number is taken only for inserts.
+
+    Returns the user and whether this call attached `invited_by_id`. It is
+    attached to a new user in the INSERT, or to an existing user without an
+    inviter by an UPDATE ... WHERE invited_by_id IS NULL. Only the call whose
+    statement actually wrote the inviter returns True, so concurrent calls
+    do not both report the invitation. The referral closure is updated in
+    that case, and an invitation from the user's own downline is undone. An
+    inviter that no longer exists (e.g. a stale promo code cache entry) is
+    ignored.
+    """
+    inviter = aliased(User)
+    existing_inviter = (
+        select(inviter.id).where(inviter.id == invited_by_id).scalar_subquery()
+        if invited_by_id is not None else None
     )
-    total_earned = total_earned_result.scalar_one()
+    user = await get_user_by_telegram_id(session, telegram_id)
+    created = False
+    if user is None:
+        result = await session.execute(
+            select(User)
+            .from_statement(
+                pg_insert(User)
+                .values(
+                    telegram_id=telegram_id,
+                    username=username,
+                    promo_code=generate_promo_code(username, await promo_code_allocator.allocate(session)),
+                    invited_by_id=existing_inviter,
+                )
+                .on_conflict_do_nothing(index_elements=[User.telegram_id])
+                .returning(User)
+            )
+            .options(lazyload(User.bonus_history))
+        )
+        user = result.scalar_one_or_none()
+        created = user is not None
+        if user is None:
+            # Пользователя только что создал параллельный запрос: читаем его строку
+            user = await get_user_by_telegram_id(session, telegram_id)
 
-    return {
-        "available_balance": available_balance,
-        "pending_balance": pending_balance,
-        "weekly_earnings": weekly_earnings,
-        "total_earned": total_earned,
-    }
+    if invited_by_id is None:
+        return user, False
+    if not created:
+        if user.invited_by_id is not None:
+            return user, False
+        # Условие в WHERE перепроверяется под блокировкой строки: из параллельных вызовов пишет один
+        attached = await session.scalar(
+            update(User)
+            .where(User.id == user.id, User.invited_by_id.is_(None))
+            .values(invited_by_id=existing_inviter)
+            .returning(User.invited_by_id)
+            .execution_options(synchronize_session=False)
+        )
+        if attached is None:
+            await session.refresh(user, ["invited_by_id"])
+            return user, False
+        set_committed_value(user, "invited_by_id", attached)
+    if user.invited_by_id != invited_by_id:
+        return user, False
+    if await link_referral(session, user.id, invited_by_id, new_user=created):
+        return user, True
+    # Пригласивший находится в даунлайне пользователя: приглашение не применяется
+    user.invited_by_id = None
+    await session.flush()
+    return user, False
 
 async def get_or_create_user(session: AsyncSession, telegram_id: int, username: str) -> User:
     """
     Retrieves a user by their Telegram ID or creates a new one if they don't exist.
     """
-    result = await session.execute(select(User).filter_by(telegram_id=telegram_id))
-    user = result.scalar_one_or_none()
-
-    if not user:
-        promo_code = generate_promo_code(username)
-        user = User(
-            telegram_id=telegram_id,
-            username=username,
-            promo_code=promo_code
-        )
-        session.add(user)
-        await session.flush()
+    user, _ = await upsert_user(session, telegram_id, username)
     return user
 
 async def get_user_by_telegram_id(session: AsyncSession, telegram_id: int) -> User | None:
     """
-    Retrieves a user by their Telegram ID.
+    Retrieves a user by their Telegram ID, without the bonus history.
     """
-    result = await session.execute(select(User).filter_by(telegram_id=telegram_id))
+    result = await session.execute(
+        select(User).options(lazyload(User.bonus_history)).filter_by(telegram_id=telegram_id)
+    )
     return result.scalar_one_or_none()
 
 async def get_user_by_promo_code(session: AsyncSession, promo_code: str) -> User | None:
     """
-    Retrieves a user by their promo code.
+    Retrieves a user by their promo code, without the bonus history.
     """
-    result = await session.execute(select(User).filter_by(promo_code=promo_code))
+    result = await session.execute(
+        select(User).options(lazyload(User.bonus_history)).filter_by(promo_code=promo_code)
+    )
     return result.scalar_one_or_none()
 
+async def resolve_promo_code(session: AsyncSession, promo_code: str) -> tuple[int, int | None] | None:
+    """
+    (id, telegram_id) of the promo code's owner, or None for an unknown code.
+    Known codes are served from an in-process LRU, so bursts of deep links
+    with the same code hit the database once. Admin edits are not propagated
+    to the cache: a changed or deleted code may resolve to its old owner for
+    up to PROMO_CODE_CACHE_TTL.
+    """
+    cached = promo_code_cache.get(promo_code)
+    if cached is not None:
+        return cached
+    result = await session.execute(select(User.id, User.telegram_id).filter_by(promo_code=promo_code))
+    owner = result.one_or_none()
+    if owner is None:
+        return None
+    owner = tuple(owner)
+    promo_code_cache.set(promo_code, owner)
+    return owner
+
 async def get_bonus_history(session: AsyncSession, user_id: int, limit: int = 15) -> list[BonusHistory]:
     """
     Retrieves the bonus history for a user.
     """
-    history_result = await session.execute(
+    history_result = await session.execute(bonus_history_query(user_id, limit))
+    return history_result.scalars().all()
+
+def bonus_history_query(user_id: int, limit: int = 15):
+    """
+    Builds the query for the latest bonus operations of a user.
+    """
+    return (
         select(BonusHistory)
         .filter_by(user_id=user_id)
         .order_by(BonusHistory.date.desc())
         .limit(limit)
     )
-    return history_result.scalars().all()
+
+async def get_bonus_history_page(
+    session: AsyncSession, user_id: int, limit: int, before_id: int | None = None
+) -> list[BonusHistory]:
+    """
+    Bonus operations of a user, newest first, keyset-paginated: pass the id of
+    the last operation of the previous page as `before_id`.
+    """
+    query = select(BonusHistory).filter_by(user_id=user_id)
+    if before_id is not None:
+        before_date = select(BonusHistory.date).where(BonusHistory.id == before_id).scalar_subquery()
+        query = query.where(tuple_(BonusHistory.date, BonusHistory.id) < tuple_(before_date, before_id))
+    result = await session.execute(
+        query.order_by(BonusHistory.date.desc(), BonusHistory.id.desc()).limit(limit)
+    )
+    return result.scalars().all()
+
+async def get_referrals_page(
+    session: AsyncSession, user_id: int, limit: int, before_id: int | None = None
+) -> list[User]:
+    """
+    Users invited by `user_id`, newest first, keyset-paginated by id.
+    Their bonus history is not loaded.
+    """
+    query = select(User).options(lazyload(User.bonus_history)).filter_by(invited_by_id=user_id)
+    if before_id is not None:
+        query = query.where(User.id < before_id)
+    result = await session.execute(query.order_by(User.id.desc()).limit(limit))
+    return result.scalars().all()
+
+async def count_user_relations(session: AsyncSession, user_id: int) -> dict:
+    """Number of referrals and bonus operations of a user, counted over indexes."""
+    referrals = select(func.count()).select_from(User).where(User.invited_by_id == user_id)
+    bonus_history = select(func.count()).select_from(BonusHistory).where(BonusHistory.user_id == user_id)
+    result = await session.execute(select(
+        referrals.scalar_subquery().label("referrals"),
+        bonus_history.scalar_subquery().label("bonus_history"),
+    ))
+    return dict(result.mappings().one())
+
+
+async def creates_referral_cycle(session: AsyncSession, user_id: int, inviter_id: int) -> bool:
+    """Whether `inviter_id` is the user or one of their descendants."""
+    if inviter_id == user_id:
+        return True
+    result = await session.execute(select(exists().where(
+        ReferralClosure.ancestor_id == user_id, ReferralClosure.descendant_id == inviter_id
+    )))
+    return result.scalar()
+
+async def link_referral(
+    session: AsyncSession, user_id: int, inviter_id: int | None, new_user: bool = False
+) -> bool:
+    """
+    Moves the user together with their whole downline under `inviter_id` in
+    the referral closure table (None detaches them). Call it in the
+    transaction that sets User.invited_by_id. Returns False without changes
+    if the inviter is the user or one of their descendants. A user created
+    in this transaction has neither, so new_user=True skips straight to the
+    insert.
+    """
+    if inviter_id is not None and not new_user and await creates_referral_cycle(session, user_id, inviter_id):
+        return False
+
+    subtree = (
+        select(ReferralClosure.descendant_id, ReferralClosure.depth)
+        .where(ReferralClosure.ancestor_id == user_id)
+        .union_all(select(literal(user_id, BigInteger), literal(0, Integer)))
+        .subquery()
+    )
+    # Пути от прежних предков в поддерево больше не верны
+    if not new_user:
+        await session.execute(
+            delete(ReferralClosure)
+            .where(
+                ReferralClosure.ancestor_id.in_(
+                    select(ReferralClosure.ancestor_id).where(ReferralClosure.descendant_id == user_id)
+                ),
+                ReferralClosure.descendant_id.in_(select(subtree.c.descendant_id)),
+            )
+            .execution_options(synchronize_session=False)
+        )
+    if inviter_id is None:
+        return True
+
+    ancestors = (
+        select(ReferralClosure.ancestor_id, ReferralClosure.depth)
+        .where(ReferralClosure.descendant_id == inviter_id)
+        .union_all(select(literal(inviter_id, BigInteger), literal(0, Integer)))
+        .subquery()
+    )
+    await session.execute(
+        insert(ReferralClosure).from_select(
+            ["ancestor_id", "descendant_id", "depth"],
+            select(ancestors.c.ancestor_id, subtree.c.descendant_id, ancestors.c.depth + subtree.c.depth + 1)
+            .join(subtree, true())
+        )
+    )
+    return True
+
+async def get_downline_stats(session: AsyncSession, user_id: int) -> dict:
+    """
+    Size, depth and per-level head count of the user's downline, read from
+    the closure table index (no recursive walk).
+    """
+    result = await session.execute(
+        select(ReferralClosure.depth, func.count())
+        .where(ReferralClosure.ancestor_id == user_id)
+        .group_by(ReferralClosure.depth)
+        .order_by(ReferralClosure.depth)
+    )
+    levels = [{"depth": depth, "count": count} for depth, count in result.all()]
+    return {
+        "size": sum(level["count"] for level in levels),
+        "depth": levels[-1]["depth"] if levels else 0,
+        "levels": levels,
+    }
+
+async def get_uplines(session: AsyncSession, user_id: int) -> list[dict]:
+    """The chain of inviters above the user, nearest first."""
+    result = await session.execute(
+        select(ReferralClosure.depth, User.id, User.telegram_id, User.username)
+        .join(User, User.id == ReferralClosure.ancestor_id)
+        .where(ReferralClosure.descendant_id == user_id)
+        .order_by(ReferralClosure.depth)
+    )
+    return [dict(row) for row in result.mappings().all()]
+
+
+def user_summaries_query(after_id: int, limit: int):
+    """
+    Builds a single query returning one page of users together with their
+    inviter, referral statistics and own purchases. The statistics are
+    correlated LATERAL aggregates, so they are computed only for the rows of
+    the requested page and the cost does not depend on the table size.
+    """
+    referral = aliased(User)
+    inviter = aliased(User)
+
+    referral_count = (
+        select(func.count(referral.id).label("referral_count"))
+        .where(referral.invited_by_id == User.id)
+        .lateral("referral_count")
+    )
+
+    referral_purchases = (
+        select(
+            cast(func.coalesce(func.sum(Purchase.amount), 0), BigInteger).label("referral_purchases"),
+            cast(func.coalesce(func.sum(Purchase.bonus_amount), 0), BigInteger).label("total_bonus"),
+            cast(func.coalesce(
+                func.sum(case((Purchase.bonus_paid.is_(True), Purchase.bonus_amount), else_=0)), 0
+            ), BigInteger).label("paid_bonus"),
+        )
+        .join(referral, Purchase.user_id == referral.id)
+        .where(referral.invited_by_id == User.id)
+        .lateral("referral_purchases")
+    )
+
+    own_purchases = (
+        select(
+            func.json_agg(
+                aggregate_order_by(func.json_build_object(
+                    "id", Purchase.id,
+                    "amount", Purchase.amount,
+                    "discount_applied", Purchase.discount_applied,
+                    "bonus_amount", Purchase.bonus_amount,
+                    "date", Purchase.date,
+                    "bonus_paid", Purchase.bonus_paid,
+                ), Purchase.id),
+                type_=JSON,
+            ).label("purchases")
+        )
+        .where(Purchase.user_id == User.id)
+        .lateral("own_purchases")
+    )
+
+    return (
+        select(
+            User.id,
+            User.telegram_id,
+            User.username,
+            User.promo_code,
+            inviter.username.label("invited_by"),
+            referral_count.c.referral_count,
+            referral_purchases.c.referral_purchases,
+            referral_purchases.c.total_bonus,
+            referral_purchases.c.paid_bonus,
+            own_purchases.c.purchases,
+        )
+        .outerjoin(inviter, User.invited_by_id == inviter.id)
+        .join(referral_count, true())
+        .join(referral_purchases, true())
+        .join(own_purchases, true())
+        .where(User.id > after_id)
+        .order_by(User.id)
+        .limit(limit)
+    )
+
+async def iter_user_summaries(session: AsyncSession, after_id: int = 0, limit: int = 100) -> AsyncIterator[dict]:
+    """
+    Streams user summaries (keyset pagination by user id) from a server-side cursor.
+    """
+    result = await session.stream(user_summaries_query(after_id, limit))
+    async for row in result.mappings():
+        summary = dict(row)
+        summary["purchases"] = summary["purchases"] or []
+        yield summary
+
+async def get_job_states(session: AsyncSession) -> list[JobState]:
+    """
+    Retrieves the watermark and last-run timing of every background job.
+    """
+    result = await session.execute(select(JobState).order_by(JobState.name))
+    return result.scalars().all()
+
+async def save_job_state(
+    session: AsyncSession,
+    name: str,
+    watermark: datetime,
+    started_at: datetime,
+    duration_ms: int,
+    processed: int
+) -> JobState:
+    """
+    Records the watermark and timing of a finished background job run.
+    """
+    state = await session.get(JobState, name)
+    if not state:
+        state = JobState(name=name)
+        session.add(state)
+    state.watermark = watermark
+    state.last_started_at = started_at
+    state.last_duration_ms = duration_ms
+    state.last_processed = processed
+    await session.flush()
+    return state
+
+def enqueue_notification(session: AsyncSession, chat_id: int, text: str) -> NotificationOutbox:
+    """
+    Adds a Telegram message to the outbox. It is delivered by the notification
+    dispatcher only after the surrounding transaction commits.
+    """
+    notification = NotificationOutbox(chat_id=chat_id, text=text)
+    session.add(notification)
+    return notification
+
+async def claim_notifications(session: AsyncSession, batch_size: int, lease: timedelta) -> list:
+    """
+    Claims up to `batch_size` due notifications by pushing their next attempt
+    `lease` into the future. If the dispatcher dies mid-send, the rows become
+    due again once the lease expires.
+    """
+    now = datetime.utcnow()
+    due = (
+        select(NotificationOutbox.id)
+        .where(
+            and_(
+                NotificationOutbox.status == 'pending',
+                NotificationOutbox.next_attempt_at <= now
+            )
+        )
+        .order_by(NotificationOutbox.next_attempt_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    result = await session.execute(
+        update(NotificationOutbox)
+        .where(NotificationOutbox.id.in_(due.scalar_subquery()))
+        .values(next_attempt_at=now + lease, attempts=NotificationOutbox.attempts + 1)
+        .returning(NotificationOutbox.id, NotificationOutbox.chat_id, NotificationOutbox.text, NotificationOutbox.attempts)
+        .execution_options(synchronize_session=False)
+    )
+    return result.all()
+
+async def record_notification_outcomes(session: AsyncSession, outcomes: list[tuple[int, str, float, str | None]]) -> None:
+    """
+    Stores the outcomes of one dispatched batch, given as (notification id,
+    'sent' | 'retry' | 'failed', retry delay in seconds, error), with a single
+    executemany UPDATE. Retried notifications stay pending until the delay
+    has passed.
+    """
+    if not outcomes:
+        return
+    outbox = NotificationOutbox.__table__
+    now = datetime.utcnow()
+    await session.execute(
+        update(outbox)
+        .where(outbox.c.id == bindparam('b_id'))
+        .values(
+            status=bindparam('b_status'),
+            sent_at=bindparam('b_sent_at'),
+            last_error=bindparam('b_error'),
+            next_attempt_at=func.coalesce(bindparam('b_next_attempt_at', type_=DateTime), outbox.c.next_attempt_at),
+        ),
+        [
+            {
+                "b_id": notification_id,
+                "b_status": 'pending' if outcome == 'retry' else outcome,
+                "b_sent_at": now if outcome == 'sent' else None,
+                "b_error": error,
+                "b_next_attempt_at": now + timedelta(seconds=delay) if outcome == 'retry' else None,
+            }
+            for notification_id, outcome, delay, error in outcomes
+        ]
+    )
+
+async def count_pending_notifications(session: AsyncSession) -> int:
+    result = await session.execute(
+        select(func.count(NotificationOutbox.id)).where(NotificationOutbox.status == 'pending')
+    )
+    return result.scalar_one()
+
+def _broadcast_audience_condition(audience: str):
+    if audience == 'invited':
+        return User.invited_by_id.is_not(None)
+    if audience == 'referrers':
+        referral = aliased(User)
+        return exists().where(referral.invited_by_id == User.id)
+    if audience == 'buyers':
+        return exists().where(Purchase.user_id == User.id)
+    return true()
+
+def broadcast_recipients_query(audience: str, after_id: int, limit: int):
+    """
+    Next page of campaign recipients after the checkpoint, in user id order.
+    """
+    return (
+        select(User.id, User.telegram_id)
+        .where(User.id > after_id, User.telegram_id.is_not(None), _broadcast_audience_condition(audience))
+        .order_by(User.id)
+        .limit(limit)
+    )
+
+async def iter_broadcast_recipients(
+    session: AsyncSession, audience: str, after_id: int, limit: int, yield_per: int
+) -> AsyncIterator[list[tuple[int, int]]]:
+    """
+    Streams one page of recipients from a server-side cursor in chunks of
+    `yield_per` (user id, chat id) pairs.
+    """
+    result = await session.stream(
+        broadcast_recipients_query(audience, after_id, limit).execution_options(yield_per=yield_per)
+    )
+    async for partition in result.partitions():
+        yield [(row.id, row.telegram_id) for row in partition]
+
+async def get_running_broadcast(session: AsyncSession) -> BroadcastCampaign | None:
+    result = await session.execute(
+        select(BroadcastCampaign)
+        .where(BroadcastCampaign.status == 'running')
+        .order_by(BroadcastCampaign.id)
+        .limit(1)
+    )
+    return result.scalar_one_or_none()
+
+async def prepare_broadcast(session: AsyncSession, campaign: BroadcastCampaign) -> int:
+    """
+    Makes a running campaign ready to (re)start. Deliveries claimed before a
+    crash were possibly sent, so they are closed as failed rather than sent
+    twice. Returns how many were closed.
+    """
+    result = await session.execute(
+        update(BroadcastDelivery)
+        .where(BroadcastDelivery.campaign_id == campaign.id, BroadcastDelivery.status == 'sending')
+        .values(status='failed', error='Прервано перезапуском, доставка не подтверждена')
+        .execution_options(synchronize_session=False)
+    )
+    interrupted = result.rowcount
+    campaign.failed += interrupted
+    if campaign.started_at is None:
+        campaign.started_at = datetime.utcnow()
+    if campaign.total_recipients is None:
+        campaign.total_recipients = (await session.execute(
+            select(func.count(User.id))
+            .where(User.telegram_id.is_not(None), _broadcast_audience_condition(campaign.audience))
+        )).scalar_one()
+    await session.flush()
+    return interrupted
+
+async def claim_broadcast_deliveries(session: AsyncSession, campaign_id: int, user_ids: list[int]) -> set[int]:
+    """
+    Inserts a 'sending' delivery per recipient in one statement. Recipients
+    who already have a delivery in this campaign are skipped, so a retried
+    batch never messages anyone twice. Returns the ids claimed now.
+    """
+    if not user_ids:
+        return set()
+    result = await session.execute(
+        pg_insert(BroadcastDelivery)
+        .values([
+            {"campaign_id": campaign_id, "user_id": user_id, "status": 'sending', "attempts": 0}
+            for user_id in user_ids
+        ])
+        .on_conflict_do_nothing(constraint='uq_broadcast_deliveries_campaign_user')
+        .returning(BroadcastDelivery.user_id)
+    )
+    return set(result.scalars().all())
+
+async def record_broadcast_batch(
+    session: AsyncSession, campaign_id: int, results: list[dict], last_user_id: int
+) -> str:
+    """
+    Stores the outcome of one batch ({user_id, status, attempts, error} per
+    recipient), adds it to the campaign counters and moves the checkpoint.
+    Returns the campaign status, which tells the sender whether to go on.
+    """
+    if results:
+        deliveries = BroadcastDelivery.__table__
+        now = datetime.utcnow()
+        await session.execute(
+            update(deliveries)
+            .where(deliveries.c.campaign_id == campaign_id, deliveries.c.user_id == bindparam('b_user_id'))
+            .values(
+                status=bindparam('b_status'), attempts=bindparam('b_attempts'),
+                error=bindparam('b_error'), sent_at=bindparam('b_sent_at')
+            ),
+            [
+                {
+                    "b_user_id": r["user_id"], "b_status": r["status"], "b_attempts": r["attempts"],
+                    "b_error": r["error"], "b_sent_at": now if r["status"] == 'delivered' else None,
+                }
+                for r in results
+            ]
+        )
+    counts = {status: sum(1 for r in results if r["status"] == status) for status in ('delivered', 'blocked', 'failed')}
+    result = await session.execute(
+        update(BroadcastCampaign)
+        .where(BroadcastCampaign.id == campaign_id)
+        .values(
+            delivered=BroadcastCampaign.delivered + counts['delivered'],
+            blocked=BroadcastCampaign.blocked + counts['blocked'],
+            failed=BroadcastCampaign.failed + counts['failed'],
+            last_user_id=func.greatest(BroadcastCampaign.last_user_id, last_user_id),
+        )
+        .returning(BroadcastCampaign.status)
+        .execution_options(synchronize_session=False)
+    )
+    return result.scalar_one()
+
+async def finish_broadcast(session: AsyncSession, campaign_id: int) -> None:
+    await session.execute(
+        update(BroadcastCampaign)
+        .where(BroadcastCampaign.id == campaign_id, BroadcastCampaign.status == 'running')
+        .values(status='done', finished_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+async def set_broadcast_status(
+    session: AsyncSession, campaign_ids: list[int], status: str, from_statuses: tuple[str, ...]
+) -> int:
+    """
+    Moves campaigns currently in one of `from_statuses` to `status`. Returns
+    how many changed.
+    """
+    values = {"status": status}
+    if status == 'cancelled':
+        values["finished_at"] = datetime.utcnow()
+    result = await session.execute(
+        update(BroadcastCampaign)
+        .where(BroadcastCampaign.id.in_(campaign_ids), BroadcastCampaign.status.in_(from_statuses))
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+from src.referalbot.bot.rate_limit import TokenBucket
+from src.referalbot.config import (
+    NOTIFY_GLOBAL_RATE, BROADCAST_BATCH_SIZE, BROADCAST_FETCH_SIZE,
+    BROADCAST_CONCURRENCY, BROADCAST_MAX_ATTEMPTS, BROADCAST_POLL_INTERVAL
+)
+from src.referalbot.database.db import get_sessionmaker
+from src.referalbot.database import repository
+from src.referalbot.database.models import BroadcastCampaign
+from src.referalbot.utils import logger
+from src.referalbot.metrics import CallbackCounter
+
+async_session = get_sessionmaker("jobs")
+
+_sender: "BroadcastSender | None" = None
+
+
+class BroadcastSender:
+    """
+    Runs broadcast campaigns one at a time. Recipients are read page by page
+    from a server-side cursor, keyset-ordered by user id after the campaign
+    checkpoint; each batch is claimed in broadcast_deliveries before sending
+    and its outcome and the new checkpoint are committed together, so after
+    a restart the campaign resumes where it stopped and nobody gets the
+    message twice. No transaction is held open while messages are sent.
+
+    Pass the notification dispatcher's limiter as `limiter` so that both
+    stay within one global Telegram rate limit. The limiter is per process:
+    N API workers send up to N times its rate between them.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        limiter: TokenBucket | None = None,
+        batch_size: int = BROADCAST_BATCH_SIZE,
+        fetch_size: int = BROADCAST_FETCH_SIZE,
+        concurrency: int = BROADCAST_CONCURRENCY,
+    ):
+        self.bot = bot
+        self.limiter = limiter or TokenBucket(NOTIFY_GLOBAL_RATE)
+        self.batch_size = batch_size
+        self.fetch_size = fetch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.outcomes = {"delivered": 0, "blocked": 0, "failed": 0}
+
+        # Метрика зарегистрирована один раз на модуль и читает последний созданный рассыльщик
+        global _sender
+        _sender = self
+
+    async def _send(self, chat_id: int, text: str) -> tuple[str, int, str | None]:
+        """Returns (outcome, attempts, error)."""
+        attempts = 0
+        async with self.semaphore:
+            while True:
+                attempts += 1
+                await self.limiter.acquire()
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text)
+                    return "delivered", attempts, None
+                except TelegramForbiddenError as e:
+                    # Пользователь заблокировал бота
+                    return "blocked", attempts, str(e)
+                except TelegramBadRequest as e:
+                    return "failed", attempts, str(e)
+                except TelegramRetryAfter as e:
+                    # Пауза распространяется на все отправки бота через общий лимитер
+                    self.limiter.pause(e.retry_after)
+                    error, delay = str(e), 0
+                except Exception as e:
+                    error, delay = str(e), min(2 ** attempts, 60)
+                if attempts >= BROADCAST_MAX_ATTEMPTS:
+                    return "failed", attempts, error
+                await asyncio.sleep(delay)
+
+    async def _send_batch(self, campaign, recipients: list[tuple[int, int]]) -> str:
+        """Claims, sends and records one batch. Returns the campaign status after it."""
+        async with async_session() as session:
+            async with session.begin():
+                claimed = await repository.claim_broadcast_deliveries(
+                    session, campaign.id, [user_id for user_id, _ in recipients]
+                )
+        last_user_id = recipients[-1][0]
+        recipients = [(user_id, chat_id) for user_id, chat_id in recipients if user_id in claimed]
+
+        outcomes = await asyncio.gather(*(self._send(chat_id, campaign.text) for _, chat_id in recipients))
+        results = []
+        for (user_id, _), (outcome, attempts, error) in zip(recipients, outcomes):
+            self.outcomes[outcome] += 1
+            results.append({"user_id": user_id, "status": outcome, "attempts": attempts, "error": error})
+
+        async with async_session() as session:
+            async with session.begin():
+                return await repository.record_broadcast_batch(session, campaign.id, results, last_user_id)
+
+    async def run_campaign(self, campaign_id: int) -> str:
+        """Sends a running campaign from its checkpoint. Returns its final status."""
+        started = time.perf_counter()
+        async with async_session() as session:
+            async with session.begin():
+                campaign = await session.get(BroadcastCampaign, campaign_id)
+                interrupted = await repository.prepare_broadcast(session, campaign)
+            session.expunge(campaign)
+        if interrupted:
+            logger.warning(f"Рассылка {campaign_id}: {interrupted} сообщений без подтверждения после перезапуска")
+        logger.info(f"Рассылка {campaign_id}: старт с пользователя {campaign.last_user_id}, получателей {campaign.total_recipients}")
+
+        status = "running"
+        checkpoint = campaign.last_user_id
+        while status == "running":
+            # Страница получателей читается целиком и курсор закрывается до начала отправки
+            async with async_session() as session:
+                page = [
+                    chunk async for chunk in repository.iter_broadcast_recipients(
+                        session, campaign.audience, checkpoint, self.fetch_size, self.batch_size
+                    )
+                ]
+            if not page:
+                async with async_session() as session:
+                    async with session.begin():
+                        await repository.finish_broadcast(session, campaign_id)
+                status = "done"
+                break
+            for recipients in page:
+                status = await self._send_batch(campaign, recipients)
+                checkpoint = recipients[-1][0]
+                if status != "running":
+                    break
+
+        logger.info(f"Рассылка {campaign_id}: {status} за {time.perf_counter() - started:.1f} с")
+        return status
+
+    async def run(self, poll_interval: float = BROADCAST_POLL_INTERVAL) -> None:
+        """
+        Picks up running campaigns (including ones interrupted by a restart) until cancelled.
+        """
+        while True:
+            try:
+                async with async_session() as session:
+                    campaign = await repository.get_running_broadcast(session)
+                if campaign:
+                    await self.run_campaign(campaign.id)
+                    continue
+            except Exception as e:
+                logger.error(f"Ошибка рассылки: {e}")
+            await asyncio.sleep(poll_interval)
+
+
+CallbackCounter(
+    "referalbot_broadcast_messages_total", "Broadcast message outcomes",
+    lambda: dict(_sender.outcomes) if _sender else {}, ("outcome",)
+)
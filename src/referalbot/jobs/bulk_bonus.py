@@ -0,0 +1,168 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import update
+
+from src.referalbot.config import ADMIN_BULK_BATCH_SIZE
+from src.referalbot.database.db import get_sessionmaker
+from src.referalbot.database import repository
+from src.referalbot.database.models import BulkOperation
+from src.referalbot.utils import logger
+
+async_session = get_sessionmaker("jobs")
+
+PAYOUT = "payout"
+CREDIT = "credit"
+
+PAYOUT_OPERATION = ("Выплата (Админ)", "Выплата всего доступного баланса")
+CREDIT_OPERATION = ("Начисление (Админ)", "Начисление через админ-панель")
+
+
+async def payout_batch(session, user_ids: list[int]) -> tuple[dict[int, str | None], dict[int, int]]:
+    """
+    Pays out the available balance of one batch of users in two statements.
+    Returns their usernames and {user_id: paid amount}.
+    """
+    usernames = await repository.get_usernames(session, user_ids, lock=True)
+    paid = await repository.payout_available_balances(session, list(usernames), *PAYOUT_OPERATION)
+    return usernames, paid
+
+
+async def credit_batch(session, user_ids: list[int], amount: int) -> tuple[dict[int, str | None], list[int]]:
+    """Credits `amount` to one batch of users in two statements."""
+    usernames = await repository.get_usernames(session, user_ids)
+    credited = await repository.credit_bonuses(session, list(usernames), amount, *CREDIT_OPERATION)
+    return usernames, credited
+
+
+class BulkBonusOperation:
+    """
+    Payout or credit over a large selection, committed batch by batch in the
+    background. Progress lives in its bulk_operations row rather than in the
+    process, so the progress page works from any API worker and after a
+    restart; an operation whose process stopped stays "running" with an
+    updated_at that no longer advances.
+    """
+
+    def __init__(self, operation_id: str, kind: str, user_ids: list[int], amount: int | None = None):
+        self.id = operation_id
+        self.kind = kind
+        self.user_ids = user_ids
+        self.amount = amount
+
+    @property
+    def total(self) -> int:
+        return len(self.user_ids)
+
+    async def run(self, batch_size: int = ADMIN_BULK_BATCH_SIZE) -> None:
+        started = time.perf_counter()
+        status, error = "done", None
+        processed = affected = total_amount = 0
+        try:
+            for offset in range(0, self.total, batch_size):
+                batch = self.user_ids[offset:offset + batch_size]
+                # Каждый батч - отдельная транзакция: блокировки держатся недолго, прогресс виден сразу
+                async with async_session() as session:
+                    async with session.begin():
+                        if self.kind == PAYOUT:
+                            _, paid = await payout_batch(session, batch)
+                            batch_affected, batch_amount = len(paid), sum(paid.values())
+                        else:
+                            _, credited = await credit_batch(session, batch, self.amount)
+                            batch_affected, batch_amount = len(credited), len(credited) * self.amount
+                        # Прогресс фиксируется вместе с бонусами батча
+                        await session.execute(
+                            update(BulkOperation)
+                            .where(BulkOperation.id == self.id)
+                            .values(
+                                processed=BulkOperation.processed + len(batch),
+                                affected=BulkOperation.affected + batch_affected,
+                                total_amount=BulkOperation.total_amount + batch_amount,
+                                updated_at=datetime.utcnow(),
+                            )
+                        )
+                processed += len(batch)
+                affected += batch_affected
+                total_amount += batch_amount
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        except Exception as e:
+            status, error = "failed", str(e)
+            logger.error(f"Ошибка массовой операции {self.kind} {self.id}: {e}")
+        finally:
+            await self._finish(status, error)
+            logger.info(
+                f"Массовая операция {self.kind} {self.id}: {status}, {processed}/{self.total} "
+                f"пользователей, затронуто {affected}, сумма {total_amount:,} IDR "
+                f"за {time.perf_counter() - started:.1f} с"
+            )
+
+    async def _finish(self, status: str, error: str | None) -> None:
+        now = datetime.utcnow()
+        try:
+            async with async_session() as session:
+                async with session.begin():
+                    await session.execute(
+                        update(BulkOperation)
+                        .where(BulkOperation.id == self.id)
+                        .values(status=status, error=error, updated_at=now, finished_at=now)
+                    )
+        except Exception as e:
+            logger.error(f"Не удалось сохранить статус массовой операции {self.id}: {e}")
+
+
+def operation_progress(operation: BulkOperation) -> dict:
+    return {
+        "id": operation.id,
+        "kind": operation.kind,
+        "status": operation.status,
+        "total": operation.total,
+        "processed": operation.processed,
+        "percent": round(operation.processed / operation.total * 100) if operation.total else 100,
+        "affected": operation.affected,
+        "total_amount": operation.total_amount,
+        "error": operation.error,
+        "started_at": operation.started_at,
+        "updated_at": operation.updated_at,
+        "finished_at": operation.finished_at,
+    }
+
+
+# Задачи операций, запущенных этим процессом: отменяются при остановке
+_tasks: set[asyncio.Task] = set()
+
+
+async def start_bulk_operation(
+    kind: str, user_ids: list[int], amount: int | None = None, batch_size: int = ADMIN_BULK_BATCH_SIZE
+) -> str:
+    """
+    Records the operation and starts it as a background task of the current
+    process. Returns the operation id.
+    """
+    user_ids = sorted(set(user_ids))
+    operation_id = uuid.uuid4().hex
+    async with async_session() as session:
+        async with session.begin():
+            session.add(BulkOperation(id=operation_id, kind=kind, amount=amount, total=len(user_ids)))
+    task = asyncio.create_task(BulkBonusOperation(operation_id, kind, user_ids, amount).run(batch_size))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return operation_id
+
+
+async def get_bulk_operation(operation_id: str) -> dict | None:
+    """Progress of the operation, whichever process runs it."""
+    async with async_session() as session:
+        operation = await session.get(BulkOperation, operation_id)
+    return operation_progress(operation) if operation else None
+
+
+async def cancel_bulk_operations() -> None:
+    """Cancels operations still running in this process, e.g. on shutdown. Committed batches stay committed."""
+    tasks = [task for task in _tasks if not task.done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,60 @@
+import asyncio
+import time
+from datetime import datetime
+
+from src.referalbot.config import MATURATION_SWEEP_INTERVAL, MATURATION_BATCH_SIZE
+from src.referalbot.database.db import get_sessionmaker
+from src.referalbot.database.models import BONUS_MATURATION_PERIOD
+from src.referalbot.database import repository
+from src.referalbot.utils import logger
+
+async_session = get_sessionmaker("jobs")
+
+JOB_NAME = "bonus_maturation"
+
+
+async def sweep_matured_bonuses(batch_size: int = MATURATION_BATCH_SIZE) -> int:
+    """
+    Flips every pending bonus older than the maturation period to 'available'.
+    Each batch is committed in its own short transaction, so row locks are held
+    only for `batch_size` rows at a time. The cutoff of the completed sweep is
+    stored as the job watermark together with the sweep duration.
+    """
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    cutoff = started_at - BONUS_MATURATION_PERIOD
+    processed = 0
+
+    while True:
+        async with async_session() as session:
+            async with session.begin():
+                updated = await repository.mature_pending_bonuses(session, cutoff, batch_size)
+        processed += updated
+        if updated < batch_size:
+            break
+
+    duration_ms = int((time.perf_counter() - started) * 1000)
+    async with async_session() as session:
+        async with session.begin():
+            await repository.save_job_state(
+                session, JOB_NAME,
+                watermark=cutoff,
+                started_at=started_at,
+                duration_ms=duration_ms,
+                processed=processed
+            )
+
+    logger.info(f"Перевод бонусов: {processed} записей стали доступными за {duration_ms} мс (watermark {cutoff.isoformat()})")
+    return processed
+
+
+async def run_maturation_sweeper(interval: int = MATURATION_SWEEP_INTERVAL) -> None:
+    """
+    Runs the maturation sweep every `interval` seconds until cancelled.
+    """
+    while True:
+        try:
+            await sweep_matured_bonuses()
+        except Exception as e:
+            logger.error(f"Ошибка при переводе бонусов в доступные: {e}")
+        await asyncio.sleep(interval)
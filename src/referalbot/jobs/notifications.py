@@ -0,0 +1,152 @@
+import asyncio
+import time
+from collections import deque
+from datetime import timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+from src.referalbot.bot.rate_limit import TokenBucket, PerChatLimiter
+from src.referalbot.config import (
+    NOTIFY_GLOBAL_RATE, NOTIFY_PER_CHAT_INTERVAL, NOTIFY_BATCH_SIZE,
+    NOTIFY_CONCURRENCY, NOTIFY_MAX_ATTEMPTS, NOTIFY_POLL_INTERVAL
+)
+from src.referalbot.database.db import get_sessionmaker
+from src.referalbot.database import repository
+from src.referalbot.utils import logger
+from src.referalbot.metrics import Gauge, CallbackCounter
+
+async_session = get_sessionmaker("jobs")
+
+THROUGHPUT_WINDOW = 60  # секунд
+
+_dispatcher: "NotificationDispatcher | None" = None
+
+
+class NotificationDispatcher:
+    """
+    Drains the notification outbox. Messages are sent outside of any DB
+    transaction, within Telegram's global and per-chat limits; RetryAfter
+    pauses all sends and reschedules the message, other errors are retried
+    with exponential backoff until NOTIFY_MAX_ATTEMPTS. The outcomes of a
+    batch are stored with one UPDATE.
+
+    The limiters live in this process: with N API workers running a
+    dispatcher each, the bot sends up to N * NOTIFY_GLOBAL_RATE messages per
+    second, so lower the rate accordingly.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        global_rate: float = NOTIFY_GLOBAL_RATE,
+        per_chat_interval: float = NOTIFY_PER_CHAT_INTERVAL,
+        batch_size: int = NOTIFY_BATCH_SIZE,
+        concurrency: int = NOTIFY_CONCURRENCY,
+    ):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.global_limiter = TokenBucket(global_rate)
+        self.chat_limiter = PerChatLimiter(per_chat_interval)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # Пока сообщение отправляется, его никто другой не заберёт
+        self.lease = timedelta(minutes=5)
+
+        self.sent_total = 0
+        self.retried_total = 0
+        self.failed_total = 0
+        self.backlog = 0
+        self._sent_at: deque[float] = deque()
+
+        # Метрики зарегистрированы один раз на модуль и читают последний созданный диспетчер
+        global _dispatcher
+        _dispatcher = self
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        while self._sent_at and self._sent_at[0] < now - THROUGHPUT_WINDOW:
+            self._sent_at.popleft()
+        return {
+            "sent_total": self.sent_total,
+            "retried_total": self.retried_total,
+            "failed_total": self.failed_total,
+            "backlog": self.backlog,
+            "throughput_per_second": round(len(self._sent_at) / THROUGHPUT_WINDOW, 2),
+        }
+
+    async def _send(self, notification) -> tuple[str, float, str | None]:
+        """Returns (outcome, retry delay in seconds, error)."""
+        async with self.semaphore:
+            await self.chat_limiter.acquire(notification.chat_id)
+            await self.global_limiter.acquire()
+            try:
+                await self.bot.send_message(chat_id=notification.chat_id, text=notification.text)
+                self._sent_at.append(time.monotonic())
+                return "sent", 0, None
+            except TelegramRetryAfter as e:
+                self.global_limiter.pause(e.retry_after)
+                return "retry", e.retry_after, str(e)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Бот заблокирован или чат не существует - повтор не поможет
+                return "failed", 0, str(e)
+            except Exception as e:
+                if notification.attempts >= NOTIFY_MAX_ATTEMPTS:
+                    return "failed", 0, str(e)
+                return "retry", min(2 ** notification.attempts, 3600), str(e)
+
+    async def dispatch_batch(self) -> int:
+        """
+        Claims and sends one batch of due notifications. Returns the batch size.
+        """
+        async with async_session() as session:
+            async with session.begin():
+                batch = await repository.claim_notifications(session, self.batch_size, self.lease)
+        if not batch:
+            return 0
+
+        outcomes = await asyncio.gather(*(self._send(n) for n in batch))
+
+        for notification, (outcome, delay, error) in zip(batch, outcomes):
+            if outcome == "sent":
+                self.sent_total += 1
+            elif outcome == "retry":
+                self.retried_total += 1
+            else:
+                self.failed_total += 1
+                logger.error(f"Не удалось отправить уведомление {notification.id} пользователю {notification.chat_id}: {error}")
+
+        async with async_session() as session:
+            async with session.begin():
+                await repository.record_notification_outcomes(session, [
+                    (notification.id, outcome, delay, error)
+                    for notification, (outcome, delay, error) in zip(batch, outcomes)
+                ])
+        return len(batch)
+
+    async def run(self, poll_interval: float = NOTIFY_POLL_INTERVAL) -> None:
+        """
+        Drains the outbox until cancelled, polling when it is empty.
+        """
+        while True:
+            try:
+                sent = await self.dispatch_batch()
+                async with async_session() as session:
+                    self.backlog = await repository.count_pending_notifications(session)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке уведомлений: {e}")
+                sent = 0
+            if not sent:
+                await asyncio.sleep(poll_interval)
+
+
+Gauge(
+    "referalbot_notifications_backlog", "Pending notifications in the outbox",
+    lambda: {(): _dispatcher.backlog} if _dispatcher else {}
+)
+CallbackCounter(
+    "referalbot_notifications_total", "Notification send outcomes",
+    lambda: {
+        "sent": _dispatcher.sent_total, "retried": _dispatcher.retried_total, "failed": _dispatcher.failed_total
+    } if _dispatcher else {},
+    ("outcome",)
+)
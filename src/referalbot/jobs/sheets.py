@@ -0,0 +1,148 @@
+import asyncio
+import os
+import re
+from typing import Callable
+
+from src.referalbot.config import GOOGLE_SHEETS_CREDENTIALS, GOOGLE_SHEETS_SPREADSHEET, SHEETS_FLUSH_INTERVAL
+from src.referalbot.utils import logger
+
+SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+
+def default_client_factory():
+    """Authorizes a gspread client with the service account credentials."""
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SHEETS_CREDENTIALS, SCOPE)
+    return gspread.authorize(creds)
+
+
+def purchase_row(purchase, user, invited_by_username: str | None) -> list:
+    return [
+        purchase.id,
+        purchase.user_id,
+        user.username,
+        user.promo_code,
+        invited_by_username or "-",
+        purchase.date.isoformat(),
+        purchase.amount,
+        purchase.discount_applied,
+        purchase.bonus_amount,
+        # Статус "Ожидание" заменен на "Начислен"
+        "Выплачен" if purchase.bonus_paid else "Начислен",
+    ]
+
+
+class SheetsExporter:
+    """
+    Exports purchases to Google Sheets without blocking the event loop.
+
+    Rows are queued in memory (a later update of the same purchase replaces
+    the queued one) and written periodically with one batch_update for known
+    purchases and one append_rows for new ones. The client is authorized
+    once, and the purchase_id -> sheet row index is read from column A and
+    then maintained locally. Other workers append to the same sheet, so
+    before appending purchases missing from the index, column A is read
+    again; rows of known purchases never move. All gspread calls run in a
+    worker thread.
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable = default_client_factory,
+        spreadsheet: str = GOOGLE_SHEETS_SPREADSHEET,
+        enabled: bool = True,
+    ):
+        self.client_factory = client_factory
+        self.spreadsheet = spreadsheet
+        self.enabled = enabled
+        self._sheet = None
+        self._row_index: dict[int, int] = {}
+        self._next_row = 2
+        self._pending: dict[int, list] = {}
+        self._lock = asyncio.Lock()
+
+    def enqueue(self, purchase, user, invited_by_username: str | None = None) -> None:
+        if self.enabled:
+            self._pending[purchase.id] = purchase_row(purchase, user, invited_by_username)
+
+    def _open_sheet(self):
+        if self._sheet is None:
+            sheet = self.client_factory().open(self.spreadsheet).sheet1
+            self._read_index(sheet)
+            self._sheet = sheet
+        return self._sheet
+
+    def _read_index(self, sheet) -> None:
+        purchase_ids = sheet.col_values(1)
+        # Первая строка - заголовок
+        for row_number, value in enumerate(purchase_ids[1:], start=2):
+            if str(value).isdigit():
+                self._row_index[int(value)] = row_number
+        self._next_row = len(purchase_ids) + 1
+
+    def _write(self, rows: dict[int, list]) -> None:
+        index_is_fresh = self._sheet is None
+        sheet = self._open_sheet()
+        if not index_is_fresh and any(pid not in self._row_index for pid in rows):
+            # Покупку мог уже дописать другой воркер: сверяемся с колонкой A, а не добавляем дубль
+            self._read_index(sheet)
+        updates = [
+            {"range": f"A{self._row_index[pid]}:J{self._row_index[pid]}", "values": [row]}
+            for pid, row in rows.items() if pid in self._row_index
+        ]
+        new_rows = {pid: row for pid, row in rows.items() if pid not in self._row_index}
+
+        if updates:
+            sheet.batch_update(updates)
+        if new_rows:
+            response = sheet.append_rows(list(new_rows.values()))
+            first_row = self._first_appended_row(response) or self._next_row
+            for offset, pid in enumerate(new_rows):
+                self._row_index[pid] = first_row + offset
+            self._next_row = first_row + len(new_rows)
+
+    @staticmethod
+    def _first_appended_row(response) -> int | None:
+        """Parses the first row number from e.g. {'updates': {'updatedRange': 'Sheet1!A10:J12'}}."""
+        updated_range = (response or {}).get("updates", {}).get("updatedRange", "")
+        match = re.search(r"![A-Z]+(\d+)", updated_range)
+        return int(match.group(1)) if match else None
+
+    async def flush(self) -> int:
+        """
+        Writes every queued row. On failure the rows are queued again unless
+        a newer version of the same purchase arrived meanwhile.
+        """
+        async with self._lock:
+            if not self._pending:
+                return 0
+            rows, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception as e:
+                logger.error(f"Ошибка записи в Google Sheets: {e}")
+                # Индекс строк мог устареть - перечитаем при следующей попытке
+                self._sheet = None
+                self._row_index.clear()
+                self._pending = {**rows, **self._pending}
+                return 0
+            return len(rows)
+
+    async def run(self, interval: float = SHEETS_FLUSH_INTERVAL) -> None:
+        """
+        Flushes queued rows every `interval` seconds until cancelled.
+        """
+        if not self.enabled:
+            logger.info("Выгрузка в Google Sheets отключена: файл с ключом сервисного аккаунта не найден")
+            return
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+
+sheets_exporter = SheetsExporter(enabled=os.path.exists(GOOGLE_SHEETS_CREDENTIALS))
@@ -0,0 +1,166 @@
+"""
+Minimal Prometheus text-format metrics shared by the API and the bot process.
+"""
+import bisect
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        REGISTRY.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> Iterable[tuple[str, dict, float]]:
+        """(name suffix, labels, value) of every sample to render."""
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield "", dict(zip(self.labelnames, key)), value
+
+
+class Gauge(Metric):
+    """Gauge whose samples are read from `function` at scrape time."""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], dict], labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def samples(self):
+        for key, value in self.function().items():
+            key = key if isinstance(key, tuple) else (key,)
+            yield "", dict(zip(self.labelnames, key)), value
+
+
+class CallbackCounter(Gauge):
+    """Counter maintained elsewhere and read from `function` at scrape time."""
+    type = "counter"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [счётчики по корзинам (+Inf последней), сумма]
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        for key, (counts, total) in self._values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield "_bucket", {**labels, "le": bound}, cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+BOT_HANDLER_LATENCY = Histogram(
+    "referalbot_bot_handler_duration_seconds", "Bot handler latency", ("handler",)
+)
+BOT_HANDLER_ERRORS = Counter(
+    "referalbot_bot_handler_errors_total", "Bot handlers that raised", ("handler",)
+)
+HTTP_REQUEST_LATENCY = Histogram(
+    "referalbot_http_request_duration_seconds", "API request latency", ("method", "route", "status")
+)
+DB_QUERY_LATENCY = Histogram(
+    "referalbot_db_query_duration_seconds", "SQL statement latency", ("role",)
+)
+DB_POOL_CHECKOUT = Histogram(
+    "referalbot_db_pool_checkout_seconds",
+    "Time to check a connection out of the pool, including connect and pre-ping", ("role",)
+)
+BOT_UPDATE_QUEUE_WAIT = Histogram(
+    "referalbot_bot_update_queue_wait_seconds", "Time an update waits in its chat queue before handling"
+)
+TELEGRAM_REQUEST_LATENCY = Histogram(
+    "referalbot_telegram_request_duration_seconds", "Telegram Bot API call latency", ("method",)
+)
+TELEGRAM_REQUEST_ERRORS = Counter(
+    "referalbot_telegram_request_errors_total", "Failed Telegram Bot API calls", ("method", "error")
+)
+
+
+async def start_metrics_server(host: str, port: int):
+    """
+    Serves /metrics from a small aiohttp server, for processes without the
+    FastAPI app (the polling bot). Returns the runner to clean up on exit.
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,256 @@
+"""
+Benchmarks the hot repository functions, API routes and admin list queries
+against the current database (fill it with tools/seed.py first).
+
+Every operation runs `--requests` times from `--concurrency` concurrent
+workers after a short warm-up. Latency percentiles, throughput and the mean
+number of SQL statements per operation are printed and can be saved as JSON
+to compare revisions:
+
+    python -m src.referalbot.tools.bench --output before.json
+    python -m src.referalbot.tools.bench --compare before.json
+
+POST /purchases and get_or_create_user for unknown users write to the
+database: run the suite against a dedicated benchmark database only.
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+from sqlalchemy import text
+from starlette.requests import Request
+
+from src.referalbot.api.main import app, admin
+from src.referalbot.database import repository
+from src.referalbot.database.db import engine, async_session
+from src.referalbot.database.query_tracker import track_queries
+from src.referalbot.tools.seed import TELEGRAM_ID_OFFSET
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float], errors: int, queries: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    done = len(latencies)
+    summary = {"requests": done, "errors": errors}
+    for q in PERCENTILES:
+        summary[f"p{q}_ms"] = round(percentile(latencies, q) * 1000, 3)
+    summary["mean_ms"] = round(sum(latencies) / done * 1000, 3) if done else 0.0
+    summary["max_ms"] = round(latencies[-1] * 1000, 3) if done else 0.0
+    summary["throughput_rps"] = round(done / elapsed, 1) if elapsed else 0.0
+    summary["queries_per_op"] = round(queries / done, 2) if done else 0.0
+    return summary
+
+
+async def run_benchmark(operation, requests: int, concurrency: int, warmup: int, rng: random.Random) -> dict:
+    """Calls `operation(rng)` `requests` times from `concurrency` workers."""
+    for _ in range(warmup):
+        await operation(rng)
+
+    latencies: list[float] = []
+    errors = 0
+    queries = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors, queries
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            try:
+                with track_queries("bench") as recorder:
+                    await operation(rng)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            queries += recorder.count
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, queries, time.perf_counter() - started)
+
+
+async def load_sample(size: int = 1000) -> dict:
+    """Ids the operations pick from: inviters (users with bonuses) and the user id range."""
+    async with engine.connect() as conn:
+        min_id, max_id, max_telegram_id = (await conn.execute(text(
+            "SELECT coalesce(min(id), 0), coalesce(max(id), 0), coalesce(max(telegram_id), 0) FROM users"
+        ))).one()
+        inviters = (await conn.execute(text(
+            "SELECT DISTINCT invited_by_id FROM users WHERE invited_by_id IS NOT NULL "
+            "ORDER BY invited_by_id LIMIT :size"
+        ), {"size": size})).scalars().all()
+        rows = (await conn.execute(text(
+            "SELECT relname, reltuples::bigint FROM pg_class "
+            "WHERE relname IN ('users', 'purchases', 'bonus_history')"
+        ))).all()
+    if not max_id:
+        raise RuntimeError("База пуста: сначала заполните её через src.referalbot.tools.seed")
+    return {
+        "min_id": min_id,
+        "max_id": max_id,
+        "max_telegram_id": max(max_telegram_id, TELEGRAM_ID_OFFSET),
+        "inviters": list(inviters) or [min_id],
+        "rows": {name: count for name, count in rows},
+    }
+
+
+def build_benchmarks(sample: dict, client: httpx.AsyncClient) -> dict:
+    def random_user_id(rng):
+        return rng.randint(sample["min_id"], sample["max_id"])
+
+    async def get_bonus_balance(rng):
+        async with async_session() as session:
+            await repository.get_bonus_balance(session, rng.choice(sample["inviters"]), use_cache=False)
+
+    async def get_bonus_balance_cached(rng):
+        async with async_session() as session:
+            await repository.get_bonus_balance(session, rng.choice(sample["inviters"]))
+
+    async def get_bonus_history(rng):
+        async with async_session() as session:
+            await repository.get_bonus_history(session, rng.choice(sample["inviters"]))
+
+    async def get_or_create_user(rng):
+        # Каждый десятый - новый пользователь; транзакция откатывается, чтобы не раздувать базу
+        if rng.random() < 0.1:
+            telegram_id = sample["max_telegram_id"] + rng.randint(1, 10 ** 9)
+        else:
+            telegram_id = TELEGRAM_ID_OFFSET + random_user_id(rng)
+        async with async_session() as session:
+            await repository.get_or_create_user(session, telegram_id, f"bench{telegram_id}")
+            await session.rollback()
+
+    async def get_users(rng):
+        after_id = max(random_user_id(rng) - 100, 0)
+        response = await client.get("/users", params={"after_id": after_id, "limit": 100})
+        response.raise_for_status()
+
+    async def post_purchase(rng):
+        response = await client.post("/purchases", json={
+            "user_id": random_user_id(rng), "amount": rng.randrange(50_000, 5_000_000, 1000)
+        })
+        response.raise_for_status()
+
+    async def get_leaderboard(rng):
+        response = await client.get("/leaderboard", params={"period": rng.choice(["week", "month"])})
+        response.raise_for_status()
+
+    benchmarks = {
+        "get_bonus_balance": get_bonus_balance,
+        "get_bonus_balance_cached": get_bonus_balance_cached,
+        "get_bonus_history": get_bonus_history,
+        "get_or_create_user": get_or_create_user,
+        "GET /users": get_users,
+        "POST /purchases": post_purchase,
+        "GET /leaderboard": get_leaderboard,
+    }
+
+    for view in admin.views:
+        if not hasattr(view, "list"):
+            continue
+
+        async def admin_list(rng, view=view):
+            # Как страница списка в админке: выборка, подсчёт и форматирование значений
+            page = rng.randint(1, max(1, sample["rows"].get(view.model.__tablename__, 0) // view.page_size // 10))
+            request = Request({
+                "type": "http", "query_string": f"page={page}".encode(), "headers": [], "session": {}
+            })
+            pagination = await view.list(request)
+            for row in pagination.rows:
+                for prop in view._list_prop_names:
+                    await view.get_list_value(row, prop)
+
+        benchmarks[f"admin {view.identity} list"] = admin_list
+    return benchmarks
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def bench(requests: int, concurrency: int, warmup: int, only: list[str] | None, seed: int) -> dict:
+    sample = await load_sample()
+    rng = random.Random(seed)
+    results = {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for name, operation in build_benchmarks(sample, client).items():
+            if only and name not in only:
+                continue
+            results[name] = await run_benchmark(operation, requests, concurrency, warmup, rng)
+            print(f"{name:<32} {_format(results[name])}", file=sys.stderr)
+    await engine.dispose()
+    return {
+        "revision": git_revision(),
+        "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "params": {"requests": requests, "concurrency": concurrency, "warmup": warmup, "seed": seed},
+        "rows": sample["rows"],
+        "results": results,
+    }
+
+
+def _format(result: dict) -> str:
+    return (
+        f"p50 {result['p50_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms  "
+        f"{result['throughput_rps']:>8.1f} rps  {result['queries_per_op']:>5} q/op  errors {result['errors']}"
+    )
+
+
+def compare(report: dict, baseline: dict) -> None:
+    """Prints p50/p99/throughput changes against a previously saved report."""
+    print(f"{baseline.get('revision')} -> {report.get('revision')}", file=sys.stderr)
+    for name, result in report["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            continue
+        changes = []
+        for key in ("p50_ms", "p99_ms", "throughput_rps"):
+            delta = (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            changes.append(f"{key} {before[key]} -> {result[key]} ({delta:+.1f}%)")
+        print(f"{name:<32} " + "  ".join(changes), file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark repository functions, routes and admin lists")
+    parser.add_argument("--requests", type=int, default=500, help="operations per benchmark")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--only", help="comma-separated benchmark names")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON report of a previous run to compare with")
+    args = parser.parse_args()
+
+    only = [name.strip() for name in args.only.split(",")] if args.only else None
+    report = asyncio.run(bench(args.requests, args.concurrency, args.warmup, only, args.seed))
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
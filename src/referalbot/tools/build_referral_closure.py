@@ -0,0 +1,79 @@
+"""
+Rebuilds the referral_closure table from users.invited_by_id.
+
+The table is filled level by level with set-based INSERT ... SELECT: first
+every direct referral (depth 1), then each level is the previous one joined
+with the users it invited. The number of statements equals the depth of the
+deepest chain, not the number of users. Everything runs in one transaction,
+so readers see either the old table or the complete new one. The table is
+locked against concurrent link_referral calls for the duration of the
+rebuild; they wait for it and apply their change on top once it commits.
+
+    python -m src.referalbot.tools.build_referral_closure
+
+Run it once after the migration that creates the table; afterwards the
+bot keeps it up to date through repository.link_referral.
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import text
+
+from src.referalbot.database.db import engine
+from src.referalbot.utils import logger
+
+FIRST_LEVEL = """
+    INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+    SELECT invited_by_id, id, 1 FROM users WHERE invited_by_id IS NOT NULL AND invited_by_id <> id
+"""
+
+NEXT_LEVEL = """
+    INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+    SELECT c.ancestor_id, u.id, c.depth + 1
+    FROM referral_closure c
+    JOIN users u ON u.invited_by_id = c.descendant_id
+    WHERE c.depth = :depth
+    ON CONFLICT DO NOTHING
+"""
+
+
+async def build_referral_closure(conn, max_depth: int = 1000) -> dict[int, int]:
+    """
+    Replaces the closure table contents using `conn` (an open transaction).
+    Returns {depth: rows}. A cycle in invited_by_id would never run out of
+    levels, so the walk stops at `max_depth`.
+    """
+    await conn.execute(text("LOCK TABLE referral_closure IN SHARE ROW EXCLUSIVE MODE"))
+    await conn.execute(text("DELETE FROM referral_closure"))
+    levels = {1: (await conn.execute(text(FIRST_LEVEL))).rowcount}
+    depth = 1
+    while levels[depth] and depth < max_depth:
+        levels[depth + 1] = (await conn.execute(text(NEXT_LEVEL), {"depth": depth})).rowcount
+        depth += 1
+        logger.info(f"Замыкание рефералов: уровень {depth}, строк {levels[depth]}")
+    if levels[depth] and depth >= max_depth:
+        logger.warning(f"Замыкание рефералов: достигнута глубина {max_depth}, возможен цикл в invited_by_id")
+    return {depth: rows for depth, rows in levels.items() if rows}
+
+
+async def rebuild(max_depth: int = 1000) -> dict:
+    started = time.perf_counter()
+    async with engine.begin() as conn:
+        levels = await build_referral_closure(conn, max_depth)
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("ANALYZE referral_closure"))
+    await engine.dispose()
+    return {"rows": sum(levels.values()), "levels": levels, "seconds": round(time.perf_counter() - started, 2)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rebuild the referral closure table from users.invited_by_id")
+    parser.add_argument("--max-depth", type=int, default=1000)
+    args = parser.parse_args()
+    print(asyncio.run(rebuild(args.max_depth)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Rebuilds the bonus_daily_rollups table from bonus_history with a single
+GROUP BY, e.g. after bonus rows were written around the repository (manual
+SQL, COPY) or to verify the incrementally maintained totals:
+
+    python -m src.referalbot.tools.rebuild_bonus_rollups
+    python -m src.referalbot.tools.rebuild_bonus_rollups --check
+
+The rollups are locked against concurrent upserts for the duration of the
+rebuild; bonus writes wait for it and are added on top once it commits.
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import text
+
+from src.referalbot.database.db import engine
+from src.referalbot.utils import logger
+
+ROLLUPS_FROM_HISTORY = """
+    SELECT user_id, date::date AS day, sum(greatest(amount, 0)) AS earned,
+           sum(greatest(-amount, 0)) AS paid_out, count(*) AS operations
+    FROM bonus_history
+    WHERE user_id IS NOT NULL AND date IS NOT NULL
+    GROUP BY user_id, date::date
+"""
+
+# Строки, которых не хватает в агрегатах (missing), и лишние/устаревшие строки (extra)
+MISMATCHES = f"""
+    WITH expected AS ({ROLLUPS_FROM_HISTORY}),
+    actual AS (SELECT user_id, day, earned, paid_out, operations FROM bonus_daily_rollups)
+    SELECT (SELECT count(*) FROM (SELECT * FROM expected EXCEPT SELECT * FROM actual) missing) AS missing,
+           (SELECT count(*) FROM (SELECT * FROM actual EXCEPT SELECT * FROM expected) extra) AS extra
+"""
+
+
+async def build_bonus_rollups(conn) -> int:
+    """Replaces the rollups using `conn` (an open transaction). Returns the row count."""
+    await conn.execute(text("LOCK TABLE bonus_daily_rollups IN SHARE ROW EXCLUSIVE MODE"))
+    await conn.execute(text("DELETE FROM bonus_daily_rollups"))
+    result = await conn.execute(text(
+        f"INSERT INTO bonus_daily_rollups (user_id, day, earned, paid_out, operations) {ROLLUPS_FROM_HISTORY}"
+    ))
+    return result.rowcount
+
+
+async def rebuild(check: bool = False) -> dict:
+    started = time.perf_counter()
+    async with engine.begin() as conn:
+        if check:
+            total = (await conn.execute(text("SELECT count(*) FROM bonus_daily_rollups"))).scalar()
+            missing, extra = (await conn.execute(text(MISMATCHES))).one()
+            report = {"rows": total, "missing": missing, "extra": extra}
+            if missing or extra:
+                logger.warning(
+                    f"Агрегаты бонусов расходятся с bonus_history: {missing} строк не хватает, {extra} лишних"
+                )
+        else:
+            report = {"rows": await build_bonus_rollups(conn)}
+    if not check:
+        async with engine.connect() as conn:
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text("ANALYZE bonus_daily_rollups"))
+    await engine.dispose()
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rebuild daily bonus rollups from bonus_history")
+    parser.add_argument("--check", action="store_true", help="only count rollup rows missing from or not backed by bonus_history")
+    args = parser.parse_args()
+    print(asyncio.run(rebuild(args.check)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Fills a local PostgreSQL database with a synthetic referral graph for
+benchmarks: users, the referral tree between them, purchases and the
+bonus_history rows those purchases produce.
+
+The tree grows by preferential attachment - a user who already invited many
+people is proportionally more likely to invite the next one - which gives the
+few large downlines and the long tail of small ones seen in production. Rows
+are written with COPY in chunks, so tens of millions of rows load in minutes.
+
+    python -m src.referalbot.tools.seed --users 100000 --truncate
+
+The referral_closure and bonus_daily_rollups tables are rebuilt at the end.
+
+Roughly users * (1 + purchases * (1 + invited_ratio * (1 + payout_ratio)))
+rows are written: --users 2000 gives ~10k rows, --users 2000000 ~10M rows.
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from src.referalbot.database.db import engine, init_db
+from src.referalbot.database.models import BONUS_MATURATION_PERIOD
+from src.referalbot.tools.build_referral_closure import build_referral_closure
+from src.referalbot.tools.rebuild_bonus_rollups import build_bonus_rollups
+from src.referalbot.utils import logger
+
+PRODUCT_NAMES = ["Villa rent", "Scooter rent", "Surf lessons", "Yoga retreat", "Airport transfer", "Diving tour"]
+
+USER_COLUMNS = ["id", "telegram_id", "username", "promo_code", "invited_by_id", "created_at"]
+PURCHASE_COLUMNS = ["id", "user_id", "name", "amount", "discount_applied", "bonus_amount", "date", "bonus_paid"]
+BONUS_COLUMNS = ["id", "user_id", "amount", "operation", "description", "date", "status"]
+
+# Смещение telegram_id, чтобы синтетические пользователи не пересекались с настоящими
+TELEGRAM_ID_OFFSET = 10 ** 12
+
+
+class ReferralGraphGenerator:
+    """Generates users, purchases and bonus operations chunk by chunk."""
+
+    def __init__(
+        self,
+        users: int,
+        invited_ratio: float = 0.7,
+        purchases_per_user: float = 2.0,
+        payout_ratio: float = 0.3,
+        days: int = 180,
+        seed: int = 42,
+        first_ids: tuple[int, int, int] = (1, 1, 1),
+        now: datetime | None = None,
+    ):
+        self.users = users
+        self.invited_ratio = invited_ratio
+        self.purchases_per_user = purchases_per_user
+        self.payout_ratio = payout_ratio
+        self.days = days
+        self.rng = random.Random(seed)
+        self.now = now or datetime.utcnow()
+        self.start = self.now - timedelta(days=days)
+        self.next_user_id, self.next_purchase_id, self.next_bonus_id = first_ids
+        # Каждый пользователь входит один раз плюс по разу за каждого приглашённого
+        self._inviter_pool: list[int] = []
+        self._generated = 0
+
+    def _random_date(self, after: datetime) -> datetime:
+        return after + (self.now - after) * self.rng.random()
+
+    def chunk(self, size: int) -> tuple[list[tuple], list[tuple], list[tuple]]:
+        users, purchases, bonuses = [], [], []
+        rng = self.rng
+        for _ in range(min(size, self.users - self._generated)):
+            user_id = self.next_user_id
+            self.next_user_id += 1
+            # Пользователи создаются в порядке id, поэтому пригласивший всегда раньше
+            created_at = self.start + (self.now - self.start) * (self._generated / self.users)
+            self._generated += 1
+
+            inviter_id = None
+            if self._inviter_pool and rng.random() < self.invited_ratio:
+                inviter_id = rng.choice(self._inviter_pool)
+                self._inviter_pool.append(inviter_id)
+            self._inviter_pool.append(user_id)
+
+            users.append((
+                user_id, TELEGRAM_ID_OFFSET + user_id, f"user{user_id}", f"SEED{user_id}", inviter_id, created_at
+            ))
+
+            for _ in range(int(rng.expovariate(1 / self.purchases_per_user) + 0.5) if self.purchases_per_user else 0):
+                purchase_id = self.next_purchase_id
+                self.next_purchase_id += 1
+                date = self._random_date(created_at)
+                amount = rng.randrange(50_000, 5_000_000, 1000)
+                bonus_amount = int(round(amount * 0.05)) if inviter_id else 0
+                matured = date < self.now - BONUS_MATURATION_PERIOD
+                purchases.append((
+                    purchase_id, user_id, rng.choice(PRODUCT_NAMES), amount, 5, bonus_amount, date, False
+                ))
+                if not bonus_amount:
+                    continue
+
+                bonuses.append((
+                    self.next_bonus_id, inviter_id, bonus_amount, "Начисление",
+                    f"За покупку от user{user_id} (ID: {purchase_id})", date,
+                    "available" if matured else "pending"
+                ))
+                self.next_bonus_id += 1
+                if matured and rng.random() < self.payout_ratio:
+                    bonuses.append((
+                        self.next_bonus_id, inviter_id, -bonus_amount, "Выплата",
+                        "Выплата всего доступного баланса",
+                        self._random_date(date + BONUS_MATURATION_PERIOD), "available"
+                    ))
+                    self.next_bonus_id += 1
+        return users, purchases, bonuses
+
+    @property
+    def done(self) -> bool:
+        return self._generated >= self.users
+
+
+async def seed(
+    users: int,
+    invited_ratio: float = 0.7,
+    purchases_per_user: float = 2.0,
+    payout_ratio: float = 0.3,
+    days: int = 180,
+    seed: int = 42,
+    chunk_size: int = 20_000,
+    truncate: bool = False,
+) -> dict:
+    """Appends a synthetic referral graph to the database and returns row counts."""
+    if engine.dialect.name != "postgresql":
+        raise RuntimeError("Сидер использует COPY и работает только с PostgreSQL")
+
+    await init_db()
+    async with engine.begin() as conn:
+        if truncate:
+            await conn.execute(text("TRUNCATE bonus_history, purchases, users RESTART IDENTITY CASCADE"))
+        first_ids = []
+        for table in ("users", "purchases", "bonus_history"):
+            first_ids.append((await conn.execute(text(f"SELECT coalesce(max(id), 0) + 1 FROM {table}"))).scalar())
+
+    generator = ReferralGraphGenerator(
+        users, invited_ratio, purchases_per_user, payout_ratio, days, seed, tuple(first_ids)
+    )
+    counts = {"users": 0, "purchases": 0, "bonus_history": 0}
+    started = time.perf_counter()
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        driver = raw.driver_connection
+        while not generator.done:
+            user_rows, purchase_rows, bonus_rows = generator.chunk(chunk_size)
+            # Чанк целиком в одной транзакции: прерванный сид не оставит покупок без пользователей
+            async with driver.transaction():
+                await driver.copy_records_to_table("users", records=user_rows, columns=USER_COLUMNS)
+                await driver.copy_records_to_table("purchases", records=purchase_rows, columns=PURCHASE_COLUMNS)
+                await driver.copy_records_to_table("bonus_history", records=bonus_rows, columns=BONUS_COLUMNS)
+            counts["users"] += len(user_rows)
+            counts["purchases"] += len(purchase_rows)
+            counts["bonus_history"] += len(bonus_rows)
+            logger.info(f"Сид: {counts} за {time.perf_counter() - started:.1f} с")
+
+    async with engine.begin() as conn:
+        for table in ("users", "purchases", "bonus_history"):
+            await conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"
+            ))
+        # COPY обходит репозиторий, поэтому замыкание и агрегаты строятся целиком заново
+        counts["referral_closure"] = sum((await build_referral_closure(conn)).values())
+        counts["bonus_daily_rollups"] = await build_bonus_rollups(conn)
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("ANALYZE users, purchases, bonus_history, referral_closure, bonus_daily_rollups"))
+    await engine.dispose()
+
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Seed a synthetic referral graph for benchmarks")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--invited-ratio", type=float, default=0.7, help="share of users who came by invitation")
+    parser.add_argument("--purchases-per-user", type=float, default=2.0, help="mean purchases per user")
+    parser.add_argument("--payout-ratio", type=float, default=0.3, help="share of matured bonuses already paid out")
+    parser.add_argument("--days", type=int, default=180, help="history depth")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk-size", type=int, default=20_000)
+    parser.add_argument("--truncate", action="store_true", help="wipe users, purchases and bonus_history first")
+    args = parser.parse_args()
+    counts = asyncio.run(seed(
+        args.users, args.invited_ratio, args.purchases_per_user, args.payout_ratio,
+        args.days, args.seed, args.chunk_size, args.truncate
+    ))
+    print(counts)
+
+
+if __name__ == "__main__":
+    main()
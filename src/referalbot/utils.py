@@ -1,18 +1,77 @@
+"""
+Logging setup shared by every process.
+
+Loggers only put records on an in-memory queue; a QueueListener thread
+formats them and writes to the console and to a rotating file of JSON
+lines, so the event loop never waits for disk I/O. Each record carries the
+correlation id of the HTTP request or bot update it was logged from.
+"""
+import atexit
+import json
 import logging
 import os
+import queue
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+from src.referalbot.config import LOG_LEVEL, LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_WHEN, LOG_BACKUP_COUNT
+
+# Идентификатор текущего HTTP-запроса или обновления бота
+correlation_id: ContextVar[str | None] = ContextVar("correlation_id", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, module, correlation id and message."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "correlation_id": record.correlation_id,
+            "message": record.getMessage(),
+        }
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _add_correlation_id(record: logging.LogRecord) -> bool:
+    # Фильтр выполняется в потоке вызова, пока контекст запроса ещё доступен
+    record.correlation_id = correlation_id.get()
+    return True
+
+
+os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+
+if LOG_ROTATE_WHEN:
+    file_handler = TimedRotatingFileHandler(
+        LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8", utc=True
+    )
+else:
+    file_handler = RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+file_handler.setFormatter(JsonFormatter())
 
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(logging.Formatter(
+    '%(asctime)s - %(levelname)s - [%(module)s] [%(correlation_id)s] %(message)s'
+))
 
-os.makedirs("logs", exist_ok=True)
+# Очередь без ограничения: вызов логгера никогда не блокируется
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+queue_handler.addFilter(_add_correlation_id)
+# Сообщение (и traceback) форматируется до постановки в очередь, поля записи добавляют форматтеры слушателя
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
 
+logging.basicConfig(level=LOG_LEVEL, handlers=[queue_handler])
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - [%(module)s] %(message)s',
-    handlers=[
-        logging.StreamHandler(),  # Логи в консоль
-        logging.FileHandler("logs/app.log", encoding='utf-8')  # Логи в файл
-    ]
-)
+log_listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+log_listener.start()
+# Дописывает оставшиеся в очереди записи при выходе
+atexit.register(log_listener.stop)
 
 
 logger = logging.getLogger(__name__)
@@ -20,4 +79,4 @@ logger = logging.getLogger(__name__)
 logging.getLogger("google.auth.transport").setLevel(logging.WARNING)
 logging.getLogger("google.auth.client").setLevel(logging.WARNING)
 logging.getLogger("oauth2client").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
\ No newline at end of file
+logging.getLogger("urllib3").setLevel(logging.WARNING)
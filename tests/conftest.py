@@ -0,0 +1,76 @@
+import asyncio
+import os
+from contextlib import contextmanager
+
+import pytest
+
+# Тесты с базой (фикстуры seeded_db и db) запускаются только на отдельной
+# базе: сидер очищает таблицы. Без TEST_DATABASE_URL они пропускаются,
+# в CI базу поднимает .github/workflows/tests.yml.
+# Переменная читается до импорта config, чтобы движок создался для неё.
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+if TEST_DATABASE_URL:
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:test")
+
+from src.referalbot.database.query_tracker import track_queries  # noqa: E402
+
+# Граф для тестов: несколько тысяч строк, сидируется за пару секунд
+SEED_USERS = 2000
+
+
+def pytest_report_header(config):
+    if TEST_DATABASE_URL:
+        return "database tests: enabled (TEST_DATABASE_URL)"
+    return "database tests: SKIPPED - set TEST_DATABASE_URL to a disposable PostgreSQL database migrated to head"
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+def seeded_db() -> dict:
+    """
+    Seeds TEST_DATABASE_URL once per run with a small synthetic referral
+    graph (tools/seed.py) and returns the row counts. Tests depending on it
+    are skipped when TEST_DATABASE_URL is not set.
+    """
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    from src.referalbot.tools.seed import seed
+
+    return asyncio.run(seed(SEED_USERS, truncate=True))
+
+
+@pytest.fixture
+async def db(seeded_db):
+    """The seeded database; engine pools are disposed after the test, since each test has its own loop."""
+    from src.referalbot.database import db as database
+
+    yield seeded_db
+    for engine in list(database._engines.values()):
+        await engine.dispose()
+
+
+@pytest.fixture
+def query_budget():
+    """
+    Asserts that a block of code stays within a SQL statement budget:
+
+        with query_budget(2):
+            await repository.get_bonus_balance(session, user_id)
+
+    Routes are covered when the app runs in the test's own context, e.g. via
+    httpx.AsyncClient(transport=httpx.ASGITransport(app=app)).
+    """
+    @contextmanager
+    def budget(max_queries: int, name: str = "test"):
+        with track_queries(name) as recorder:
+            yield recorder
+        assert recorder.count <= max_queries, (
+            f"query budget exceeded ({recorder.count} > {max_queries})\n{recorder.report()}"
+        )
+
+    return budget
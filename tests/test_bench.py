@@ -0,0 +1,30 @@
+import pytest
+
+from src.referalbot.tools import bench
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_benchmark_suite_runs_on_seeded_graph(db):
+    """A short run of every benchmark: each operation must succeed and be measured."""
+    report = await bench.bench(requests=20, concurrency=4, warmup=1, only=None, seed=1)
+
+    assert report["rows"]["users"] > 0
+    for name, result in report["results"].items():
+        assert result["errors"] == 0, name
+        assert result["requests"] == 20, name
+        assert result["p50_ms"] <= result["p99_ms"] <= result["max_ms"], name
+
+
+def test_percentile_and_summary():
+    values = [i / 1000 for i in range(1, 101)]
+    assert bench.percentile(values, 50) == 0.05
+    assert bench.percentile(values, 99) == 0.099
+    assert bench.percentile([], 50) == 0.0
+
+    summary = bench.summarize(values, errors=2, queries=300, elapsed=2.0)
+    assert summary["requests"] == 100
+    assert summary["errors"] == 2
+    assert summary["throughput_rps"] == 50.0
+    assert summary["queries_per_op"] == 3.0
+    assert summary["max_ms"] == 100.0
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select, text, update
+
+from src.referalbot.database import repository
+from src.referalbot.database.db import async_session
+from src.referalbot.database.models import BonusDailyRollup, BonusHistory, User
+from src.referalbot.tools.rebuild_bonus_rollups import MISMATCHES
+
+pytestmark = pytest.mark.anyio
+
+
+async def _mismatches(session) -> tuple[int, int]:
+    return tuple((await session.execute(text(MISMATCHES))).one())
+
+
+async def _invited_user_ids(session, limit: int) -> list[int]:
+    return (await session.execute(
+        select(User.id).where(User.invited_by_id.is_not(None)).order_by(User.id).limit(limit)
+    )).scalars().all()
+
+
+async def test_seeded_rollups_match_bonus_history(db):
+    async with async_session() as session:
+        assert await _mismatches(session) == (0, 0)
+
+
+async def test_bonus_writers_keep_rollups_consistent(db):
+    async with async_session() as session:
+        try:
+            user_ids = await _invited_user_ids(session, 5)
+            now = datetime.utcnow()
+            # Начисление, выплата и импорт покупок в один и тот же день
+            await repository.credit_bonuses(session, user_ids, 1_000, "Начисление", "Тест", now)
+            await session.execute(update(BonusHistory).where(BonusHistory.user_id.in_(user_ids)).values(
+                status="available"
+            ))
+            paid = await repository.payout_available_balances(session, user_ids[:3], "Выплата", "Тест", now)
+            await repository.import_purchases(session, [
+                {"idempotency_key": f"rollups-{user_id}", "user_id": user_id, "amount": 20_000}
+                for user_id in user_ids
+            ], now)
+
+            assert set(paid) == set(user_ids[:3])
+            assert await _mismatches(session) == (0, 0)
+        finally:
+            await session.rollback()
+
+
+async def test_check_detects_missing_and_extra_rows(db):
+    async with async_session() as session:
+        try:
+            user_id = (await _invited_user_ids(session, 1))[0]
+            # Строка истории без агрегата и агрегат без истории
+            session.add(BonusHistory(
+                user_id=user_id, amount=10, operation="Начисление", date=datetime(2001, 1, 1), status="pending"
+            ))
+            session.add(BonusDailyRollup(
+                user_id=user_id, day=datetime(2002, 1, 1).date(), earned=10, paid_out=0, operations=1
+            ))
+            await session.flush()
+
+            assert await _mismatches(session) == (1, 1)
+        finally:
+            await session.rollback()
+
+
+async def test_balance_statistics_match_bonus_history(db):
+    async with async_session() as session:
+        user_id = await session.scalar(
+            select(BonusHistory.user_id).where(BonusHistory.amount > 0)
+            .group_by(BonusHistory.user_id).order_by(func.count().desc(), BonusHistory.user_id).limit(1)
+        )
+        week_start = datetime.combine(datetime.utcnow().date() - timedelta(days=6), datetime.min.time())
+        positive = BonusHistory.amount > 0
+        total, weekly = (await session.execute(
+            select(
+                func.coalesce(func.sum(BonusHistory.amount).filter(positive), 0),
+                func.coalesce(func.sum(BonusHistory.amount).filter(positive, BonusHistory.date >= week_start), 0),
+            ).where(BonusHistory.user_id == user_id)
+        )).one()
+
+        balance = await repository.get_bonus_balance(session, user_id, use_cache=False)
+
+    assert balance["total_earned"] == total
+    assert balance["weekly_earnings"] == weekly
@@ -0,0 +1,22 @@
+import pytest
+
+from src.referalbot.bot.client import KeepaliveAiohttpSession
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_connector_keeps_connections_alive():
+    session = KeepaliveAiohttpSession(limit=7, keepalive_timeout=42)
+    try:
+        client = await session.create_session()
+        assert await session.create_session() is client
+        assert client.connector.limit == 7
+        assert client.connector._keepalive_timeout == 42
+    finally:
+        await session.close()
+
+    assert client.closed
+    # После закрытия создаётся новая сессия
+    reopened = await session.create_session()
+    assert reopened is not client
+    await session.close()
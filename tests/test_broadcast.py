@@ -0,0 +1,14 @@
+from src.referalbot.jobs.broadcast import BroadcastSender
+from src.referalbot.metrics import REGISTRY
+
+
+def test_metrics_follow_the_current_sender():
+    BroadcastSender(bot=None)
+    sender = BroadcastSender(bot=None)
+    sender.outcomes["delivered"] = 4
+
+    lines = REGISTRY.render().splitlines()
+
+    assert lines.count("# TYPE referalbot_broadcast_messages_total counter") == 1
+    assert 'referalbot_broadcast_messages_total{outcome="delivered"} 4' in lines
+    assert 'referalbot_broadcast_messages_total{outcome="blocked"} 0' in lines
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from sqlalchemy import delete
+
+from src.referalbot.database.models import BulkOperation
+from src.referalbot.jobs import bulk_bonus
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def operations(db):
+    """Ids of the bulk operations started by the test; their rows are deleted afterwards."""
+    ids = []
+    yield ids
+    await bulk_bonus.cancel_bulk_operations()
+    async with bulk_bonus.async_session() as session:
+        async with session.begin():
+            await session.execute(delete(BulkOperation).where(BulkOperation.id.in_(ids)))
+
+
+@pytest.fixture
+def batches(monkeypatch) -> list[list[int]]:
+    """Replaces the bonus writes with a recorder, so only the progress rows are written."""
+    seen = []
+
+    async def credit_batch(session, user_ids, amount):
+        seen.append(user_ids)
+        if 13 in user_ids:
+            raise RuntimeError("batch failed")
+        # Каждый второй пользователь "не найден"
+        return {}, [user_id for user_id in user_ids if user_id % 2]
+
+    monkeypatch.setattr(bulk_bonus, "credit_batch", credit_batch)
+    return seen
+
+
+async def _wait(operation_id: str) -> dict:
+    for _ in range(100):
+        progress = await bulk_bonus.get_bulk_operation(operation_id)
+        if progress["status"] != "running":
+            return progress
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"operation {operation_id} did not finish")
+
+
+async def test_progress_is_stored_per_batch(operations, batches):
+    operation_id = await bulk_bonus.start_bulk_operation(
+        bulk_bonus.CREDIT, [5, 1, 2, 2, 3, 4, 6, 7], 100, batch_size=3
+    )
+    operations.append(operation_id)
+
+    progress = await _wait(operation_id)
+
+    assert batches == [[1, 2, 3], [4, 5, 6], [7]]
+    assert progress["status"] == "done"
+    assert progress["kind"] == bulk_bonus.CREDIT
+    assert (progress["total"], progress["processed"], progress["percent"]) == (7, 7, 100)
+    assert progress["affected"] == 4
+    assert progress["total_amount"] == 400
+    assert progress["finished_at"] is not None
+
+
+async def test_failed_batch_keeps_committed_progress(operations, batches):
+    operation_id = await bulk_bonus.start_bulk_operation(
+        bulk_bonus.CREDIT, list(range(10, 20)), 100, batch_size=3
+    )
+    operations.append(operation_id)
+
+    progress = await _wait(operation_id)
+
+    assert progress["status"] == "failed"
+    assert progress["error"] == "batch failed"
+    assert progress["processed"] == 3
+    assert progress["affected"] == 1
+
+
+async def test_cancelled_operation_is_marked(operations, monkeypatch):
+    started = asyncio.Event()
+
+    async def slow_credit_batch(session, user_ids, amount):
+        started.set()
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(bulk_bonus, "credit_batch", slow_credit_batch)
+    operation_id = await bulk_bonus.start_bulk_operation(bulk_bonus.CREDIT, [1, 2, 3], 100)
+    operations.append(operation_id)
+    await started.wait()
+
+    await bulk_bonus.cancel_bulk_operations()
+
+    progress = await bulk_bonus.get_bulk_operation(operation_id)
+    assert progress["status"] == "cancelled"
+    assert progress["processed"] == 0
+
+
+async def test_unknown_operation(db):
+    assert await bulk_bonus.get_bulk_operation("missing") is None
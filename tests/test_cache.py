@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.referalbot.database import cache
+from src.referalbot.database.cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces time.monotonic in the cache module with a clock moved by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+
+    def advance(seconds: float) -> None:
+        now[0] += seconds
+
+    return advance
+
+
+def test_entry_expires_after_ttl(clock):
+    ttl_cache = TTLCache(maxsize=10, ttl=60)
+    ttl_cache.set("a", 1)
+
+    clock(59)
+    assert ttl_cache.get("a") == 1
+    clock(1)
+    assert ttl_cache.get("a") is None
+    assert ttl_cache.stats() == {"size": 0, "hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_valid_until_shortens_ttl(clock):
+    ttl_cache = TTLCache(maxsize=10, ttl=60)
+    ttl_cache.set("a", 1, valid_until=datetime.utcnow() + timedelta(seconds=10))
+
+    clock(9)
+    assert ttl_cache.get("a") == 1
+    clock(2)
+    assert ttl_cache.get("a") is None
+
+
+def test_valid_until_does_not_extend_ttl(clock):
+    ttl_cache = TTLCache(maxsize=10, ttl=60)
+    ttl_cache.set("a", 1, valid_until=datetime.utcnow() + timedelta(days=1))
+
+    clock(61)
+    assert ttl_cache.get("a") is None
+
+
+def test_value_already_stale_is_not_stored():
+    ttl_cache = TTLCache(maxsize=10, ttl=60)
+    ttl_cache.set("a", 1, valid_until=datetime.utcnow() - timedelta(seconds=1))
+
+    assert ttl_cache.get("a") is None
+    assert ttl_cache.stats()["size"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    ttl_cache = TTLCache(maxsize=2, ttl=60)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2)
+    # Чтение делает "a" самой свежей записью
+    assert ttl_cache.get("a") == 1
+    ttl_cache.set("c", 3)
+
+    assert ttl_cache.get("b") is None
+    assert ttl_cache.get("a") == 1
+    assert ttl_cache.get("c") == 3
+    assert ttl_cache.stats()["evictions"] == 1
+
+
+def test_invalidate_and_clear():
+    ttl_cache = TTLCache(maxsize=10, ttl=60)
+    ttl_cache.set(("week", 10), [1, 2])
+    ttl_cache.set(("month", 10), [3])
+
+    ttl_cache.invalidate(("week", 10))
+    ttl_cache.invalidate("missing")
+    assert ttl_cache.get(("week", 10)) is None
+    assert ttl_cache.get(("month", 10)) == [3]
+
+    ttl_cache.clear()
+    assert ttl_cache.stats()["size"] == 0
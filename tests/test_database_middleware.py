@@ -0,0 +1,165 @@
+import pytest
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.filters import Command
+from aiogram.types import Update
+from sqlalchemy import func, insert, select
+
+from src.referalbot.bot.handlers import router as bot_router
+from src.referalbot.bot.middleware import DatabaseMiddleware, LazySession
+from src.referalbot.database.db import async_session
+from src.referalbot.database.models import NotificationOutbox
+
+pytestmark = pytest.mark.anyio
+
+USER = {"id": 1, "is_bot": False, "first_name": "Test"}
+
+
+class FakeSession:
+    """Records what the middleware and the handlers do with a session."""
+
+    def __init__(self):
+        self.queries = []
+        self.closed = False
+
+    async def execute(self, statement):
+        self.queries.append(statement)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeSessionPool:
+    def __init__(self):
+        self.sessions: list[FakeSession] = []
+
+    def __call__(self) -> FakeSession:
+        session = FakeSession()
+        self.sessions.append(session)
+        return session
+
+
+def message_update(text: str, update_id: int = 1) -> Update:
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "chat": {"id": 1, "type": "private"}, "from": USER, "text": text,
+        },
+    })
+
+
+def callback_update(data: str, update_id: int = 1) -> Update:
+    return Update.model_validate({
+        "update_id": update_id,
+        "callback_query": {"id": str(update_id), "from": USER, "chat_instance": "1", "data": data},
+    })
+
+
+def make_dispatcher(session_pool) -> tuple[Dispatcher, DatabaseMiddleware, dict]:
+    """A dispatcher with the middleware and test handlers; `seen` collects what handlers received."""
+    middleware = DatabaseMiddleware(session_pool)
+    seen = {}
+    router = Router()
+
+    @router.message(Command("idle"))
+    async def idle(message, session):
+        seen["idle"] = session
+
+    @router.message(Command("query"))
+    async def query(message, session):
+        await session.execute(select(1))
+
+    @router.message(Command("fail"))
+    async def fail(message, session):
+        await session.execute(select(1))
+        raise RuntimeError("handler failed")
+
+    @router.callback_query(F.data == "help_info", flags={"db": False})
+    async def no_db(callback, **data):
+        seen["no_db"] = data
+
+    dp = Dispatcher()
+    dp.message.middleware(middleware)
+    dp.callback_query.middleware(middleware)
+    dp.include_router(router)
+    return dp, middleware, seen
+
+
+@pytest.fixture
+async def bot():
+    bot = Bot("123456:test")
+    yield bot
+    await bot.session.close()
+
+
+async def test_handler_without_queries_opens_no_session(bot):
+    pool = FakeSessionPool()
+    dp, middleware, seen = make_dispatcher(pool)
+
+    await dp.feed_update(bot, message_update("/idle"))
+
+    assert isinstance(seen["idle"], LazySession)
+    assert not seen["idle"].opened
+    assert pool.sessions == []
+    assert middleware.stats() == {"updates_total": 1, "db_updates_total": 0}
+
+
+async def test_session_is_opened_on_first_use_and_closed(bot):
+    pool = FakeSessionPool()
+    dp, middleware, _ = make_dispatcher(pool)
+
+    await dp.feed_update(bot, message_update("/query"))
+
+    assert len(pool.sessions) == 1
+    assert len(pool.sessions[0].queries) == 1
+    assert pool.sessions[0].closed
+    assert middleware.stats() == {"updates_total": 1, "db_updates_total": 1}
+
+
+async def test_db_flag_skips_the_session(bot):
+    pool = FakeSessionPool()
+    dp, middleware, seen = make_dispatcher(pool)
+
+    await dp.feed_update(bot, callback_update("help_info"))
+
+    assert "session" not in seen["no_db"]
+    assert pool.sessions == []
+    assert middleware.stats() == {"updates_total": 1, "db_updates_total": 0}
+
+
+async def test_opened_session_is_closed_when_handler_fails(bot):
+    pool = FakeSessionPool()
+    dp, middleware, _ = make_dispatcher(pool)
+
+    with pytest.raises(RuntimeError, match="handler failed"):
+        await dp.feed_update(bot, message_update("/fail"))
+
+    assert pool.sessions[0].closed
+    assert middleware.stats() == {"updates_total": 1, "db_updates_total": 1}
+
+
+def test_help_info_handler_opts_out_of_the_database():
+    handlers = [
+        handler for handler in bot_router.callback_query.handlers
+        if handler.callback.__name__ == "help_command_callback"
+    ]
+    assert [handler.flags for handler in handlers] == [{"db": False}]
+
+
+async def test_failed_handler_changes_are_rolled_back(db, bot):
+    dp, _, _ = make_dispatcher(async_session)
+    router = Router()
+
+    @router.message(Command("write"))
+    async def write(message, session):
+        await session.execute(insert(NotificationOutbox).values(chat_id=-1, text="rolled back"))
+        raise RuntimeError("handler failed")
+
+    dp.include_router(router)
+    with pytest.raises(RuntimeError):
+        await dp.feed_update(bot, message_update("/write"))
+
+    async with async_session() as session:
+        count = await session.scalar(
+            select(func.count()).select_from(NotificationOutbox).where(NotificationOutbox.chat_id == -1)
+        )
+    assert count == 0
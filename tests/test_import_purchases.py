@@ -0,0 +1,86 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+from src.referalbot.database import repository
+from src.referalbot.database.db import async_session
+from src.referalbot.database.models import BonusHistory, NotificationOutbox, Purchase, User
+
+pytestmark = pytest.mark.anyio
+
+NOW = datetime(2026, 1, 15, 12, 0)
+
+
+async def _count(session, model) -> int:
+    return await session.scalar(select(func.count()).select_from(model))
+
+
+async def test_import_purchases(db, query_budget):
+    async with async_session() as session:
+        invited = await session.scalar(
+            select(User).where(User.invited_by_id.is_not(None)).order_by(User.id).limit(1)
+        )
+        uninvited = await session.scalar(select(User).where(User.invited_by_id.is_(None)).order_by(User.id).limit(1))
+        missing_id = await session.scalar(select(func.max(User.id))) + 1
+        # Транзакция сессии откатывается в конце: сидированный граф не меняется
+        try:
+            purchases, bonuses, notifications = (
+                await _count(session, Purchase), await _count(session, BonusHistory),
+                await _count(session, NotificationOutbox),
+            )
+            rows = [
+                {"idempotency_key": "a", "user_id": invited.id, "amount": 100_000, "name": "Villa"},
+                {"idempotency_key": "b", "user_id": uninvited.id, "amount": 50_000, "discount_applied": 10},
+                {"idempotency_key": "c", "user_id": missing_id, "amount": 10_000},
+            ]
+            with query_budget(6):
+                results, created = await repository.import_purchases(session, rows, NOW)
+
+            assert results["a"]["status"] == "created"
+            assert results["a"]["bonus_amount"] == 5_000
+            assert results["b"]["status"] == "created"
+            assert results["b"]["bonus_amount"] == 0
+            assert results["c"]["status"] == "user_not_found"
+            assert {purchase.idempotency_key for purchase, _ in created} == {"a", "b"}
+            assert await _count(session, Purchase) == purchases + 2
+
+            # Бонус начисляется только пригласившему покупателя из строки "a"
+            bonus = (await session.execute(
+                select(BonusHistory).where(BonusHistory.description.like(f"%(ID: {results['a']['purchase_id']})"))
+            )).scalar_one()
+            assert bonus.user_id == invited.invited_by_id
+            assert bonus.amount == 5_000
+            assert bonus.status == "pending"
+            assert await _count(session, BonusHistory) == bonuses + 1
+            inviter_telegram_id = await session.scalar(
+                select(User.telegram_id).where(User.id == invited.invited_by_id)
+            )
+            expected_notifications = notifications + (1 if inviter_telegram_id else 0)
+            assert await _count(session, NotificationOutbox) == expected_notifications
+
+            # Повторный импорт тех же ключей ничего не создаёт и возвращает существующие покупки
+            results_again, created_again = await repository.import_purchases(session, rows[:2], NOW)
+            assert created_again == []
+            assert results_again["a"] == {
+                "status": "duplicate", "purchase_id": results["a"]["purchase_id"], "bonus_amount": 5_000
+            }
+            assert results_again["b"]["status"] == "duplicate"
+            assert await _count(session, Purchase) == purchases + 2
+            assert await _count(session, BonusHistory) == bonuses + 1
+            assert await _count(session, NotificationOutbox) == expected_notifications
+        finally:
+            await session.rollback()
+
+
+async def test_import_purchases_of_unknown_users_writes_nothing(db):
+    async with async_session() as session:
+        missing_id = await session.scalar(select(func.max(User.id))) + 1
+        try:
+            results, created = await repository.import_purchases(
+                session, [{"idempotency_key": "x", "user_id": missing_id, "amount": 1}], NOW
+            )
+            assert results == {"x": {"status": "user_not_found", "error": "Пользователь не найден"}}
+            assert created == []
+        finally:
+            await session.rollback()
@@ -0,0 +1,71 @@
+import httpx
+import pytest
+from sqlalchemy import func, select
+
+from src.referalbot.api.main import app
+from src.referalbot.database.db import async_session
+from src.referalbot.database.models import Purchase, User
+
+pytestmark = pytest.mark.anyio
+
+
+async def _pages(client: httpx.AsyncClient, limit: int):
+    after_id = 0
+    while True:
+        response = await client.get("/users", params={"after_id": after_id, "limit": limit})
+        assert response.status_code == 200
+        page = response.json()
+        if not page:
+            return
+        yield page
+        after_id = page[-1]["id"]
+
+
+async def test_keyset_pages_cover_every_user_once(db):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        pages = [page async for page in _pages(client, 700)]
+
+    ids = [user["id"] for page in pages for user in page]
+    async with async_session() as session:
+        expected = (await session.execute(select(User.id).order_by(User.id))).scalars().all()
+    assert ids == expected
+    assert all(len(page) == 700 for page in pages[:-1])
+
+
+async def test_user_summary_matches_per_user_queries(db):
+    async with async_session() as session:
+        inviter_id = await session.scalar(
+            select(User.invited_by_id).group_by(User.invited_by_id)
+            .having(func.count() > 2).order_by(User.invited_by_id).limit(1)
+        )
+        referrals = select(User.id).where(User.invited_by_id == inviter_id)
+        referral_count = await session.scalar(select(func.count()).select_from(referrals.subquery()))
+        amount, bonus, paid = (await session.execute(
+            select(
+                func.coalesce(func.sum(Purchase.amount), 0),
+                func.coalesce(func.sum(Purchase.bonus_amount), 0),
+                func.coalesce(func.sum(Purchase.bonus_amount).filter(Purchase.bonus_paid.is_(True)), 0),
+            ).where(Purchase.user_id.in_(referrals))
+        )).one()
+        own_purchase_ids = (await session.execute(
+            select(Purchase.id).where(Purchase.user_id == inviter_id).order_by(Purchase.id)
+        )).scalars().all()
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.get("/users", params={"after_id": inviter_id - 1, "limit": 1})
+    [summary] = response.json()
+
+    assert summary["id"] == inviter_id
+    assert summary["referral_count"] == referral_count
+    assert summary["referral_purchases"] == amount
+    assert summary["total_bonus"] == bonus
+    assert summary["paid_bonus"] == paid
+    assert [purchase["id"] for purchase in summary["purchases"]] == own_purchase_ids
+
+
+async def test_page_after_last_user_is_empty(db):
+    async with async_session() as session:
+        last_id = await session.scalar(select(func.max(User.id)))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.get("/users", params={"after_id": last_id, "limit": 10})
+    assert response.json() == []
@@ -0,0 +1,54 @@
+import httpx
+import pytest
+
+from src.referalbot.api.main import app
+from src.referalbot.metrics import HTTP_REQUEST_LATENCY, REGISTRY, Counter, Histogram, Metric
+
+pytestmark = pytest.mark.anyio
+
+
+def _routes(method: str) -> set[str]:
+    return {
+        labels["route"] for suffix, labels, _ in HTTP_REQUEST_LATENCY.samples()
+        if suffix == "_count" and labels["method"] == method
+    }
+
+
+async def test_route_labels_are_templates_for_mounted_apps():
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        for path in ("/admin/login", "/admin/statics/css/main.css", "/admin/no/such/page", "/no-such-page"):
+            await client.get(path)
+        await client.put("/admin/login")
+
+    routes = _routes("GET")
+    assert {"/admin/login", "/admin/statics", "unmatched"} <= routes
+    assert not any(route.startswith("/admin/no") or route == "/admin" for route in routes)
+    # Путь совпал, метод нет: шаблон маршрута, а не "unmatched"
+    assert "/admin/login" in _routes("PUT")
+
+
+def test_metric_without_samples_cannot_be_created():
+    class Incomplete(Metric):
+        type = "gauge"
+
+    with pytest.raises(TypeError):
+        Incomplete("referalbot_test_incomplete", "Metric missing samples()")
+    assert "referalbot_test_incomplete" not in REGISTRY.render()
+
+
+def test_counter_and_histogram_render():
+    counter = Counter("referalbot_test_events_total", "Test events", ("kind",))
+    counter.inc(kind="a")
+    counter.inc(2, kind="a")
+    histogram = Histogram("referalbot_test_duration_seconds", "Test durations", buckets=(0.1, 1.0))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+
+    assert counter.render()[2:] == ['referalbot_test_events_total{kind="a"} 3']
+    assert histogram.render()[2:] == [
+        'referalbot_test_duration_seconds_bucket{le="0.1"} 1',
+        'referalbot_test_duration_seconds_bucket{le="1.0"} 2',
+        'referalbot_test_duration_seconds_bucket{le="+Inf"} 2',
+        "referalbot_test_duration_seconds_sum 0.55",
+        "referalbot_test_duration_seconds_count 2",
+    ]
@@ -0,0 +1,16 @@
+from src.referalbot.jobs.notifications import NotificationDispatcher
+from src.referalbot.metrics import REGISTRY
+
+
+def test_metrics_follow_the_current_dispatcher():
+    NotificationDispatcher(bot=None)
+    dispatcher = NotificationDispatcher(bot=None)
+    dispatcher.sent_total, dispatcher.failed_total, dispatcher.backlog = 7, 2, 5
+
+    lines = REGISTRY.render().splitlines()
+
+    # Второй экземпляр не добавляет ещё одну метрику с тем же именем
+    assert lines.count("# TYPE referalbot_notifications_total counter") == 1
+    assert 'referalbot_notifications_total{outcome="sent"} 7' in lines
+    assert 'referalbot_notifications_total{outcome="failed"} 2' in lines
+    assert "referalbot_notifications_backlog 5" in lines
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from sqlalchemy import func, select
+
+from src.referalbot.bot.utils import PROMO_PREFIX_LENGTH, generate_promo_code, to_base36
+from src.referalbot.database import repository
+from src.referalbot.database.cache import promo_code_cache
+from src.referalbot.database.db import async_session
+from src.referalbot.database.models import User
+from src.referalbot.database.promo_codes import PromoCodeAllocator
+
+pytestmark = pytest.mark.anyio
+
+
+def test_to_base36():
+    assert to_base36(0) == "0"
+    assert to_base36(35) == "Z"
+    assert to_base36(36) == "10"
+    assert to_base36(36 ** 4 - 1) == "ZZZZ"
+    for number in (1, 1000, 123456789, 2 ** 63 - 1):
+        assert int(to_base36(number), 36) == number
+
+
+def test_generate_promo_code():
+    assert generate_promo_code("john_doe", 36) == "johndoe-10"
+    assert generate_promo_code("", 1) == "BALI-1"
+    assert generate_promo_code(None, 1) == "BALI-1"
+    # Имя без латиницы и цифр тоже даёт префикс по умолчанию
+    assert generate_promo_code("Иван", 1) == "BALI-1"
+
+    code = generate_promo_code("a" * 40, 2 ** 63 - 1)
+    prefix, number = code.split("-")
+    assert prefix == "a" * PROMO_PREFIX_LENGTH
+    assert int(number, 36) == 2 ** 63 - 1
+    assert len(f"REF_{code}") <= 64
+
+
+def test_promo_codes_differ_for_same_username():
+    codes = {generate_promo_code("john", number) for number in range(1000)}
+    assert len(codes) == 1000
+
+
+class FakeResult:
+    def __init__(self, value: int):
+        self.value = value
+
+    def scalar_one(self) -> int:
+        return self.value
+
+
+class FakeSequenceSession:
+    """Stands in for an AsyncSession whose only query is nextval(promo_code_seq)."""
+
+    def __init__(self, block: int):
+        self.block = block
+        self.calls = 0
+
+    async def execute(self, statement):
+        self.calls += 1
+        await asyncio.sleep(0)
+        return FakeResult(1 + (self.calls - 1) * self.block)
+
+
+async def test_allocator_reserves_blocks():
+    session = FakeSequenceSession(block=10)
+    allocator = PromoCodeAllocator(block=10)
+
+    numbers = [await allocator.allocate(session) for _ in range(25)]
+
+    assert numbers == list(range(1, 26))
+    assert session.calls == 3
+
+
+async def test_allocator_is_safe_under_concurrency():
+    session = FakeSequenceSession(block=5)
+    allocator = PromoCodeAllocator(block=5)
+
+    numbers = await asyncio.gather(*(allocator.allocate(session) for _ in range(50)))
+
+    assert sorted(numbers) == list(range(1, 51))
+    assert session.calls == 10
+
+
+async def test_resolve_promo_code_caches_known_codes(db, query_budget):
+    promo_code_cache.clear()
+    async with async_session() as session:
+        owner = (await session.execute(select(User.id, User.telegram_id).order_by(User.id).limit(1))).one()
+        promo_code = await session.scalar(select(User.promo_code).where(User.id == owner.id))
+
+        with query_budget(1):
+            assert await repository.resolve_promo_code(session, promo_code) == tuple(owner)
+        with query_budget(0):
+            assert await repository.resolve_promo_code(session, promo_code) == tuple(owner)
+
+        # Неизвестные коды не кэшируются: код может появиться позже
+        with query_budget(2) as recorder:
+            assert await repository.resolve_promo_code(session, "NOSUCHCODE-0") is None
+            assert await repository.resolve_promo_code(session, "NOSUCHCODE-0") is None
+        assert recorder.count == 2
+    promo_code_cache.clear()
+
+
+async def test_seeded_promo_codes_are_unique(db):
+    async with async_session() as session:
+        total, distinct = (await session.execute(
+            select(func.count(User.promo_code), func.count(func.distinct(User.promo_code)))
+        )).one()
+    assert total == distinct
@@ -0,0 +1,38 @@
+import httpx
+import pytest
+from sqlalchemy import select
+
+from src.referalbot.api.main import app
+from src.referalbot.database import repository
+from src.referalbot.database.db import async_session
+from src.referalbot.database.models import User
+
+pytestmark = pytest.mark.anyio
+
+
+async def _inviter_id() -> int:
+    async with async_session() as session:
+        return await session.scalar(select(User.invited_by_id).where(User.invited_by_id.is_not(None)).limit(1))
+
+
+async def test_get_bonus_balance_is_one_query(db, query_budget):
+    user_id = await _inviter_id()
+    async with async_session() as session:
+        with query_budget(1):
+            await repository.get_bonus_balance(session, user_id, use_cache=False)
+
+
+async def test_cached_bonus_balance_needs_no_query(db, query_budget):
+    user_id = await _inviter_id()
+    async with async_session() as session:
+        await repository.get_bonus_balance(session, user_id)
+        with query_budget(0):
+            await repository.get_bonus_balance(session, user_id)
+
+
+async def test_list_users_page_is_one_query(db, query_budget):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        with query_budget(1, "GET /users"):
+            response = await client.get("/users", params={"after_id": 0, "limit": 100})
+    assert response.status_code == 200
+    assert len(response.json()) == 100
@@ -0,0 +1,57 @@
+"""
+The hot repository queries must be served by indexes.
+
+Each query is EXPLAINed against the seeded database with sequential scans
+disabled. The planner still falls back to a Seq Scan when no usable index
+exists, so any Seq Scan node left in a plan means an index is missing,
+however small the seeded tables are.
+"""
+import json
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from src.referalbot.database import repository
+from src.referalbot.database.db import engine
+from src.referalbot.database.models import User, BONUS_MATURATION_PERIOD
+
+pytestmark = pytest.mark.anyio
+
+HOT_QUERIES = {
+    "get_bonus_balance": lambda user: repository.bonus_balance_query(user.id, datetime.utcnow()),
+    "get_bonus_history": lambda user: repository.bonus_history_query(user.id),
+    "get_user_by_telegram_id": lambda user: select(User).filter_by(telegram_id=user.telegram_id),
+    "get_user_by_promo_code": lambda user: select(User).filter_by(promo_code=user.promo_code),
+    "mature_pending_bonuses": lambda user: repository.matured_bonuses_batch_query(
+        datetime.utcnow() - BONUS_MATURATION_PERIOD, 1000
+    ),
+    "list_users": lambda user: repository.user_summaries_query(user.id, 100),
+}
+
+
+def seq_scans(plan: dict) -> list[str]:
+    """Tables read with a sequential scan anywhere in the plan tree."""
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child))
+    return found
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+async def test_hot_query_uses_indexes(db, name):
+    async with engine.connect() as conn:
+        user = (await conn.execute(
+            select(User.id, User.telegram_id, User.promo_code).where(User.invited_by_id.is_not(None)).limit(1)
+        )).one()
+        stmt = HOT_QUERIES[name](user)
+        sql = stmt.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+        await conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        plan = (await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}")).scalar_one()
+        await conn.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    assert seq_scans(plan[0]["Plan"]) == [], json.dumps(plan, indent=2)
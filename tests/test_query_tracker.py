@@ -0,0 +1,32 @@
+from src.referalbot.database.query_tracker import statement_shape
+
+
+def test_bound_parameters_are_replaced():
+    assert statement_shape("SELECT * FROM users WHERE id = $1 AND username = $2") == (
+        "SELECT * FROM users WHERE id = ? AND username = ?"
+    )
+    assert statement_shape("SELECT * FROM users WHERE id = %(id_1)s") == "SELECT * FROM users WHERE id = ?"
+
+
+def test_in_lists_of_any_length_share_one_shape():
+    short = statement_shape("SELECT * FROM users WHERE id IN ($1, $2)")
+    long = statement_shape("SELECT * FROM users WHERE id IN ($1, $2, $3, $4, $5)")
+    assert short == long == "SELECT * FROM users WHERE id IN (?)"
+
+
+def test_casts_in_in_lists_are_collapsed():
+    statement = "SELECT * FROM users WHERE id IN ($1::BIGINT, $2::BIGINT, $3::BIGINT)"
+    assert statement_shape(statement) == "SELECT * FROM users WHERE id IN (?)"
+
+
+def test_single_parameter_in_parentheses_is_kept():
+    assert statement_shape("SELECT coalesce($1, 0)") == "SELECT coalesce(?, 0)"
+
+
+def test_whitespace_is_normalized():
+    statement = """
+        SELECT id
+        FROM   users
+        WHERE  promo_code = $1
+    """
+    assert statement_shape(statement) == "SELECT id FROM users WHERE promo_code = ?"
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import pytest
+
+from src.referalbot.bot.rate_limit import PerChatLimiter, TokenBucket
+
+pytestmark = pytest.mark.anyio
+
+
+async def _elapsed(coro) -> float:
+    started = time.monotonic()
+    await coro
+    return time.monotonic() - started
+
+
+async def test_token_bucket_allows_burst_then_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=5)
+
+    burst = await _elapsed(asyncio.gather(*(bucket.acquire() for _ in range(5))))
+    assert burst < 0.02
+
+    # Ещё 5 токенов накапливаются за 5 / 50 = 0.1 с
+    limited = await _elapsed(asyncio.gather(*(bucket.acquire() for _ in range(5))))
+    assert 0.08 <= limited < 0.3
+
+
+async def test_token_bucket_capacity_defaults_to_rate():
+    bucket = TokenBucket(rate=3)
+    assert bucket.capacity == 3
+    assert await _elapsed(asyncio.gather(*(bucket.acquire() for _ in range(3)))) < 0.02
+
+
+async def test_token_bucket_pause_blocks_all_callers():
+    bucket = TokenBucket(rate=1000)
+    bucket.pause(0.1)
+    # Более короткая пауза не сокращает уже назначенную
+    bucket.pause(0.01)
+
+    elapsed = await _elapsed(asyncio.gather(*(bucket.acquire() for _ in range(3))))
+    assert 0.09 <= elapsed < 0.3
+
+
+async def test_per_chat_limiter_spaces_messages_to_one_chat():
+    limiter = PerChatLimiter(interval=0.05)
+
+    elapsed = await _elapsed(asyncio.gather(*(limiter.acquire(1) for _ in range(3))))
+    assert 0.09 <= elapsed < 0.3
+
+
+async def test_per_chat_limiter_does_not_delay_other_chats():
+    limiter = PerChatLimiter(interval=1)
+
+    elapsed = await _elapsed(asyncio.gather(*(limiter.acquire(chat_id) for chat_id in range(100))))
+    assert elapsed < 0.05
+
+
+async def test_per_chat_limiter_forgets_idle_chats():
+    limiter = PerChatLimiter(interval=0.01)
+    for chat_id in range(10_001):
+        await limiter.acquire(chat_id)
+    await asyncio.sleep(0.02)
+
+    await limiter.acquire(-1)
+    assert list(limiter._next_allowed) == [-1]
@@ -0,0 +1,112 @@
+import pytest
+from sqlalchemy import func, select, text, update
+
+from src.referalbot.database import repository
+from src.referalbot.database.db import async_session
+from src.referalbot.database.models import ReferralClosure, User
+
+pytestmark = pytest.mark.anyio
+
+# Расхождения таблицы с замыканием, вычисленным заново из users.invited_by_id
+DIFFERENCE = """
+    WITH RECURSIVE paths (ancestor_id, descendant_id, depth) AS (
+        SELECT invited_by_id, id, 1 FROM users WHERE invited_by_id IS NOT NULL
+        UNION ALL
+        SELECT p.ancestor_id, u.id, p.depth + 1
+        FROM paths p JOIN users u ON u.invited_by_id = p.descendant_id
+    ),
+    actual AS (SELECT ancestor_id, descendant_id, depth FROM referral_closure)
+    SELECT (SELECT count(*) FROM (SELECT * FROM paths EXCEPT SELECT * FROM actual) missing),
+           (SELECT count(*) FROM (SELECT * FROM actual EXCEPT SELECT * FROM paths) extra)
+"""
+
+
+async def _assert_closure_matches_users(session) -> None:
+    assert tuple((await session.execute(text(DIFFERENCE))).one()) == (0, 0)
+
+
+async def _user_with_deep_downline(session) -> int:
+    """A user who has referrals of referrals and an inviter of their own."""
+    return await session.scalar(
+        select(ReferralClosure.ancestor_id)
+        .join(User, User.id == ReferralClosure.ancestor_id)
+        .where(ReferralClosure.depth == 2, User.invited_by_id.is_not(None))
+        .order_by(ReferralClosure.ancestor_id)
+        .limit(1)
+    )
+
+
+async def _relink(session, user_id: int, inviter_id: int | None) -> bool:
+    await session.execute(update(User).where(User.id == user_id).values(invited_by_id=inviter_id))
+    return await repository.link_referral(session, user_id, inviter_id)
+
+
+async def test_seeded_closure_matches_users(db):
+    async with async_session() as session:
+        await _assert_closure_matches_users(session)
+
+
+async def test_moving_a_user_moves_their_downline(db):
+    async with async_session() as session:
+        try:
+            user_id = await _user_with_deep_downline(session)
+            downline = await repository.get_downline_stats(session, user_id)
+            # Новый пригласивший вне поддерева пользователя и вне его прежней ветки
+            new_inviter = await session.scalar(
+                select(User.id)
+                .where(
+                    User.id.not_in(select(ReferralClosure.descendant_id).where(ReferralClosure.ancestor_id == user_id)),
+                    User.id.not_in(select(ReferralClosure.ancestor_id).where(ReferralClosure.descendant_id == user_id)),
+                    User.id != user_id,
+                    User.invited_by_id.is_not(None),
+                )
+                .order_by(User.id)
+                .limit(1)
+            )
+
+            assert await _relink(session, user_id, new_inviter)
+
+            uplines = await repository.get_uplines(session, user_id)
+            assert uplines[0]["id"] == new_inviter
+            assert [upline["depth"] for upline in uplines] == list(range(1, len(uplines) + 1))
+            assert await repository.get_downline_stats(session, user_id) == downline
+            await _assert_closure_matches_users(session)
+        finally:
+            await session.rollback()
+
+
+async def test_detaching_a_user_keeps_their_downline(db):
+    async with async_session() as session:
+        try:
+            user_id = await _user_with_deep_downline(session)
+            downline = await repository.get_downline_stats(session, user_id)
+
+            assert await _relink(session, user_id, None)
+
+            assert await repository.get_uplines(session, user_id) == []
+            assert await repository.get_downline_stats(session, user_id) == downline
+            await _assert_closure_matches_users(session)
+        finally:
+            await session.rollback()
+
+
+async def test_cycles_are_rejected_without_changes(db):
+    async with async_session() as session:
+        try:
+            user_id = await _user_with_deep_downline(session)
+            grandchild = await session.scalar(
+                select(ReferralClosure.descendant_id)
+                .where(ReferralClosure.ancestor_id == user_id, ReferralClosure.depth == 2)
+                .limit(1)
+            )
+            rows = await session.scalar(select(func.count()).select_from(ReferralClosure))
+
+            assert await repository.creates_referral_cycle(session, user_id, grandchild)
+            assert await repository.creates_referral_cycle(session, user_id, user_id)
+            assert not await repository.link_referral(session, user_id, grandchild)
+            assert not await repository.link_referral(session, user_id, user_id)
+
+            assert await session.scalar(select(func.count()).select_from(ReferralClosure)) == rows
+            await _assert_closure_matches_users(session)
+        finally:
+            await session.rollback()
@@ -0,0 +1,192 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from src.referalbot.jobs.sheets import SheetsExporter
+
+pytestmark = pytest.mark.anyio
+
+HEADER = ["ID", "User ID", "Username", "Promo", "Invited by", "Date", "Amount", "Discount", "Bonus", "Status"]
+
+
+class FakeSheet:
+    """An in-memory worksheet recording the gspread calls made on it."""
+
+    def __init__(self, rows: list[list]):
+        self.rows = [list(row) for row in rows]
+        self.calls: list[str] = []
+        self.failures = 0
+
+    def _call(self, name: str) -> None:
+        self.calls.append(name)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("quota exceeded")
+
+    def col_values(self, col: int) -> list:
+        self._call("col_values")
+        return [row[col - 1] for row in self.rows]
+
+    def batch_update(self, updates: list[dict]) -> None:
+        self._call("batch_update")
+        for update in updates:
+            row_number = int(update["range"].split(":")[0][1:])
+            self.rows[row_number - 1] = list(update["values"][0])
+
+    def append_rows(self, rows: list[list]) -> dict:
+        self._call("append_rows")
+        first_row = len(self.rows) + 1
+        self.rows.extend(list(row) for row in rows)
+        return {"updates": {"updatedRange": f"Sheet1!A{first_row}:J{len(self.rows)}"}}
+
+
+class FakeClient:
+    def __init__(self, sheet: FakeSheet):
+        self.sheet = sheet
+        self.opened: list[str] = []
+
+    def open(self, name: str):
+        self.opened.append(name)
+        return SimpleNamespace(sheet1=self.sheet)
+
+
+def make_exporter(sheet: FakeSheet) -> tuple[SheetsExporter, FakeClient]:
+    client = FakeClient(sheet)
+    return SheetsExporter(client_factory=lambda: client, spreadsheet="Test"), client
+
+
+def purchase(purchase_id: int, amount: float = 100.0, bonus_paid: bool = False):
+    return SimpleNamespace(
+        id=purchase_id, user_id=1, date=datetime(2026, 1, 1), amount=amount,
+        discount_applied=0.0, bonus_amount=amount / 10, bonus_paid=bonus_paid,
+    )
+
+
+USER = SimpleNamespace(username="john", promo_code="john-1")
+
+
+async def test_flush_batches_updates_and_appends():
+    existing = [5, 1, "john", "john-1", "-", "2026-01-01T00:00:00", 50.0, 0.0, 5.0, "Начислен"]
+    sheet = FakeSheet([HEADER, existing])
+    exporter, client = make_exporter(sheet)
+
+    exporter.enqueue(purchase(5, bonus_paid=True), USER)
+    exporter.enqueue(purchase(6), USER)
+    exporter.enqueue(purchase(7), USER, "alice")
+    # Более позднее изменение той же покупки заменяет строку в очереди
+    exporter.enqueue(purchase(7, amount=300.0), USER, "alice")
+
+    assert await exporter.flush() == 3
+    assert sheet.calls == ["col_values", "batch_update", "append_rows"]
+    assert [row[0] for row in sheet.rows[1:]] == [5, 6, 7]
+    assert sheet.rows[1][-1] == "Выплачен"
+    assert sheet.rows[3][4] == "alice"
+    assert sheet.rows[3][6] == 300.0
+
+    # Известные покупки обновляются без повторного открытия и чтения листа
+    exporter.enqueue(purchase(6, bonus_paid=True), USER)
+    assert await exporter.flush() == 1
+    assert client.opened == ["Test"]
+    assert sheet.calls.count("col_values") == 1
+    assert sheet.rows[2][-1] == "Выплачен"
+
+    # Перед добавлением новой покупки колонка A читается заново
+    exporter.enqueue(purchase(8), USER)
+    assert await exporter.flush() == 1
+    assert client.opened == ["Test"]
+    assert sheet.calls.count("col_values") == 2
+    assert [row[0] for row in sheet.rows[1:]] == [5, 6, 7, 8]
+
+
+async def test_rows_appended_by_another_worker_are_updated_in_place():
+    sheet = FakeSheet([HEADER])
+    first, _ = make_exporter(sheet)
+    second, _ = make_exporter(sheet)
+    first.enqueue(purchase(1), USER)
+    second.enqueue(purchase(2), USER)
+    assert await first.flush() == 1
+    assert await second.flush() == 1
+
+    # Покупку 1 дописал первый воркер, а обновление пришло во второй
+    second.enqueue(purchase(1, bonus_paid=True), USER)
+    first.enqueue(purchase(2, bonus_paid=True), USER)
+    assert await second.flush() == 1
+    assert await first.flush() == 1
+
+    assert [row[0] for row in sheet.rows[1:]] == [1, 2]
+    assert [row[-1] for row in sheet.rows[1:]] == ["Выплачен", "Выплачен"]
+
+
+async def test_flush_without_pending_rows_makes_no_calls():
+    sheet = FakeSheet([HEADER])
+    exporter, client = make_exporter(sheet)
+
+    assert await exporter.flush() == 0
+    assert client.opened == []
+
+
+async def test_failed_flush_requeues_rows_and_keeps_newer_versions():
+    sheet = FakeSheet([HEADER])
+    exporter, client = make_exporter(sheet)
+    exporter.enqueue(purchase(1), USER)
+    exporter.enqueue(purchase(2), USER)
+    exporter._open_sheet()
+    sheet.failures = 1
+
+    # Пока запись падает, приходит новая версия покупки 2
+    original_write = exporter._write
+
+    def failing_write(rows):
+        exporter.enqueue(purchase(2, bonus_paid=True), USER)
+        original_write(rows)
+
+    exporter._write = failing_write
+    assert await exporter.flush() == 0
+    exporter._write = original_write
+
+    assert sheet.rows == [HEADER]
+    assert set(exporter._pending) == {1, 2}
+    assert exporter._pending[2][-1] == "Выплачен"
+
+    # Упало чтение колонки A перед добавлением; повторная попытка заново открывает лист
+    assert sheet.calls == ["col_values", "col_values"]
+    assert await exporter.flush() == 2
+    assert client.opened == ["Test", "Test"]
+    assert sheet.calls == ["col_values", "col_values", "col_values", "append_rows"]
+    assert [row[0] for row in sheet.rows[1:]] == [1, 2]
+    assert sheet.rows[2][-1] == "Выплачен"
+    assert exporter._pending == {}
+
+
+async def test_disabled_exporter_ignores_rows():
+    sheet = FakeSheet([HEADER])
+    client = FakeClient(sheet)
+    exporter = SheetsExporter(client_factory=lambda: client, spreadsheet="Test", enabled=False)
+
+    exporter.enqueue(purchase(1), USER)
+    assert await exporter.flush() == 0
+    await exporter.run(interval=0)
+    assert client.opened == []
+
+
+async def test_run_flushes_on_cancel():
+    sheet = FakeSheet([HEADER])
+    exporter, _ = make_exporter(sheet)
+    task = asyncio.create_task(exporter.run(interval=3600))
+    await asyncio.sleep(0)
+
+    exporter.enqueue(purchase(1), USER)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert [row[0] for row in sheet.rows[1:]] == [1]
+
+
+def test_first_appended_row():
+    assert SheetsExporter._first_appended_row({"updates": {"updatedRange": "Sheet1!A10:J12"}}) == 10
+    assert SheetsExporter._first_appended_row({"updates": {"updatedRange": "'Лист 1'!A3:J3"}}) == 3
+    assert SheetsExporter._first_appended_row({}) is None
+    assert SheetsExporter._first_appended_row(None) is None
@@ -0,0 +1,178 @@
+import asyncio
+
+import pytest
+from sqlalchemy import delete, func, select
+
+from src.referalbot.database import repository
+from src.referalbot.database.db import async_session
+from src.referalbot.database.models import ReferralClosure, User
+from src.referalbot.database.promo_codes import promo_code_allocator
+
+pytestmark = pytest.mark.anyio
+
+# Telegram ID ниже смещения сидера: с синтетическими пользователями не пересекаются
+TELEGRAM_IDS = range(900_000_000_001, 900_000_000_010)
+
+
+@pytest.fixture
+async def cleanup(db):
+    """Deletes the users the test committed."""
+    yield
+    async with async_session() as session:
+        async with session.begin():
+            await session.execute(delete(User).where(User.telegram_id.in_(TELEGRAM_IDS)))
+
+
+@pytest.fixture
+def allocations(monkeypatch) -> list[int]:
+    """Promo code numbers taken during the test."""
+    numbers = []
+    allocate = promo_code_allocator.allocate
+
+    async def recording_allocate(session):
+        numbers.append(await allocate(session))
+        return numbers[-1]
+
+    monkeypatch.setattr(promo_code_allocator, "allocate", recording_allocate)
+    return numbers
+
+
+async def _inviter_id(session) -> int:
+    return await session.scalar(select(User.id).where(User.invited_by_id.is_not(None)).order_by(User.id).limit(1))
+
+
+async def _upline_ids(session, user_id: int) -> list[int]:
+    return [upline["id"] for upline in await repository.get_uplines(session, user_id)]
+
+
+async def test_new_user_with_inviter(cleanup, allocations):
+    telegram_id = TELEGRAM_IDS[0]
+    async with async_session() as session:
+        async with session.begin():
+            inviter_id = await _inviter_id(session)
+            user, invited = await repository.upsert_user(session, telegram_id, "new_user", inviter_id)
+
+        assert invited
+        assert user.invited_by_id == inviter_id
+        assert user.promo_code.startswith("newuser-")
+        assert len(allocations) == 1
+        uplines = await _upline_ids(session, user.id)
+        assert uplines[0] == inviter_id
+        assert uplines[1:] == await _upline_ids(session, inviter_id)
+
+
+async def test_existing_user_costs_one_select_and_no_promo_number(cleanup, allocations, query_budget):
+    telegram_id = TELEGRAM_IDS[1]
+    async with async_session() as session:
+        async with session.begin():
+            inviter_id = await _inviter_id(session)
+            created, _ = await repository.upsert_user(session, telegram_id, "repeat", inviter_id)
+        allocations.clear()
+
+        async with session.begin():
+            with query_budget(1):
+                user, invited = await repository.upsert_user(session, telegram_id, "repeat", inviter_id)
+            with query_budget(1):
+                same_user = await repository.get_or_create_user(session, telegram_id, "repeat")
+
+    assert not invited
+    assert user.id == same_user.id == created.id
+    assert user.promo_code == created.promo_code
+    assert allocations == []
+
+
+async def test_existing_user_without_inviter_is_attached_once(cleanup):
+    telegram_id = TELEGRAM_IDS[2]
+    async with async_session() as session:
+        async with session.begin():
+            inviter_id = await _inviter_id(session)
+            user = await repository.get_or_create_user(session, telegram_id, "late")
+            assert user.invited_by_id is None
+
+        async with session.begin():
+            user, invited = await repository.upsert_user(session, telegram_id, "late", inviter_id)
+            assert invited
+            assert user.invited_by_id == inviter_id
+            assert (await _upline_ids(session, user.id))[0] == inviter_id
+
+        async with session.begin():
+            other_inviter = await session.scalar(select(User.id).where(User.id != inviter_id).limit(1))
+            user, invited = await repository.upsert_user(session, telegram_id, "late", other_inviter)
+        assert not invited
+        assert user.invited_by_id == inviter_id
+
+
+async def test_missing_inviter_is_ignored(cleanup):
+    async with async_session() as session:
+        async with session.begin():
+            missing_id = await session.scalar(select(func.max(User.id))) + 1000
+            user, invited = await repository.upsert_user(session, TELEGRAM_IDS[3], "orphan", missing_id)
+
+    assert not invited
+    assert user.invited_by_id is None
+
+
+async def test_inviter_from_own_downline_is_undone(cleanup):
+    async with async_session() as session:
+        async with session.begin():
+            user = await repository.get_or_create_user(session, TELEGRAM_IDS[4], "parent")
+            child, _ = await repository.upsert_user(session, TELEGRAM_IDS[5], "child", user.id)
+
+        async with session.begin():
+            user, invited = await repository.upsert_user(session, TELEGRAM_IDS[4], "parent", child.id)
+        assert not invited
+        assert user.invited_by_id is None
+        assert await _upline_ids(session, user.id) == []
+        rows = await session.scalar(
+            select(func.count()).select_from(ReferralClosure).where(ReferralClosure.descendant_id == user.id)
+        )
+        assert rows == 0
+
+
+async def _race(telegram_id: int, inviter_id: int) -> tuple[bool, bool]:
+    """
+    Runs two upserts with the same inviter so that the second one starts
+    while the first is still uncommitted, and returns both `invited` flags.
+    """
+    async with async_session() as first, async_session() as second:
+        async with first.begin():
+            _, first_invited = await repository.upsert_user(first, telegram_id, "racer", inviter_id)
+
+            async def second_call():
+                async with second.begin():
+                    return (await repository.upsert_user(second, telegram_id, "racer", inviter_id))[1]
+
+            second_task = asyncio.create_task(second_call())
+            # Второй вызов должен дойти до записи и ждать блокировки первого
+            await asyncio.sleep(0.3)
+            assert not second_task.done()
+        return first_invited, await second_task
+
+
+async def test_concurrent_first_starts_report_one_invitation(cleanup):
+    async with async_session() as session:
+        inviter_id = await _inviter_id(session)
+
+    assert await _race(TELEGRAM_IDS[6], inviter_id) == (True, False)
+
+    async with async_session() as session:
+        user = await repository.get_user_by_telegram_id(session, TELEGRAM_IDS[6])
+        assert user.invited_by_id == inviter_id
+        assert (await _upline_ids(session, user.id))[0] == inviter_id
+
+
+async def test_concurrent_attaches_to_existing_user_report_one_invitation(cleanup):
+    async with async_session() as session:
+        async with session.begin():
+            inviter_id = await _inviter_id(session)
+            await repository.get_or_create_user(session, TELEGRAM_IDS[7], "racer")
+
+    assert await _race(TELEGRAM_IDS[7], inviter_id) == (True, False)
+
+    async with async_session() as session:
+        user = await repository.get_user_by_telegram_id(session, TELEGRAM_IDS[7])
+        depth_one = await session.scalar(
+            select(func.count()).select_from(ReferralClosure)
+            .where(ReferralClosure.descendant_id == user.id, ReferralClosure.depth == 1)
+        )
+    assert depth_one == 1